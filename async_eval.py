@@ -0,0 +1,69 @@
+import time
+import queue
+import logging
+import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
+
+
+def _eval_loop(eval_fn, model: nn.Module, snapshots, results):
+    while True:
+        item = snapshots.get()
+        if item is None:
+            break
+        args, state_dict = item
+        model.load_state_dict(state_dict)
+        del state_dict
+        model.eval()
+        start_time = time.perf_counter()
+        with torch.no_grad():
+            result = eval_fn(model, *args)
+        results.put((args, result))
+        logging.info(f'Evaluation {args} done in {time.perf_counter() - start_time:.1f}s')
+
+
+# Runs evaluation in a separate (forked) process so that training does not wait for decoding and scoring
+# The evaluation process gets a copy of the model (and of everything eval_fn uses) at fork time, so it must be
+# created after the model, data and eval_fn are set up and before any training thread or data loader worker is
+# started. submit() takes a CPU snapshot of the current weights and queues it with the eval_fn arguments; the
+# snapshots are evaluated in order, and submit() blocks once max_pending snapshots are waiting (the training is
+# faster than the evaluation). The eval_fn return values are collected with poll()
+# Forking is only safe for CPU models (CUDA can not be reinitialized in a forked process)
+class AsyncEvaluator:
+
+    def __init__(self, eval_fn, model: nn.Module, max_pending=1):
+        ctx = mp.get_context('fork')
+        self.snapshots = ctx.Queue(maxsize=max_pending)
+        self.results = ctx.Queue()
+        self.process = ctx.Process(target=_eval_loop, args=(eval_fn, model, self.snapshots, self.results),
+                                   daemon=False)
+        self.process.start()
+
+    def submit(self, model: nn.Module, *args):
+        state_dict = {k: v.detach().to('cpu', copy=True) for k, v in model.state_dict().items()}
+        start_time = time.perf_counter()
+        self.snapshots.put((args, state_dict))
+        wait_time = time.perf_counter() - start_time
+        if wait_time > 1.0:
+            logging.info(f'Waited {wait_time:.1f}s for the evaluation process to take evaluation {args}')
+
+    # The (eval_fn args, eval_fn result) of the evaluations finished since the last call
+    def poll(self) -> list:
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except queue.Empty:
+                return results
+
+    # Wait for the pending evaluations, returns their results (see poll)
+    def close(self) -> list:
+        self.snapshots.put(None)
+        results = []
+        while self.process.is_alive() or not self.results.empty():
+            try:
+                results.append(self.results.get(timeout=0.1))
+            except queue.Empty:
+                pass
+        self.process.join()
+        return results
@@ -1,7 +1,9 @@
 import sys
 import uuid
-from collections import defaultdict
-from copy import deepcopy
+import heapq
+import random
+import itertools
+import numpy as np
 import pandas as pd
 
 lattice_fields = ['sent_id', 'from_node_id', 'to_node_id', 'form', 'lemma', 'tag', 'feats', 'token_id', 'token', 'is_gold']
@@ -27,49 +29,149 @@ def globalize(func):
     return result
 
 
-def _dfs(edges, cur_node_id, next_node_id, analysis_in, analyses):
-    node = edges[cur_node_id]
-    edge = node[next_node_id]
-    analysis = deepcopy(analysis_in)
-    analysis.append(tuple(edge))
-    if edge.to_node_id not in edges:
-        analyses.append(analysis)
-        return
-    next_node = edges[edge.to_node_id]
-    for i in range(len(next_node)):
-        _dfs(edges, edge.to_node_id, i, analysis, analyses)
-
-
-def _parse_sent_analyses(df, column_names):
-    token_analyses = {}
-    token_edges = defaultdict(lambda: defaultdict(list))
-    for row in df.itertuples():
-        token_edges[row.token_id][row.from_node_id].append(row)
-    for token_id in token_edges:
-        analyses = []
-        token_lattice_start_node_id = min(token_edges[token_id].keys())
-        token_lattice_start_node = token_edges[token_id][token_lattice_start_node_id]
-        for j in range(len(token_lattice_start_node)):
-            _dfs(token_edges[token_id], token_lattice_start_node_id, j, [], analyses)
-        token_analyses[token_id] = analyses
-    return _lattice_to_dataframe(token_analyses, column_names)
-
-
-def _lattice_to_dataframe(lattice, column_names):
+# Compact lattice graph: the nodes are compacted to 0..num_nodes-1 (in node id order) and the edges (morphemes) are
+# kept in CSR form - the edges leaving node n are edge_offsets[n]:edge_offsets[n + 1], in their original row order
+# Edges must go from a lower to a higher node id, so node order is a topological order and the path operations
+# (count, sample, score, k-best) are dynamic programs over the nodes that never materialize all the paths
+# Paths start at the first node and end at any node without outgoing edges; a path is returned as the row
+# positions of its edges in the lattice the graph was built from
+class LatticeGraph:
+
+    def __init__(self, from_node_ids, to_node_ids):
+        from_node_ids = np.asarray(from_node_ids, dtype=np.int64)
+        to_node_ids = np.asarray(to_node_ids, dtype=np.int64)
+        if np.any(to_node_ids <= from_node_ids):
+            raise ValueError('lattice edges must go from a lower to a higher node id')
+        self.node_ids, nodes = np.unique(np.concatenate([from_node_ids, to_node_ids]), return_inverse=True)
+        edge_from, edge_to = nodes[:len(from_node_ids)], nodes[len(from_node_ids):]
+        self.edge_rows = np.argsort(edge_from, kind='stable')
+        self.edge_to = edge_to[self.edge_rows]
+        self.edge_offsets = np.zeros(len(self.node_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(edge_from, minlength=len(self.node_ids)), out=self.edge_offsets[1:])
+        self._paths_from = None
+
+    @classmethod
+    def from_dataframe(cls, lattice_df: pd.DataFrame):
+        return cls(lattice_df.from_node_id.to_numpy(), lattice_df.to_node_id.to_numpy())
+
+    @property
+    def num_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def num_edges(self):
+        return len(self.edge_rows)
+
+    # Number of paths from every node to an end node (python ints, the counts grow exponentially)
+    @property
+    def paths_from(self) -> list:
+        if self._paths_from is None:
+            paths_from = [0] * self.num_nodes
+            edge_to = self.edge_to.tolist()
+            for node in reversed(range(self.num_nodes)):
+                start, end = self.edge_offsets[node], self.edge_offsets[node + 1]
+                paths_from[node] = sum(paths_from[edge_to[e]] for e in range(start, end)) if end > start else 1
+            self._paths_from = paths_from
+        return self._paths_from
+
+    def num_paths(self) -> int:
+        return self.paths_from[0] if self.num_nodes > 0 else 0
+
+    # All the paths, lazily, in depth first order (the order of the edges in the lattice rows)
+    def paths(self):
+        if self.num_edges == 0:
+            return
+        edge_to, offsets = self.edge_to.tolist(), self.edge_offsets.tolist()
+        stack = [(0, offsets[0])]
+        path = []
+        while stack:
+            node, e = stack[-1]
+            if e == offsets[node + 1]:
+                stack.pop()
+                if path:
+                    path.pop()
+                continue
+            stack[-1] = (node, e + 1)
+            path.append(e)
+            next_node = edge_to[e]
+            if offsets[next_node] == offsets[next_node + 1]:
+                yield self.edge_rows[path].tolist()
+                path.pop()
+            else:
+                stack.append((next_node, offsets[next_node]))
+
+    # Paths sampled uniformly (with replacement): every edge is chosen with probability proportional to the number
+    # of paths through it
+    def sample_paths(self, num_samples, rnd: random.Random = None) -> list:
+        rnd = rnd if rnd is not None else random.Random()
+        paths_from, edge_to = self.paths_from, self.edge_to.tolist()
+        samples = []
+        for _ in range(num_samples if self.num_edges > 0 else 0):
+            node, path = 0, []
+            while self.edge_offsets[node + 1] > self.edge_offsets[node]:
+                r = rnd.randrange(paths_from[node])
+                for e in range(self.edge_offsets[node], self.edge_offsets[node + 1]):
+                    r -= paths_from[edge_to[e]]
+                    if r < 0:
+                        break
+                path.append(e)
+                node = edge_to[e]
+            samples.append(self.edge_rows[path].tolist())
+        return samples
+
+    # Score of a path: the sum of the scores of its edges (edge_scores are aligned with the lattice rows)
+    def path_score(self, path: list, edge_scores) -> float:
+        return float(np.asarray(edge_scores, dtype=np.float64)[path].sum())
+
+    # The k highest scoring paths (score, path), best first: keeps the k best partial paths into every node
+    def best_paths(self, edge_scores, k=1) -> list:
+        if self.num_edges == 0:
+            return []
+        scores = np.asarray(edge_scores, dtype=np.float64)[self.edge_rows].tolist()
+        edge_to, offsets = self.edge_to.tolist(), self.edge_offsets.tolist()
+        # best[node]: (score, edge into node, rank of the partial path in best[edge source node])
+        best = [[] for _ in range(self.num_nodes)]
+        best[0] = [(0.0, -1, -1)]
+        edge_from = np.repeat(np.arange(self.num_nodes), np.diff(self.edge_offsets)).tolist()
+        candidates = [[] for _ in range(self.num_nodes)]
+        ends = []
+        for node in range(self.num_nodes):
+            if node > 0:
+                best[node] = heapq.nlargest(k, candidates[node], key=lambda c: c[0])
+                candidates[node] = None
+            if offsets[node] == offsets[node + 1]:
+                ends.extend((score, node, rank) for rank, (score, _, _) in enumerate(best[node]))
+            for e in range(offsets[node], offsets[node + 1]):
+                candidates[edge_to[e]].extend((score + scores[e], e, rank)
+                                              for rank, (score, _, _) in enumerate(best[node]))
+        results = []
+        for score, node, rank in heapq.nlargest(k, ends, key=lambda c: c[0]):
+            path = []
+            while node > 0:
+                _, e, prev_rank = best[node][rank]
+                path.append(e)
+                node, rank = edge_from[e], prev_rank
+            results.append((score, self.edge_rows[path[::-1]].tolist()))
+        return results
+
+
+# Enumerates the analyses (paths) of every token lattice of the sentence, in depth first order, at most
+# max_analyses per token (the first ones, the paths are generated lazily)
+def _parse_sent_analyses(df, column_names, max_analyses=None):
     rows = []
-    for token_id in lattice:
-        for i, analyses in enumerate(lattice[token_id]):
-            for j, morpheme in enumerate(analyses):
-                row = [*morpheme[1:], i, j]
-                rows.append(row)
-    # return pd.merge(lattice_df, token_df, on='token_id')
+    for token_id, token_df in df.groupby(df.token_id, sort=False):
+        graph = LatticeGraph.from_dataframe(token_df)
+        token_rows = list(token_df.itertuples(index=False, name=None))
+        for i, path in enumerate(itertools.islice(graph.paths(), max_analyses)):
+            for j, row_pos in enumerate(path):
+                rows.append([*token_rows[row_pos], i, j])
     return pd.DataFrame(rows, columns=column_names)
 
 
-def _to_data_lattices(treebank):
+def _to_data_lattices(treebank, max_analyses=None):
     dataset = {}
     column_names = lattice_fields + ['analysis_id', 'morpheme_id']
     for partition_type in treebank:
-        lattices = [_parse_sent_analyses(df, column_names) for df in treebank[partition_type]]
+        lattices = [_parse_sent_analyses(df, column_names, max_analyses) for df in treebank[partition_type]]
         dataset[partition_type] = lattices
     return dataset
@@ -0,0 +1,256 @@
+import sys
+import random
+import itertools
+import logging
+from collections import Counter
+from pathlib import Path
+import pandas as pd
+from bclm.format.format_utils import lattice_fields
+
+
+# Synthetic Hebrew-like treebanks for offline scale and performance testing
+# Tokens are built from a Zipf distributed stem lexicon, optionally preceded by single letter prefix morphemes
+# (conjunction, preposition, definite article - omitted from the token after ב, כ and ל) and followed by a
+# pronominal suffix (the suffix letters in the token, the pronoun form as the morpheme), written with Hebrew final
+# letters at the end of words. Every morpheme gets a tag, lemma and feats, and (optionally) a BIOSE NER label (the
+# biose_layer0 feature) over entity spans of consecutive tokens
+hebrew_alphabet = 'אבגדהוזחטיכלמנסעפצקרשת'
+final_letters = {'כ': 'ך', 'מ': 'ם', 'נ': 'ן', 'פ': 'ף', 'צ': 'ץ'}
+non_final_letters = {v: k for k, v in final_letters.items()}
+stem_tags = ['NN', 'NN', 'NN', 'VB', 'VB', 'JJ', 'RB', 'CD', 'NNP', 'BN']
+prefix_morphemes = [('ו', 'CONJ'), ('ה', 'DEF'), ('ב', 'PREPOSITION'), ('ל', 'PREPOSITION'), ('מ', 'PREPOSITION'),
+                    ('ש', 'REL'), ('כ', 'PREPOSITION')]
+suffix_morphemes = [('ו', 'הוא'), ('ה', 'היא'), ('ם', 'הם'), ('ן', 'הן'), ('י', 'אני'), ('נו', 'אנחנו')]
+default_feats = {'gen': ['M', 'F'], 'num': ['S', 'P'], 'per': ['1', '2', '3'], 'tense': ['PAST', 'FUTURE', 'BEINONI']}
+default_ner_types = ['PER', 'ORG', 'LOC', 'GPE', 'EVE', 'FAC', 'WOA', 'ANG']
+punctuation = [('.', 'yyDOT'), (',', 'yyCM'), ('?', 'yyQM')]
+ner_feat_name = 'biose_layer0'
+
+
+def _to_word(chars: str) -> str:
+    chars = ''.join(non_final_letters.get(c, c) for c in chars)
+    return chars[:-1] + final_letters.get(chars[-1], chars[-1])
+
+
+def _feats_str(feats: dict) -> str:
+    if len(feats) == 0:
+        return '_'
+    return '|'.join(f'{k}={feats[k]}' for k in sorted(feats))
+
+
+class SyntheticTreebank:
+
+    def __init__(self, lexicon_size=5000, alphabet=hebrew_alphabet, stem_len=(2, 6), tags=None, feats=None,
+                 max_prefixes=2, prefix_prob=0.4, suffix_prob=0.1, ner_types=None, ner_prob=0.1, max_ner_len=3,
+                 zipf_s=1.1, seed=None):
+        self.rnd = random.Random(seed)
+        self.alphabet = alphabet
+        self.tags = tags if tags is not None else stem_tags
+        self.feats = feats if feats is not None else default_feats
+        self.max_prefixes = max_prefixes
+        self.prefix_prob = prefix_prob
+        self.suffix_prob = suffix_prob
+        self.ner_types = ner_types if ner_types is not None else default_ner_types
+        self.ner_prob = ner_prob
+        self.max_ner_len = max_ner_len
+        self.lexicon = [self._random_stem(stem_len) for _ in range(lexicon_size)]
+        self.cum_weights = list(itertools.accumulate(1.0 / (i + 1) ** zipf_s for i in range(lexicon_size)))
+
+    def _random_stem(self, stem_len) -> tuple:
+        chars = ''.join(self.rnd.choice(self.alphabet) for _ in range(self.rnd.randint(*stem_len)))
+        form = _to_word(chars)
+        tag = self.rnd.choice(self.tags)
+        feats = {}
+        if tag in ['NN', 'JJ', 'VB', 'BN', 'NNP']:
+            feats.update({k: self.rnd.choice(v) for k, v in self.feats.items() if k in ['gen', 'num']})
+        if tag == 'VB':
+            feats.update({k: self.rnd.choice(v) for k, v in self.feats.items() if k not in ['gen', 'num']})
+        return form, form, tag, feats, form
+
+    # Morphemes (form, lemma, tag, feats, surface) of a random token, the token is the concatenated surfaces
+    def _random_token(self) -> list:
+        if self.rnd.random() < 0.05:
+            form, tag = self.rnd.choice(punctuation)
+            return [(form, form, tag, {}, form)]
+        morphemes = []
+        if self.rnd.random() < self.prefix_prob:
+            for _ in range(self.rnd.randint(1, self.max_prefixes)):
+                form, tag = self.rnd.choice(prefix_morphemes)
+                surface = '' if form == 'ה' and morphemes and morphemes[-1][0] in 'בכל' else form
+                morphemes.append((form, form, tag, {}, surface))
+        stem = self.rnd.choices(self.lexicon, cum_weights=self.cum_weights)[0]
+        morphemes.append(stem)
+        if stem[2] == 'NN' and self.rnd.random() < self.suffix_prob:
+            surface, form = self.rnd.choice(suffix_morphemes)
+            morphemes.append((form, form, 'S_PRN', {'gen': self.rnd.choice(self.feats['gen'])}, surface))
+        return morphemes
+
+    def _ner_labels(self, num_tokens) -> list:
+        labels = ['O'] * num_tokens
+        i = 0
+        while i < num_tokens:
+            if self.ner_types and self.rnd.random() < self.ner_prob:
+                span_len = min(self.rnd.randint(1, self.max_ner_len), num_tokens - i)
+                ner_type = self.rnd.choice(self.ner_types)
+                if span_len == 1:
+                    labels[i] = f'S-{ner_type}'
+                else:
+                    labels[i:i + span_len] = ([f'B-{ner_type}'] + [f'I-{ner_type}'] * (span_len - 2) +
+                                              [f'E-{ner_type}'])
+                i += span_len
+            else:
+                i += 1
+        return labels
+
+    # Lattice rows (lattice_fields) of a single sentence
+    def sentence(self, sent_id, num_tokens, with_ner=True) -> list:
+        tokens = [self._random_token() for _ in range(num_tokens)]
+        ner_labels = self._ner_labels(num_tokens) if with_ner else None
+        rows = []
+        node_id = 0
+        for token_id, morphemes in enumerate(tokens):
+            token = _to_word(''.join(m[4] for m in morphemes))
+            stem_idx = max(i for i, m in enumerate(morphemes)
+                           if m[2] not in ['CONJ', 'DEF', 'PREPOSITION', 'REL', 'S_PRN'])
+            for i, (form, lemma, tag, feats, _) in enumerate(morphemes):
+                if with_ner:
+                    feats = dict(feats)
+                    feats[ner_feat_name] = ner_labels[token_id] if i == stem_idx else 'O'
+                rows.append([sent_id, node_id, node_id + 1, form, lemma, tag, _feats_str(feats), token_id + 1, token,
+                             True])
+                node_id += 1
+        return rows
+
+    # Generates num_sentences sentence lattices (lists of rows), with a uniform number of tokens in token_range
+    def sentences(self, num_sentences, token_range=(5, 25), with_ner=True, first_sent_id=1):
+        for i in range(num_sentences):
+            yield self.sentence(first_sent_id + i, self.rnd.randint(*token_range), with_ner)
+
+    def lattice(self, num_sentences, token_range=(5, 25), with_ner=True) -> pd.DataFrame:
+        rows = [row for sent in self.sentences(num_sentences, token_range, with_ner) for row in sent]
+        return pd.DataFrame(rows, columns=lattice_fields)
+
+
+def _conllu_lines(sent_rows: list) -> list:
+    lines = [f'# sent_id = {sent_rows[0][0]}']
+    token_rows = {}
+    for row in sent_rows:
+        token_rows.setdefault(row[7], []).append(row)
+    lines.append(f'# text = {" ".join(rows[0][8] for rows in token_rows.values())}')
+    for rows in token_rows.values():
+        if len(rows) > 1:
+            lines.append('\t'.join([f'{rows[0][2]}-{rows[-1][2]}', rows[0][8]] + ['_'] * 8))
+        for row in rows:
+            lines.append('\t'.join([str(row[2]), row[3], row[4], row[5], row[5], row[6], '_', '_', '_', '_']))
+    return lines
+
+
+def _conllx_lines(sent_rows: list) -> list:
+    return ['\t'.join([str(row[1]), str(row[2]), row[3], row[4], row[5], row[5], row[6], str(row[7])])
+            for row in sent_rows]
+
+
+def _bmes_lines(sent_rows: list) -> list:
+    lines = []
+    for row in sent_rows:
+        feats = dict(f.split('=') for f in row[6].split('|')) if row[6] != '_' else {}
+        lines.append(f'{row[3]} {feats.get(ner_feat_name, "O")}')
+    return lines
+
+
+# Writes the sentences of a partition (streamed, so partitions larger than memory can be written) in the UD
+# CoNLL-U format, the SPMRL lattices (CoNLL-X like) and tokens formats, and the morpheme level BIOSE NER format
+# (gold file for ne_evaluate_mentions). Returns the token counts
+def write_partition(sentences, conllu_path: Path, lattices_path: Path, tokens_path: Path,
+                    bmes_path: Path = None) -> Counter:
+    token_counts = Counter()
+    files = [open(p, 'w', encoding='utf8') for p in [conllu_path, lattices_path, tokens_path, bmes_path]
+             if p is not None]
+    try:
+        for sent_rows in sentences:
+            sent_tokens = {row[7]: row[8] for row in sent_rows}
+            token_counts.update(sent_tokens.values())
+            sent_lines = [_conllu_lines(sent_rows), _conllx_lines(sent_rows), list(sent_tokens.values())]
+            if bmes_path is not None:
+                sent_lines.append(_bmes_lines(sent_rows))
+            for f, lines in zip(files, sent_lines):
+                f.write('\n'.join(lines))
+                f.write('\n\n')
+    finally:
+        for f in files:
+            f.close()
+    return token_counts
+
+
+# Generates a train/dev/test treebank under tb_root_path, laid out the way bclm.treebank expects:
+# UD_{lang}-{tb_name}/{la_name}_{tb_name}-ud-{part}.conllu and {tb_name}/{part}_{tb_name}-gold.lattices/.tokens,
+# and the gold NER files (if with_ner) as {data_root_path}/{tb_name}/gold/morph_gold_{part}.bmes
+# Returns the train token counts
+def write_treebank(synthetic_tb: SyntheticTreebank, tb_root_path, data_root_path, tb_name, num_sentences,
+                   split=(0.8, 0.1, 0.1), token_range=(5, 25), with_ner=True, lang='Hebrew', la_name='he') -> Counter:
+    ud_path = Path(tb_root_path) / f'UD_{lang}-{tb_name}'
+    spmrl_path = Path(tb_root_path) / tb_name
+    gold_path = Path(data_root_path) / tb_name / 'gold'
+    for path in [ud_path, spmrl_path, gold_path]:
+        path.mkdir(parents=True, exist_ok=True)
+    train_token_counts = Counter()
+    for part, ratio in zip(['train', 'dev', 'test'], split):
+        part_size = max(int(num_sentences * ratio), 1)
+        logging.info(f'Writing {part_size} synthetic {part} sentences')
+        sentences = synthetic_tb.sentences(part_size, token_range, with_ner)
+        token_counts = write_partition(sentences,
+                                       ud_path / f'{f"{la_name}_{tb_name}-ud-{part}".lower()}.conllu',
+                                       spmrl_path / f'{f"{part}_{tb_name}".lower()}-gold.lattices',
+                                       spmrl_path / f'{f"{part}_{tb_name}".lower()}.tokens',
+                                       gold_path / f'morph_gold_{part}.bmes' if with_ner else None)
+        if part == 'train':
+            train_token_counts = token_counts
+    return train_token_counts
+
+
+# Tiny random weight BERT (config, weights and a word piece vocab built from the token counts) loadable with
+# BertModel.from_pretrained / BertTokenizerFast.from_pretrained / AlefBERTRootTokenizer from bert_path
+def save_tiny_bert(bert_path, token_counts: Counter, vocab_size=2000, hidden_size=64, num_layers=2, num_heads=2,
+                   max_len=512, seed=0):
+    import torch
+    from transformers import BertConfig, BertModel
+    from hebrew_root_tokenizer import suf_replace
+    special_tokens = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]']
+    chars = sorted({c for token in token_counts for c in token} | set(suf_replace.values()))
+    vocab = special_tokens + chars + [f'##{c}' for c in chars]
+    vocab_set = set(vocab)
+    for token, _ in token_counts.most_common():
+        if len(vocab) >= vocab_size:
+            break
+        for piece in [token, ''.join(suf_replace.get(c, c) for c in token)]:
+            if piece not in vocab_set and len(vocab) < vocab_size:
+                vocab.append(piece)
+                vocab_set.add(piece)
+    bert_path = Path(bert_path)
+    bert_path.mkdir(parents=True, exist_ok=True)
+    with open(bert_path / 'vocab.txt', 'w', encoding='utf8') as f:
+        f.write('\n'.join(vocab) + '\n')
+    config = BertConfig(vocab_size=len(vocab), hidden_size=hidden_size, num_hidden_layers=num_layers,
+                        num_attention_heads=num_heads, intermediate_size=hidden_size * 4,
+                        max_position_embeddings=max_len)
+    torch.manual_seed(seed)
+    BertModel(config).save_pretrained(str(bert_path))
+    logging.info(f'Saved tiny BERT ({len(vocab)} word pieces) to {bert_path}')
+
+
+# python -m bclm.synthetic out_root_path num_sentences [tb_name] [seed]
+# Writes out_root_path/treebank (CoNLL-U and SPMRL files), out_root_path/raw (lattice CSVs, loaded through
+# bclm.treebank, and gold NER files) and out_root_path/bert (tiny BERT)
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    out_root_path = Path(sys.argv[1])
+    num_sentences = int(sys.argv[2])
+    tb_name = sys.argv[3] if len(sys.argv) > 3 else 'hebtb'
+    seed = int(sys.argv[4]) if len(sys.argv) > 4 else 0
+    tb_root_path = out_root_path / 'treebank'
+    raw_root_path = out_root_path / 'raw'
+    train_token_counts = write_treebank(SyntheticTreebank(seed=seed), tb_root_path, raw_root_path, tb_name,
+                                        num_sentences)
+    from bclm import treebank as tb
+    tb.spmrl_conllu(raw_root_path, tb_name, tb_root_path)
+    save_tiny_bert(out_root_path / 'bert', train_token_counts, seed=seed)
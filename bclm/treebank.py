@@ -1,5 +1,6 @@
 from collections import Counter, defaultdict
 from pathlib import Path
+import numpy as np
 import pandas as pd
 import logging
 import itertools
@@ -25,31 +26,137 @@ def _unify_multi_value_feats(feats_str: str) -> str:
 
 
 def _fix_spmrl_lattice_multivalue_feats(lattice_df: pd.DataFrame) -> pd.DataFrame:
-    rows = []
-    feats_column_index = lattice_df.columns.get_loc('feats')
-    for values in lattice_df.itertuples():
-        feats = _unify_multi_value_feats(values.feats)
-        new_values = list(values[1:])
-        new_values[feats_column_index] = feats
-        rows.append(new_values)
-    return pd.DataFrame(rows, columns=lattice_df.columns)
+    lattice_df = lattice_df.reset_index(drop=True)
+    unified_feats = {feats: _unify_multi_value_feats(feats) for feats in pd.unique(lattice_df.feats)}
+    lattice_df['feats'] = lattice_df.feats.map(unified_feats)
+    return lattice_df
+
+
+lattice_string_fields = ['token', 'form', 'lemma', 'tag', 'feats']
+
+
+# Converts the string (and feat) columns of the partition lattices to categoricals, with the same categories (the
+# values of all the parts) in every part, so that the codes of a value are the same in train, dev and test
+def to_categorical(partition: dict, fields: list = None) -> dict:
+    if fields is None:
+        feat_columns = sorted({feat_column(fname) for part in partition for fname in feat_names(partition[part])})
+        fields = lattice_string_fields + feat_columns
+    for field in fields:
+        parts = [part for part in partition if field in partition[part].columns]
+        values = pd.concat([partition[part][field].astype(object) for part in parts], ignore_index=True)
+        dtype = pd.CategoricalDtype(pd.unique(values.dropna()))
+        for part in parts:
+            partition[part][field] = partition[part][field].astype(object).astype(dtype)
+    return partition
+
+
+# The distinct values of a field over all the parts (the categories of categorical columns)
+def unique_values(partition: dict, field) -> list:
+    values = set()
+    for part in partition:
+        column = partition[part][field]
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            values.update(column.cat.categories)
+        else:
+            values.update(pd.unique(column.dropna()))
+    return sorted(values, key=str)
 
 
 # switch tag and ner values
 def _switch_tag_and_feature(lattice_df: pd.DataFrame, feat_name: str) -> pd.DataFrame:
-    tags = lattice_df.tag
-    feats = [{ff.split('=')[0]: ff.split('=')[1] for ff in f.split('|')} for f in lattice_df['feats'].tolist()]
-    new_tags = [f[feat_name] for f in feats]
-    for f, t in zip(feats, tags):
-        f['tag'] = t
-        f.pop(feat_name, None)
-    new_feats = ['|'.join([f'{k}={f[k]}' for k in f]) for f in feats]
+    feat_df = parse_feats(lattice_df.feats)
+    new_tags = feat_df[feat_column(feat_name)].astype(object).to_numpy()
+    feat_df[feat_column('tag')] = lattice_df.tag.astype(object).to_numpy()
+    feat_df = feat_df.drop(columns=[feat_column(feat_name)])
     lattice_df['tag'] = new_tags
-    lattice_df['feats'] = new_feats
+    lattice_df['feats'] = format_feats(feat_df).to_numpy()
     return lattice_df
 
 
-def spmrl_ner_conllu(data_root_path, tb_name, tb_root_path=None, ma_name=None):
+feat_column_prefix = 'feat_'
+
+
+def feat_column(feat_name) -> str:
+    return f'{feat_column_prefix}{feat_name}'
+
+
+# Names of the features that have a pre-parsed column in the lattice (see parse_feats)
+def feat_names(lattice_df: pd.DataFrame) -> list:
+    return [c[len(feat_column_prefix):] for c in lattice_df.columns if c.startswith(feat_column_prefix)]
+
+
+# Canonical feats string: the features sorted by name, '_' values omitted ('_' if there are none)
+def feats_str(feats: dict) -> str:
+    fstrs = [f'{name}={feats[name]}' for name in sorted(feats) if feats[name] != '_']
+    return '|'.join(fstrs) if len(fstrs) > 0 else '_'
+
+
+def _parse_feats_str(feats_str: str) -> dict:
+    features = defaultdict(set)
+    if isinstance(feats_str, str) and feats_str != '_':
+        for feat in feats_str.split('|'):
+            parts = feat.split('=', 1)
+            if len(parts) == 2:
+                features[parts[0]].add(parts[1])
+    return {fname: ','.join(sorted(fvalues)) for fname, fvalues in features.items()}
+
+
+# feats strings -> a categorical column per feature name (feat_{name}, '_' where the feature is missing)
+# Every distinct feats string (category of a categorical column) is parsed once
+def parse_feats(feats: pd.Series) -> pd.DataFrame:
+    if isinstance(feats.dtype, pd.CategoricalDtype):
+        codes, uniques = feats.cat.codes.to_numpy(), list(feats.cat.categories)
+    else:
+        codes, uniques = pd.factorize(feats.astype(object))
+    # code -1 (missing feats) picks the last, empty, entry
+    parsed = [_parse_feats_str(f) for f in uniques] + [{}]
+    columns = {}
+    for fname in sorted({fname for features in parsed for fname in features}):
+        value_codes, values = pd.factorize(pd.Series([features.get(fname, '_') for features in parsed], dtype=object))
+        columns[feat_column(fname)] = pd.Categorical.from_codes(value_codes[codes], categories=values)
+    return pd.DataFrame(columns, index=feats.index)
+
+
+# feat columns -> canonical feats strings (every distinct combination of feature values is formatted once)
+def format_feats(feat_df: pd.DataFrame) -> pd.Series:
+    fnames = feat_names(feat_df)
+    if len(fnames) == 0:
+        return pd.Series('_', index=feat_df.index, dtype=object)
+    columns = [feat_column(fname) for fname in fnames]
+    group_ids = feat_df.groupby(columns, observed=True, sort=False).ngroup().to_numpy()
+    combinations = feat_df[columns].drop_duplicates()
+    strs = np.array([feats_str(dict(zip(fnames, values))) for values in combinations.itertuples(index=False)],
+                    dtype=object)
+    return pd.Series(strs[group_ids], index=feat_df.index)
+
+
+# The values of the features (one array per name, '_' where missing): read from the pre-parsed feat columns of the
+# lattice if it has them, otherwise parsed from its feats strings
+def get_feat_values(lattice_df: pd.DataFrame, fnames) -> dict:
+    feat_df = lattice_df if len(feat_names(lattice_df)) > 0 else parse_feats(lattice_df.feats)
+    values = {}
+    for fname in fnames:
+        column = feat_column(fname)
+        if column in feat_df.columns:
+            values[fname] = np.asarray(feat_df[column].astype(str), dtype=object)
+        else:
+            values[fname] = np.full(len(lattice_df), '_', dtype=object)
+    return values
+
+
+# Adds the feat columns to the partition lattices, every part gets a column for every feature name of the partition
+def add_feat_columns(partition: dict) -> dict:
+    feat_dfs = {part: parse_feats(partition[part].feats) for part in partition}
+    columns = sorted({c for feat_df in feat_dfs.values() for c in feat_df.columns})
+    for part in partition:
+        feat_df = feat_dfs[part]
+        for column in columns:
+            partition[part][column] = feat_df[column] if column in feat_df.columns else '_'
+    return partition
+
+
+def spmrl_ner_conllu(data_root_path, tb_name, tb_root_path=None, ma_name=None, categorical=False,
+                     split_feats=False):
     logging.info('SPMRL NER conllu')
     partition = {'train': None, 'dev': None, 'test': None}
     ma_type = ma_name if ma_name is not None else 'gold'
@@ -67,10 +174,15 @@ def spmrl_ner_conllu(data_root_path, tb_name, tb_root_path=None, ma_name=None):
             lattice_file_path = data_tb_path / f'{part}_{tb_name}-{ma_type}.lattices.csv'
             logging.info(f'Loading: {lattice_file_path}')
             partition[part] = pd.read_csv(lattice_file_path, index_col=0)
+    if split_feats:
+        partition = add_feat_columns(partition)
+    if categorical:
+        partition = to_categorical(partition)
     return partition
 
 
-def spmrl_conllu(data_root_path, tb_name, tb_root_path=None, ma_name=None):
+def spmrl_conllu(data_root_path, tb_name, tb_root_path=None, ma_name=None, categorical=False,
+                 split_feats=False):
     logging.info('SPMRL conllu')
     partition = {'train': None, 'dev': None, 'test': None}
     ma_type = ma_name if ma_name is not None else 'gold'
@@ -90,10 +202,15 @@ def spmrl_conllu(data_root_path, tb_name, tb_root_path=None, ma_name=None):
             lattice_file_path = data_tb_path / f'{part}_{tb_name}-{ma_type}.lattices.csv'
             logging.info(f'Loading: {lattice_file_path}')
             partition[part] = pd.read_csv(lattice_file_path, index_col=0)
+    if split_feats:
+        partition = add_feat_columns(partition)
+    if categorical:
+        partition = to_categorical(partition)
     return partition
 
 
-def spmrl(data_root_path, tb_name, tb_root_path=None, ma_name=None):
+def spmrl(data_root_path, tb_name, tb_root_path=None, ma_name=None, categorical=False,
+          split_feats=False):
     logging.info('SPMRL lattices')
     partition = {'train': None, 'dev': None, 'test': None}
     ma_type = ma_name if ma_name is not None else 'gold'
@@ -114,10 +231,15 @@ def spmrl(data_root_path, tb_name, tb_root_path=None, ma_name=None):
             lattice_file_path = data_tb_path / f'{part}_{tb_name}-{ma_type}.lattices.csv'
             logging.info(f'Loading: {lattice_file_path}')
             partition[part] = pd.read_csv(lattice_file_path, index_col=0)
+    if split_feats:
+        partition = add_feat_columns(partition)
+    if categorical:
+        partition = to_categorical(partition)
     return partition
 
 
-def ud(data_root_path, tb_name, tb_root_path=None, ma_name=None):
+def ud(data_root_path, tb_name, tb_root_path=None, ma_name=None, categorical=False,
+       split_feats=False):
     logging.info('UD lattices')
     partition = {'train': None, 'dev': None, 'test': None}
     ma_type = ma_name if ma_name is not None else 'gold'
@@ -135,6 +257,10 @@ def ud(data_root_path, tb_name, tb_root_path=None, ma_name=None):
             lattice_file_path = data_tb_path / f'{part}_{tb_name}-{ma_type}.lattices.csv'
             logging.info(f'Loading: {lattice_file_path}')
             partition[part] = pd.read_csv(lattice_file_path, index_col=0)
+    if split_feats:
+        partition = add_feat_columns(partition)
+    if categorical:
+        partition = to_categorical(partition)
     return partition
 
 
@@ -142,45 +268,53 @@ def get_subsets(s, n):
     return list(itertools.combinations(s, n))
 
 
+# Shared integer codes of the values of a field in the predicted and gold lattices (the categorical codes if both
+# columns have the same categories)
+def _field_codes(pred_values: pd.Series, gold_values: pd.Series) -> (np.array, np.array):
+    if (isinstance(pred_values.dtype, pd.CategoricalDtype) and isinstance(gold_values.dtype, pd.CategoricalDtype) and
+            pred_values.cat.categories.equals(gold_values.cat.categories)):
+        return pred_values.cat.codes.to_numpy(), gold_values.cat.codes.to_numpy()
+    codes, _ = pd.factorize(pd.concat([pred_values.astype(object), gold_values.astype(object)], ignore_index=True))
+    return codes[:len(pred_values)], codes[len(pred_values):]
+
+
+# Scores the predicted morphemes of every gold token against the gold morphemes, for every subset of the fields:
+# aligned (the morphemes at the same position in the token) and mset (the multiset of morphemes in the token)
+# The field values are compared as integer codes and the counts are computed with groupby over all the tokens
 def morph_eval(pred_df, gold_df, fields):
-    gold_gb = gold_df.groupby([gold_df.sent_id, gold_df.token_id])
-    pred_gb = pred_df.groupby([pred_df.sent_id, pred_df.token_id])
-    aligned_gold_counts, aligned_pred_counts, aligned_intersection_counts = defaultdict(int), defaultdict(int), defaultdict(int)
-    mset_gold_counts, mset_pred_counts, mset_intersection_counts = defaultdict(int), defaultdict(int), defaultdict(int)
-    for (sent_id, token_id), gold in sorted(gold_gb):
-        for n in range(1, len(fields) + 1):
-            fsets = get_subsets(fields, n)
-            for fs in fsets:
-                gold_values = [tuple(row[1].values) for row in gold[list(fs)].iterrows()]
-                if (sent_id, token_id) not in pred_gb.groups:
-                    pred_values = []
-                else:
-                    pred = pred_gb.get_group((sent_id, token_id))
-                    pred_values = [tuple(row[1].values) for row in pred[list(fs)].iterrows()]
-                # mset
-                gold_count, pred_count = Counter(gold_values), Counter(pred_values)
-                intersection_count = gold_count & pred_count
-                mset_gold_counts[fs] += sum(gold_count.values())
-                mset_pred_counts[fs] += sum(pred_count.values())
-                mset_intersection_counts[fs] += sum(intersection_count.values())
-                # aligned
-                intersection_values = [p for g, p in zip(gold_values, pred_values) if p == g]
-                aligned_gold_counts[fs] += len(gold_values)
-                aligned_pred_counts[fs] += len(pred_values)
-                aligned_intersection_counts[fs] += len(intersection_values)
+    token_keys = ['sent_id', 'token_id']
+    gold = gold_df[token_keys].reset_index(drop=True)
+    pred = pred_df[token_keys].reset_index(drop=True)
+    for field in fields:
+        pred[field], gold[field] = _field_codes(pred_df[field], gold_df[field])
+    gold['morph_pos'] = gold.groupby(token_keys).cumcount()
+    pred['morph_pos'] = pred.groupby(token_keys).cumcount()
+    pred = pred[pd.MultiIndex.from_frame(pred[token_keys]).isin(pd.MultiIndex.from_frame(gold[token_keys]))]
+    aligned = gold.merge(pred, on=token_keys + ['morph_pos'], suffixes=('_gold', '_pred'))
     aligned_scores, mset_scores = {}, {}
-    for fs in aligned_gold_counts:
-        precision = aligned_intersection_counts[fs] / aligned_pred_counts[fs] if aligned_pred_counts[fs] else 0.0
-        recall = aligned_intersection_counts[fs] / aligned_gold_counts[fs] if aligned_gold_counts[fs] else 0.0
-        f1 = 2.0 * (precision * recall) / (precision + recall) if precision + recall else 0.0
-        aligned_scores[fs] = precision, recall, f1
-    for fs in mset_gold_counts:
-        precision = mset_intersection_counts[fs] / mset_pred_counts[fs] if mset_pred_counts[fs] else 0.0
-        recall = mset_intersection_counts[fs] / mset_gold_counts[fs] if mset_gold_counts[fs] else 0.0
-        f1 = 2.0 * (precision * recall) / (precision + recall) if precision + recall else 0.0
-        mset_scores[fs] = precision, recall, f1
+    if len(gold) == 0:
+        return aligned_scores, mset_scores
+    for n in range(1, len(fields) + 1):
+        for fs in get_subsets(fields, n):
+            gold_counts = gold.groupby(token_keys + list(fs)).size()
+            pred_counts = pred.groupby(token_keys + list(fs)).size()
+            gold_counts, pred_counts = gold_counts.align(pred_counts, join='inner')
+            mset_intersection_count = int(np.minimum(gold_counts.to_numpy(), pred_counts.to_numpy()).sum())
+            aligned_matches = np.ones(len(aligned), dtype=bool)
+            for field in fs:
+                aligned_matches &= aligned[f'{field}_gold'].to_numpy() == aligned[f'{field}_pred'].to_numpy()
+            aligned_intersection_count = int(aligned_matches.sum())
+            aligned_scores[fs] = _scores(aligned_intersection_count, len(pred), len(gold))
+            mset_scores[fs] = _scores(mset_intersection_count, len(pred), len(gold))
     return aligned_scores, mset_scores
 
 
+def _scores(intersection_count, pred_count, gold_count) -> tuple:
+    precision = intersection_count / pred_count if pred_count else 0.0
+    recall = intersection_count / gold_count if gold_count else 0.0
+    f1 = 2.0 * (precision * recall) / (precision + recall) if precision + recall else 0.0
+    return precision, recall, f1
+
+
 def ner_eval(ner_file_path, truth_file_path, with_type=True):
     ne_evaluate_mentions.evaluate_files(truth_file_path, ner_file_path, ignore_cat=with_type)
@@ -1,67 +1,153 @@
-from collections import defaultdict
-from bclm import treebank as tb
+import json
+import logging
 from pathlib import Path
-import pickle
-
-vocab_file_path = Path('vocab.pickle')
-if vocab_file_path.exists():
-    with open(str(vocab_file_path), 'rb') as f:
-        (token2id, form2id, lemma2id, char2id, tag2id, feats2id) = pickle.load(f)
-        id2token = {v: k for k, v in token2id.items()}
-        id2form = {v: k for k, v in form2id.items()}
-        id2lemma = {v: k for k, v in lemma2id.items()}
-        id2char = {v: k for k, v in char2id.items()}
-        id2tag = {v: k for k, v in tag2id.items()}
-        id2feats = {}
-        for feat_type in feats2id:
-            id2feats[feat_type] = {v: k for k, v in feats2id[feat_type].items()}
-else:
-    properties = ['token', 'form', 'lemma', 'tag', 'feats']
-
-    token2id, form2id, lemma2id, char2id, tag2id = ({'<pad>': 0, '<s>': 1, '</s>': 2, '_': 3} for _ in range(5))
-    id2token, id2form, id2lemma, id2char, id2tag = ({0: '<pad>', 1: '<s>', 2: '</s>', 3: '_'} for _ in range(5))
-    feats2id = {}
-    id2feats = {}
-    prop2ids = [token2id, form2id, lemma2id, tag2id, feats2id]
-    id2props = [id2token, id2form, id2lemma, id2tag, id2feats]
-    partition = tb.spmrl(None)
-    for part in partition:
-        for sample in partition[part]:
-            for prop, prop2id, id2prop in zip(properties, prop2ids, id2props):
-                for value in sample[prop]:
-                    if prop == 'feats':
-                        if value == '_':
-                            continue
-                        feats = defaultdict(set)
-                        for feat_key_value in value.split("|"):
-                            feat_key, feat_value = feat_key_value.split("=")
-                            feats[feat_key].add(feat_value)
-                        for feat_key in feats:
-                            if feat_key not in prop2id:
-                                prop2id[feat_key] = {'<pad>': 0, '<s>': 1, '</s>': 2, '_': 3}
-                                id2prop[feat_key] = {0: '<pad>', 1: '<s>', 2: '</s>', 3: '_'}
-                            feat_value = ','.join(feats[feat_key])
-                            if feat_value not in prop2id[feat_key]:
-                                next_id = len(id2prop[feat_key])
-                                id2prop[feat_key][next_id] = feat_value
-                                prop2id[feat_key][feat_value] = next_id
-                    else:
-                        if value not in prop2id:
-                            next_id = len(id2prop)
-                            id2prop[next_id] = value
-                            prop2id[value] = next_id
-                        if prop in ['token', 'form', 'lemma']:
-                            for c in value:
-                                if c not in char2id:
-                                    next_id = len(id2char)
-                                    id2char[next_id] = c
-                                    char2id[c] = next_id
-    with open(str(vocab_file_path), 'wb') as f:
-        pickle.dump((token2id, form2id, lemma2id, char2id, tag2id, feats2id), f)
-
-print(f'{len(id2token)} tokens')
-print(f'{len(id2form)} forms')
-print(f'{len(id2lemma)} lemmas')
-print(f'{len(id2char)} chars')
-print(f'{len(id2tag)} tags')
-print(f'{len(id2feats)} feats')
+import numpy as np
+import pandas as pd
+
+# Vocabulary of a lattice partition (the token, form, lemma, tag and per feature values, and the chars of the
+# tokens, forms and lemmas). Every table interns its strings into contiguous ids (the special symbols first, then
+# the values in order of first appearance in the partition) and keeps the id -> string table as a numpy array,
+# the string -> id index is built on first lookup
+# Saved as a folder: meta.json (format version and table files) and one .npy string array per table, loaded
+# memory mapped. Nothing is loaded or built on import, see get_vocab
+vocab_format_version = 1
+special_symbols = ['<pad>', '<s>', '</s>', '_']
+string_properties = ['token', 'form', 'lemma', 'tag']
+char_properties = ['token', 'form', 'lemma']
+
+
+class StringTable:
+
+    def __init__(self, strings: np.array):
+        self.strings = strings
+        self._index = None
+
+    @property
+    def index(self) -> pd.Index:
+        if self._index is None:
+            self._index = pd.Index(np.asarray(self.strings, dtype=object))
+        return self._index
+
+    def __len__(self):
+        return len(self.strings)
+
+    # Ids of the values (-1 for values not in the table)
+    def encode(self, values) -> np.array:
+        return self.index.get_indexer(np.asarray(values, dtype=object))
+
+    def decode(self, ids) -> np.array:
+        return self.strings[np.asarray(ids)]
+
+    def to_dict(self) -> dict:
+        return {s: i for i, s in enumerate(self.strings.tolist())}
+
+
+def _string_array(values: list) -> np.array:
+    return np.array(values, dtype=str) if values else np.array([], dtype='U1')
+
+
+def _intern(values) -> StringTable:
+    uniques = pd.unique(pd.Series(values, dtype=object).dropna())
+    uniques = [s for s in uniques.tolist() if s not in special_symbols]
+    return StringTable(_string_array(special_symbols + uniques))
+
+
+# feats strings (key=value|key=value or _) -> (key, value) per feats string, the values of a key that appears more
+# than once in a feats string are joined (sorted) with ','
+def _feat_values(feats: pd.Series) -> pd.DataFrame:
+    feats = pd.Series(pd.unique(feats.dropna()), dtype=object)
+    feats = feats[feats != '_']
+    key_values = feats.str.split('|').explode()
+    key_values = key_values[key_values.str.contains('=', regex=False)].str.split('=', n=1, expand=True)
+    if key_values.empty:
+        return pd.DataFrame(columns=['key', 'value'])
+    key_values.columns = ['key', 'value']
+    key_values['row'] = key_values.index
+    key_values = key_values.groupby(['row', 'key'], sort=False).value.agg(lambda v: ','.join(sorted(set(v))))
+    return key_values.reset_index()[['key', 'value']]
+
+
+class Vocab:
+
+    def __init__(self, tables: dict, feats: dict):
+        self.tables = tables
+        self.feats = feats
+
+    @property
+    def token(self) -> StringTable:
+        return self.tables['token']
+
+    @property
+    def form(self) -> StringTable:
+        return self.tables['form']
+
+    @property
+    def lemma(self) -> StringTable:
+        return self.tables['lemma']
+
+    @property
+    def char(self) -> StringTable:
+        return self.tables['char']
+
+    @property
+    def tag(self) -> StringTable:
+        return self.tables['tag']
+
+    @classmethod
+    def build(cls, partition: dict):
+        lattices = pd.concat([partition[part] for part in partition], ignore_index=True)
+        tables = {prop: _intern(lattices[prop]) for prop in string_properties}
+        words = pd.unique(pd.concat([lattices[prop] for prop in char_properties], ignore_index=True).dropna())
+        tables['char'] = _intern(list(''.join(str(w) for w in words)))
+        feat_values = _feat_values(lattices.feats)
+        feats = {key: _intern(key_df.value) for key, key_df in feat_values.groupby('key', sort=False)}
+        return cls(tables, feats)
+
+    def save(self, vocab_path: Path):
+        vocab_path = Path(vocab_path)
+        vocab_path.mkdir(parents=True, exist_ok=True)
+        files = {}
+        for name, table in self.tables.items():
+            files[name] = f'{name}.npy'
+            np.save(vocab_path / files[name], table.strings)
+        feat_files = {}
+        for i, (key, table) in enumerate(self.feats.items()):
+            feat_files[key] = f'feats-{i}.npy'
+            np.save(vocab_path / feat_files[key], table.strings)
+        meta = {'version': vocab_format_version, 'tables': files, 'feats': feat_files}
+        with open(vocab_path / 'meta.json', 'w', encoding='utf8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+
+    @classmethod
+    def load(cls, vocab_path: Path):
+        vocab_path = Path(vocab_path)
+        with open(vocab_path / 'meta.json', encoding='utf8') as f:
+            meta = json.load(f)
+        if meta.get('version') != vocab_format_version:
+            raise ValueError(f'{vocab_path}: vocab format version {meta.get("version")}, '
+                             f'expected {vocab_format_version}')
+        tables = {name: StringTable(np.load(vocab_path / file_name, mmap_mode='r'))
+                  for name, file_name in meta['tables'].items()}
+        feats = {key: StringTable(np.load(vocab_path / file_name, mmap_mode='r'))
+                 for key, file_name in meta['feats'].items()}
+        return cls(tables, feats)
+
+    def print_stats(self):
+        for name, table in self.tables.items():
+            print(f'{len(table)} {name}s')
+        print(f'{len(self.feats)} feats')
+
+
+# Loads the vocab saved in vocab_path, or builds it from the partition returned by load_partition (called only
+# if there is no saved vocab of the current format version) and saves it
+def get_vocab(vocab_path: Path, load_partition) -> Vocab:
+    vocab_path = Path(vocab_path)
+    if (vocab_path / 'meta.json').exists():
+        try:
+            return Vocab.load(vocab_path)
+        except ValueError as e:
+            logging.info(f'Rebuilding vocab: {e}')
+    logging.info(f'Building vocab: {vocab_path}')
+    vocab = Vocab.build(load_partition())
+    vocab.save(vocab_path)
+    return vocab
@@ -0,0 +1,485 @@
+import gc
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import platform
+import resource
+import tempfile
+from collections import Counter
+from pathlib import Path
+import pandas as pd
+import torch
+import torch.nn as nn
+from transformers import BertModel, BertTokenizerFast
+from bclm import treebank as tb
+from bclm import ne_evaluate_mentions
+from bclm.format.format_utils import lattice_fields
+from bclm.synthetic import SyntheticTreebank, write_treebank, save_tiny_bert, ner_feat_name
+from conditional_random_field import ConditionalRandomField, allowed_transitions
+from hebrew_root_tokenizer import AlefBERTRootTokenizer
+from morph_model import BertTokenEmbeddingModel, SegmentDecoder
+import utils
+
+# Benchmarks of the morphological disambiguation pipeline hot paths, run on synthetic treebanks (bclm.synthetic)
+# of several sizes (scale = number of sentences). Every benchmark records its best wall time over the repeats,
+# its throughput (items/sec, the item unit depends on the benchmark) and the peak memory of the process while
+# it ran, and the results are saved to a JSON file. Two result files are compared with the compare command, which
+# flags the benchmarks that got slower (or used more memory) by more than the threshold
+# Usage:
+# python benchmark.py run results.json [scales] [benchmark names] [repeats]
+#   e.g. python benchmark.py run base.json 100,1000 crf_viterbi,morph_eval 3
+# python benchmark.py compare base_results.json new_results.json [threshold]
+# The compare command exits with status 1 if there are regressions
+
+tb_name = 'hebtb'
+pad, sos, eos, sep = '<pad>', '<s>', '</s>', '<sep>'
+default_scales = [100, 1000]
+default_repeats = 3
+default_threshold = 0.1
+batch_size = 32
+char_emb_size = 50
+hidden_size = 64
+num_layers = 2
+beam_size = 4
+max_form_len = 30
+ner_error_rate = 0.1
+tag_error_rate = 0.1
+
+_data_cache = {}
+
+
+# Synthetic sentences of a scale and the vocabularies and per sentence tensors the benchmarks share
+def _get_data(num_sentences, work_path: Path) -> dict:
+    if num_sentences in _data_cache:
+        return _data_cache[num_sentences]
+    data_path = work_path / f'data_{num_sentences}'
+    synthetic_tb = SyntheticTreebank(seed=0)
+    sentences = list(synthetic_tb.sentences(num_sentences))
+    lattice_df = pd.DataFrame([row for sent in sentences for row in sent], columns=lattice_fields)
+    chars = sorted({c for sent in sentences for row in sent for c in row[3] + row[8]})
+    char2id = {c: i for i, c in enumerate([pad, sos, eos, sep] + chars)}
+    tags = [pad, eos] + sorted(set(lattice_df.tag))
+    tag2id = {t: i for i, t in enumerate(tags)}
+    sent_tensors = []
+    for sent in sentences:
+        token_rows = {}
+        for row in sent:
+            token_rows.setdefault(row[7], []).append(row)
+        token_rows = list(token_rows.values())
+        max_token_len = max(len(rows[0][8]) for rows in token_rows)
+        max_num_morphemes = max(len(rows) for rows in token_rows)
+        token_chars = torch.zeros((len(token_rows), max_token_len), dtype=torch.long)
+        form_chars = torch.zeros((len(token_rows), max_form_len), dtype=torch.long)
+        token_tags = torch.zeros((len(token_rows), max_num_morphemes), dtype=torch.long)
+        for i, rows in enumerate(token_rows):
+            token_chars[i, :len(rows[0][8])] = torch.tensor([char2id[c] for c in rows[0][8]])
+            forms = [char2id[c] for row in rows for c in list(row[3]) + [sep]][:-1] + [char2id[eos]]
+            form_chars[i, :len(forms)] = torch.tensor(forms[:max_form_len])
+            token_tags[i, :len(rows)] = torch.tensor([tag2id[row[5]] for row in rows])
+        sent_tensors.append((sent[0][0], token_chars, form_chars, token_tags))
+    token_counts = Counter(row[8] for sent in sentences for row in {row[7]: row for row in sent}.values())
+    bert_path = data_path / 'bert'
+    save_tiny_bert(bert_path, token_counts)
+    data = {'path': data_path, 'sentences': sentences, 'lattice_df': lattice_df, 'char2id': char2id,
+            'id2char': {i: c for c, i in char2id.items()}, 'tag2id': tag2id, 'sent_tensors': sent_tensors,
+            'bert_path': bert_path}
+    _data_cache[num_sentences] = data
+    return data
+
+
+def _num_tokens(data: dict) -> int:
+    return sum(len(token_chars) for _, token_chars, _, _ in data['sent_tensors'])
+
+
+def _setup_treebank(num_sentences, work_path: Path) -> dict:
+    tb_path = work_path / f'treebank_{num_sentences}'
+    tb_root_path, raw_root_path = tb_path / 'treebank', tb_path / 'raw'
+    if not tb_path.exists():
+        write_treebank(SyntheticTreebank(seed=0), tb_root_path, raw_root_path, tb_name, num_sentences)
+        tb.spmrl_conllu(raw_root_path, tb_name, tb_root_path)
+    return {'tb_root_path': tb_root_path, 'raw_root_path': raw_root_path}
+
+
+def _run_treebank_conllu(state: dict) -> int:
+    partition = tb.spmrl_conllu(state['raw_root_path'], tb_name, state['tb_root_path'])
+    return sum(df.sent_id.nunique() for df in partition.values())
+
+
+def _run_treebank_csv(state: dict) -> int:
+    partition = tb.spmrl_conllu(state['raw_root_path'], tb_name)
+    return sum(df.sent_id.nunique() for df in partition.values())
+
+
+def _setup_preprocess(num_sentences, work_path: Path) -> dict:
+    # The preprocessing modules depend on fasttext
+    from data import preprocess_base, preprocess_form, preprocess_labels
+    data = _get_data(num_sentences, work_path)
+    morph_df = preprocess_base._get_morph_df(data['lattice_df'].copy())
+    feats = {}
+    for morph_feats in morph_df.feats:
+        for f in morph_feats.split('|'):
+            if f != '_':
+                feat_name, feat_value = f.split('=')
+                feats.setdefault(feat_name, set()).add(feat_value)
+    labels2id = {name: {l: i for i, l in enumerate([pad, eos] + sorted(values | {'_'}))}
+                 for name, values in feats.items()}
+    labels2id['tag'] = data['tag2id']
+    xtokenizer = BertTokenizerFast.from_pretrained(str(data['bert_path']))
+    return {'morph_df': morph_df, 'char2id': data['char2id'], 'labels2id': labels2id, 'xtokenizer': xtokenizer,
+            'modules': (preprocess_base, preprocess_form, preprocess_labels)}
+
+
+def _run_preprocess(state: dict) -> int:
+    preprocess_base, preprocess_form, preprocess_labels = state['modules']
+    morph_df, char2id, xtokenizer = state['morph_df'], state['char2id'], state['xtokenizer']
+    xtoken_df = preprocess_base._create_xtoken_df(morph_df, xtokenizer, sos, eos)
+    preprocess_base._collate_xtokens(xtoken_df, xtokenizer, pad)
+    token_char_df = preprocess_base._create_token_char_df(morph_df)
+    preprocess_base._collate_token_chars(token_char_df, char2id, pad)
+    form_char_df = preprocess_form._create_form_char_df(morph_df, sep, eos)
+    preprocess_form._collate_form_chars(form_char_df, char2id, pad)
+    preprocess_labels._collate_labels(morph_df, state['labels2id'], pad, eos)
+    return morph_df.sent_id.nunique()
+
+
+def _setup_root_tokenizer(num_sentences, work_path: Path) -> dict:
+    data = _get_data(num_sentences, work_path)
+    tokenizer = AlefBERTRootTokenizer(str(data['bert_path'] / 'vocab.txt'))
+    texts = [' '.join({row[7]: row[8] for row in sent}.values()) for sent in data['sentences']]
+    return {'tokenizer': tokenizer, 'texts': texts, 'num_tokens': _num_tokens(data)}
+
+
+# The word cache is cleared so that every repeat tokenizes the words from scratch
+def _run_root_tokenizer(state: dict) -> int:
+    tokenizer = state['tokenizer']
+    tokenizer.cache.clear()
+    for text in state['texts']:
+        tokenizer.tokenize(text)
+    return state['num_tokens']
+
+
+def _setup_bert_pooling(num_sentences, work_path: Path) -> dict:
+    data = _get_data(num_sentences, work_path)
+    xtokenizer = BertTokenizerFast.from_pretrained(str(data['bert_path']))
+    bert = BertModel.from_pretrained(str(data['bert_path']))
+    model = BertTokenEmbeddingModel(bert, xtokenizer).eval()
+    sent_xtokens = []
+    for sent in data['sentences']:
+        tokens = {row[7]: row[8] for row in sent}
+        xtokens = [(0, xtokenizer.cls_token_id)]
+        for token_id, token in tokens.items():
+            xtokens.extend((token_id, xt) for xt in xtokenizer.convert_tokens_to_ids(xtokenizer.tokenize(token)))
+        xtokens.append((len(tokens) + 1, xtokenizer.sep_token_id))
+        sent_xtokens.append(torch.tensor(xtokens, dtype=torch.long))
+    batches = []
+    for i in range(0, len(sent_xtokens), batch_size):
+        batch = sent_xtokens[i:i + batch_size]
+        xtokens = torch.full((len(batch), max(len(x) for x in batch), 2), -1, dtype=torch.long)
+        xtokens[:, :, 1] = xtokenizer.pad_token_id
+        for j, x in enumerate(batch):
+            xtokens[j, :len(x)] = x
+        batches.append(xtokens)
+    return {'model': model, 'batches': batches, 'num_tokens': _num_tokens(data)}
+
+
+def _run_bert_pooling(state: dict) -> int:
+    with torch.no_grad():
+        for xtokens in state['batches']:
+            state['model'](xtokens)
+    return state['num_tokens']
+
+
+def _create_segment_decoder(data: dict) -> SegmentDecoder:
+    torch.manual_seed(0)
+    num_chars = len(data['char2id'])
+    char_emb = nn.Embedding(num_chars, char_emb_size, padding_idx=0)
+    labels_configs = [{'id2label': {i: t for t, i in data['tag2id'].items()}}]
+    return SegmentDecoder(char_emb, hidden_size, num_layers, 0.0, 0.0, num_chars, labels_configs,
+                          fused_labels=True).eval()
+
+
+def _setup_segment_decoder(num_sentences, work_path: Path) -> dict:
+    data = _get_data(num_sentences, work_path)
+    torch.manual_seed(0)
+    enc_states = [torch.randn(len(token_chars), num_layers * hidden_size)
+                  for _, token_chars, _, _ in data['sent_tensors']]
+    special_symbols = {s: torch.tensor([data['char2id'][s]]) for s in [pad, sos, eos, sep]}
+    return {'decoder': _create_segment_decoder(data), 'sent_tensors': data['sent_tensors'],
+            'enc_states': enc_states, 'special_symbols': special_symbols, 'num_tokens': _num_tokens(data)}
+
+
+# Greedy decoding, token by token (the inference path of MorphSequenceModel.forward)
+def _run_segment_decode(state: dict) -> int:
+    decoder, special_symbols = state['decoder'], state['special_symbols']
+    with torch.no_grad():
+        for (_, token_chars, _, token_tags), enc_state in zip(state['sent_tensors'], state['enc_states']):
+            for chars, token_state in zip(token_chars, enc_state):
+                decoder(chars, token_state, special_symbols, max_form_len, None, token_tags.shape[1])
+    return state['num_tokens']
+
+
+def _run_segment_beam_decode(state: dict) -> int:
+    decoder, special_symbols = state['decoder'], state['special_symbols']
+    with torch.no_grad():
+        for (_, token_chars, _, _), enc_state in zip(state['sent_tensors'], state['enc_states']):
+            decoder.beam_decode(token_chars, enc_state, special_symbols, max_form_len, beam_size)
+    return state['num_tokens']
+
+
+# Morpheme level BIOSE NER CRF over random scores, batched like the label scores of a train batch
+def _setup_crf(num_sentences, work_path: Path) -> dict:
+    data = _get_data(num_sentences, work_path)
+    ner_labels = sorted({f for f in data['lattice_df'].feats.str.extract(f'{ner_feat_name}=([^|]+)')[0].dropna()})
+    id2label = {i: l for i, l in enumerate(ner_labels)}
+    label2id = {l: i for i, l in id2label.items()}
+    torch.manual_seed(0)
+    crf = ConditionalRandomField(len(id2label), constraints=allowed_transitions('BIOSE', id2label))
+    sent_labels = []
+    for sent in data['sentences']:
+        sent_labels.append([label2id[dict(f.split('=') for f in row[6].split('|'))[ner_feat_name]] for row in sent])
+    batches = []
+    for i in range(0, len(sent_labels), batch_size):
+        batch = sent_labels[i:i + batch_size]
+        max_len = max(len(labels) for labels in batch)
+        tags = torch.zeros((len(batch), max_len), dtype=torch.long)
+        mask = torch.zeros((len(batch), max_len), dtype=torch.bool)
+        for j, labels in enumerate(batch):
+            tags[j, :len(labels)] = torch.tensor(labels)
+            mask[j, :len(labels)] = True
+        batches.append((torch.randn(len(batch), max_len, len(id2label)), tags, mask))
+    return {'crf': crf, 'batches': batches, 'num_morphemes': len(data['lattice_df'])}
+
+
+def _run_crf_viterbi(state: dict) -> int:
+    with torch.no_grad():
+        for logits, _, mask in state['batches']:
+            state['crf'].viterbi_tags(logits, mask)
+    return state['num_morphemes']
+
+
+def _run_crf_loss(state: dict) -> int:
+    crf = state['crf']
+    for logits, tags, mask in state['batches']:
+        logits = logits.detach().requires_grad_()
+        loss = -crf(logits, tags, mask) / torch.sum(mask)
+        loss.backward()
+    crf.zero_grad()
+    return state['num_morphemes']
+
+
+def _setup_detokenize(num_sentences, work_path: Path) -> dict:
+    data = _get_data(num_sentences, work_path)
+    id2labels = {'tag': {i: t for t, i in data['tag2id'].items()}}
+    return {'sent_tensors': data['sent_tensors'], 'id2char': data['id2char'], 'id2labels': id2labels,
+            'eos': data['char2id'][eos], 'sep': data['char2id'][sep],
+            'label_pads': [torch.tensor([data['tag2id'][pad]], dtype=torch.long)]}
+
+
+# Decoded char and label tensors to lattice rows (the evaluation path of morph_train.process)
+def _run_detokenize(state: dict) -> int:
+    lattice_rows = []
+    for sent_id, token_chars, form_chars, token_tags in state['sent_tensors']:
+        input_tokens = utils.to_sent_tokens(token_chars, state['id2char'])
+        segments = utils.to_token_morph_segments(form_chars, state['id2char'], state['eos'], state['sep'])
+        labels = utils.to_token_morph_labels([token_tags], ['tag'], state['id2labels'], state['label_pads'])
+        lattice_rows.append((sent_id, input_tokens, segments, labels))
+    utils.get_lattice_data(lattice_rows, ['tag'])
+    return len(state['sent_tensors'])
+
+
+# Gold lattice and a prediction with tag_error_rate of the tags replaced
+def _setup_morph_eval(num_sentences, work_path: Path) -> dict:
+    data = _get_data(num_sentences, work_path)
+    gold_df = data['lattice_df']
+    pred_df = gold_df.copy()
+    rnd = random.Random(0)
+    tags = sorted(set(gold_df.tag))
+    pred_df['tag'] = [rnd.choice(tags) if rnd.random() < tag_error_rate else t for t in pred_df.tag]
+    return {'gold_df': gold_df, 'pred_df': pred_df}
+
+
+def _run_morph_eval(state: dict) -> int:
+    tb.morph_eval(state['pred_df'], state['gold_df'], ['form', 'tag'])
+    return state['gold_df'].sent_id.nunique()
+
+
+def _write_bmes(sentences, file_path: Path, error_rate=0.0, seed=0):
+    rnd = random.Random(seed)
+    with open(file_path, 'w', encoding='utf8') as f:
+        for sent in sentences:
+            for row in sent:
+                label = dict(f.split('=') for f in row[6].split('|'))[ner_feat_name]
+                if rnd.random() < error_rate:
+                    label = 'O' if label != 'O' else 'S-PER'
+                f.write(f'{row[3]} {label}\n')
+            f.write('\n')
+
+
+# Gold and predicted (ner_error_rate of the labels changed) morpheme level BIOSE files
+def _setup_ner_eval(num_sentences, work_path: Path) -> dict:
+    data = _get_data(num_sentences, work_path)
+    gold_path, pred_path = data['path'] / 'gold.bmes', data['path'] / 'pred.bmes'
+    _write_bmes(data['sentences'], gold_path)
+    _write_bmes(data['sentences'], pred_path, ner_error_rate)
+    return {'gold_path': gold_path, 'pred_path': pred_path, 'num_sentences': len(data['sentences'])}
+
+
+# ne_evaluate_mentions.evaluate_files without the printing
+def _run_ner_eval(state: dict) -> int:
+    gold_sents = ne_evaluate_mentions.read_file_sents(state['gold_path'])
+    pred_sents = ne_evaluate_mentions.read_file_sents(state['pred_path'])
+    gold_mentions = ne_evaluate_mentions.sents_to_mentions(gold_sents, truncate=None, str_join_char='')
+    pred_mentions = ne_evaluate_mentions.sents_to_mentions(pred_sents, truncate=None, str_join_char='')
+    ne_evaluate_mentions.evaluate_mentions(gold_mentions, pred_mentions, verbose=False)
+    return state['num_sentences']
+
+
+# name: (setup(num_sentences, work_path) -> state, run(state) -> number of items processed, item unit)
+benchmarks = {
+    'treebank_conllu': (_setup_treebank, _run_treebank_conllu, 'sents'),
+    'treebank_csv': (_setup_treebank, _run_treebank_csv, 'sents'),
+    'preprocess_collate': (_setup_preprocess, _run_preprocess, 'sents'),
+    'root_tokenizer': (_setup_root_tokenizer, _run_root_tokenizer, 'tokens'),
+    'bert_pooling': (_setup_bert_pooling, _run_bert_pooling, 'tokens'),
+    'segment_decode': (_setup_segment_decoder, _run_segment_decode, 'tokens'),
+    'segment_beam_decode': (_setup_segment_decoder, _run_segment_beam_decode, 'tokens'),
+    'crf_viterbi': (_setup_crf, _run_crf_viterbi, 'morphemes'),
+    'crf_loss': (_setup_crf, _run_crf_loss, 'morphemes'),
+    'detokenize': (_setup_detokenize, _run_detokenize, 'sents'),
+    'morph_eval': (_setup_morph_eval, _run_morph_eval, 'sents'),
+    'ner_eval': (_setup_ner_eval, _run_ner_eval, 'sents'),
+}
+
+
+def _read_status_mb(field) -> float:
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(f'{field}:'):
+                return int(line.split()[1]) / 1024
+    return None
+
+
+# Peak resident memory (MB) since the last _reset_peak_memory call, or since the process started if the peak can
+# not be reset (no /proc/self/clear_refs)
+def _reset_peak_memory() -> bool:
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_memory_mb() -> float:
+    try:
+        return _read_status_mb('VmHWM')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _memory_mb() -> float:
+    try:
+        return _read_status_mb('VmRSS')
+    except OSError:
+        return None
+
+
+def run_benchmark(name, num_sentences, work_path: Path, repeats=default_repeats) -> dict:
+    setup, run, unit = benchmarks[name]
+    result = {'benchmark': name, 'scale': num_sentences, 'unit': unit}
+    try:
+        state = setup(num_sentences, work_path)
+        gc.collect()
+        peak_reset = _reset_peak_memory()
+        start_memory = _memory_mb()
+        times = []
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            num_items = run(state)
+            times.append(time.perf_counter() - start_time)
+        peak_memory = _peak_memory_mb()
+    except Exception as e:
+        logging.exception(f'Benchmark {name} (scale {num_sentences}) failed')
+        result['error'] = f'{type(e).__name__}: {e}'
+        return result
+    wall_time = min(times)
+    result.update({'items': num_items, 'wall_time': wall_time, 'times': times,
+                   'throughput': num_items / wall_time if wall_time > 0 else None, 'peak_memory_mb': peak_memory,
+                   'peak_memory_delta_mb': peak_memory - start_memory if peak_reset and start_memory else None})
+    logging.info(f'{name} (scale {num_sentences}): {wall_time:.3f}s, {result["throughput"]:.1f} {unit}/sec, '
+                 f'peak memory {peak_memory:.1f}MB')
+    return result
+
+
+def run_benchmarks(names: list, scales: list, repeats=default_repeats, work_path=None) -> dict:
+    tmp_path = None
+    if work_path is None:
+        tmp_path = work_path = Path(tempfile.mkdtemp(prefix='bclm_benchmark_'))
+    results = []
+    try:
+        for num_sentences in scales:
+            for name in names:
+                results.append(run_benchmark(name, num_sentences, Path(work_path), repeats))
+            _data_cache.pop(num_sentences, None)
+    finally:
+        if tmp_path is not None:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+    return {'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'host': platform.node(),
+            'python': platform.python_version(), 'torch': torch.__version__, 'num_threads': torch.get_num_threads(),
+            'repeats': repeats, 'results': results}
+
+
+# Benchmarks whose wall time (or peak memory delta) grew by more than threshold (relative) from base to new
+def compare_results(base: dict, new: dict, threshold=default_threshold) -> list:
+    base_results = {(r['benchmark'], r['scale']): r for r in base['results']}
+    regressions = []
+    print('benchmark\tscale\tbase time\tnew time\ttime ratio\tbase mem\tnew mem')
+    for r in new['results']:
+        key = (r['benchmark'], r['scale'])
+        b = base_results.get(key)
+        if b is None or 'error' in b or 'error' in r:
+            error = r.get('error', b.get('error') if b is not None else 'not in base results')
+            print(f'{key[0]}\t{key[1]}\t{error}')
+            continue
+        time_ratio = r['wall_time'] / b['wall_time']
+        flags = []
+        if time_ratio > 1.0 + threshold:
+            flags.append('TIME REGRESSION')
+        base_mem, new_mem = b.get('peak_memory_delta_mb'), r.get('peak_memory_delta_mb')
+        if base_mem is not None and new_mem is not None and new_mem > max(base_mem, 1.0) * (1.0 + threshold):
+            flags.append('MEMORY REGRESSION')
+        base_mem_str = f'{base_mem:.1f}' if base_mem is not None else '-'
+        new_mem_str = f'{new_mem:.1f}' if new_mem is not None else '-'
+        print(f'{key[0]}\t{key[1]}\t{b["wall_time"]:.3f}\t{r["wall_time"]:.3f}\t{time_ratio:.2f}\t'
+              f'{base_mem_str}\t{new_mem_str}\t{" ".join(flags)}')
+        if flags:
+            regressions.append({'benchmark': key[0], 'scale': key[1], 'time_ratio': time_ratio,
+                                'base_memory_mb': base_mem, 'new_memory_mb': new_mem, 'flags': flags})
+    print(f'{len(regressions)} regressions (threshold {threshold:.0%})')
+    return regressions
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    command = sys.argv[1]
+    if command == 'run':
+        results_path = Path(sys.argv[2])
+        scales = [int(s) for s in sys.argv[3].split(',')] if len(sys.argv) > 3 else default_scales
+        names = sys.argv[4].split(',') if len(sys.argv) > 4 else list(benchmarks)
+        repeats = int(sys.argv[5]) if len(sys.argv) > 5 else default_repeats
+        run_results = run_benchmarks(names, scales, repeats)
+        with open(results_path, 'w') as f:
+            json.dump(run_results, f, indent=2)
+        logging.info(f'Saved benchmark results to {results_path}')
+    elif command == 'compare':
+        with open(sys.argv[2]) as f:
+            base_results = json.load(f)
+        with open(sys.argv[3]) as f:
+            new_results = json.load(f)
+        threshold = float(sys.argv[4]) if len(sys.argv) > 4 else default_threshold
+        sys.exit(1 if compare_results(base_results, new_results, threshold) else 0)
+    else:
+        raise ValueError(f'Unknown command: {command} (run or compare)')
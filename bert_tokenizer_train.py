@@ -1,18 +1,204 @@
+import gzip
+import heapq
+import random
+import hashlib
 import logging
+import collections
+import multiprocessing as mp
 from pathlib import Path
 from tokenizers.implementations import BertWordPieceTokenizer
+from hebrew_root_tokenizer import Word, suf_replace
 
+special_tokens = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]']
 
-def train_tokenizer(data_file_paths):
+
+def _read_line_chunks(data_file_paths, sample_rate, lines_per_chunk=10000, seed=42):
+    rnd = random.Random(seed)
+    lines = []
+    for data_file_path in data_file_paths:
+        with open(data_file_path, encoding='utf8', errors='replace') as f:
+            for line in f:
+                if sample_rate < 1.0 and rnd.random() >= sample_rate:
+                    continue
+                lines.append(line)
+                if len(lines) == lines_per_chunk:
+                    yield lines
+                    lines = []
+    if lines:
+        yield lines
+
+
+def _count_chunk_words(lines: list) -> collections.Counter:
+    counts = collections.Counter()
+    for line in lines:
+        counts.update(line.split())
+    return counts
+
+
+# Whitespace separated word counts of the data files (a sample_rate fraction of their lines), counted by
+# num_workers processes with a bounded number of chunks in flight
+def count_words(data_file_paths, sample_rate=1.0, num_workers=8) -> collections.Counter:
+    word_counts = collections.Counter()
+    ctx = mp.get_context('fork')
+    with ctx.Pool(num_workers) as pool:
+        pending = collections.deque()
+        chunks = _read_line_chunks(data_file_paths, sample_rate)
+        while True:
+            for lines in chunks:
+                pending.append(pool.apply_async(_count_chunk_words, (lines,)))
+                if len(pending) >= 2 * num_workers:
+                    break
+            if not pending:
+                break
+            word_counts.update(pending.popleft().get())
+    return word_counts
+
+
+# The word counts are cached in word_counts_root_path, keyed by the data files (path, size and modification time)
+# and the sample rate, as a gzipped word<TAB>count file, most frequent first
+def get_word_counts(data_file_paths, word_counts_root_path, sample_rate=1.0) -> collections.Counter:
+    h = hashlib.sha1(f'{sample_rate}'.encode('utf8'))
+    for data_file_path in data_file_paths:
+        stat = Path(data_file_path).stat()
+        h.update(f'{Path(data_file_path).resolve()}:{stat.st_size}:{stat.st_mtime_ns}'.encode('utf8'))
+    word_counts_path = Path(word_counts_root_path) / f'word_counts-{h.hexdigest()[:16]}.tsv.gz'
+    if word_counts_path.exists():
+        logger.info(f'loading word counts from {word_counts_path}')
+        word_counts = collections.Counter()
+        with gzip.open(word_counts_path, 'rt', encoding='utf8') as f:
+            for line in f:
+                word, count = line.rstrip('\n').split('\t')
+                word_counts[word] = int(count)
+        return word_counts
+    logger.info(f'counting words in {data_file_paths} (sample rate {sample_rate})')
+    word_counts = count_words(data_file_paths, sample_rate)
+    word_counts_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = word_counts_path.with_name(f'.{word_counts_path.name}.tmp')
+    with gzip.open(tmp_path, 'wt', encoding='utf8') as f:
+        for word, count in word_counts.most_common():
+            f.write(f'{word}\t{count}\n')
+    tmp_path.rename(word_counts_path)
+    logger.info(f'saved {len(word_counts)} word counts to {word_counts_path}')
+    return word_counts
+
+
+# Every word is fed to the trainer count // count_scale times, at least once (in strings of at most max_repeat
+# copies), so the trainer normalizes, pre-tokenizes and counts about 1 / count_scale of the corpus tokens
+# With count_scale 1 the trainer sees the same word frequencies as when it reads the data files, otherwise the
+# frequencies are approximate: rounded down, and the words rarer than count_scale are counted once
+def _word_count_iterator(word_counts: collections.Counter, count_scale=1, max_repeat=10000):
+    for word, count in word_counts.items():
+        count = max(count // count_scale, 1)
+        while count > 0:
+            n = min(count, max_repeat)
+            yield ' '.join([word] * n)
+            count -= n
+
+
+# WordPiece vocabulary in vocabulary rank order (the special tokens, the alphabet and the learned merges in merge
+# order, as saved in vocab.txt). The merges are greedy, so the vocabulary of a smaller size is a prefix of this one
+# (up to the order of the pairs with equal counts)
+# The trainer is fed the word counts divided by count_scale, with min_frequency scaled by the same factor
+def train_wordpiece_vocab(word_counts: collections.Counter, vocab_size, min_frequency=2, limit_alphabet=1000,
+                          count_scale=1) -> list:
     t = BertWordPieceTokenizer()
-    t.train(
-        files=data_file_paths,
+    t.train_from_iterator(
+        _word_count_iterator(word_counts, count_scale),
         vocab_size=vocab_size,
-        min_frequency=2,
+        min_frequency=max(min_frequency // count_scale, 1),
         show_progress=True,
-        limit_alphabet=1000,
+        limit_alphabet=limit_alphabet,
+        special_tokens=special_tokens,
     )
-    return t
+    return [token for token, _ in sorted(t.get_vocab().items(), key=lambda item: item[1])]
+
+
+def _push_pair(heap, pair_counts, pair):
+    if pair_counts[pair] > 0:
+        heapq.heappush(heap, (-pair_counts[pair], pair))
+
+
+# Root tokenizer (AlefBERTRootTokenizer) vocabulary: the special tokens and the alphabet followed by the learned
+# merges in merge order (the tokenizer applies the merges by vocabulary rank). Every step merges the most frequent
+# piece pair or root structure (see hebrew_root_tokenizer.Word) over the max_words most frequent words (final
+# letters mapped as in whitespace_tokenize), updating only the words that contain the merged pair
+# The alphabet is the limit_alphabet most frequent chars that occur at least min_frequency times (as in the
+# wordpiece trainer), and the words with chars out of the alphabet are not merged
+# The merges are greedy, so the vocabulary of a smaller size is a prefix of this one
+def train_roots_vocab(word_counts: collections.Counter, vocab_size, min_frequency=2, limit_alphabet=1000,
+                      max_words=200000) -> list:
+    counts = collections.Counter()
+    for word, count in word_counts.items():
+        counts[''.join(suf_replace.get(c, c) for c in word)] += count
+    char_counts = collections.Counter()
+    for word, count in counts.items():
+        for c in word:
+            char_counts[c] += count
+    alphabet = {c for c, count in char_counts.most_common(limit_alphabet) if count >= min_frequency}
+    vocab = special_tokens + sorted(alphabet)
+    vocab_set = set(vocab)
+    words = [Word(word, count) for word, count in counts.most_common(max_words)
+             if len(word) > 1 and alphabet.issuperset(word)]
+    pair_counts = collections.Counter()
+    pair_words = collections.defaultdict(set)
+    for i, word in enumerate(words):
+        word.make_pairs()
+        for pair in word.pairs:
+            pair_counts[pair] += word.count
+            pair_words[pair].add(i)
+    heap = []
+    for pair in pair_counts:
+        _push_pair(heap, pair_counts, pair)
+    while len(vocab) < vocab_size and heap:
+        neg_count, best_pair = heapq.heappop(heap)
+        if -neg_count != pair_counts[best_pair]:
+            continue
+        if -neg_count < min_frequency:
+            break
+        changed = set()
+        for i in list(pair_words[best_pair]):
+            word = words[i]
+            for pair in word.pairs:
+                pair_counts[pair] -= word.count
+                pair_words[pair].discard(i)
+                changed.add(pair)
+            word.join(best_pair)
+            word.make_pairs()
+            for pair in word.pairs:
+                pair_counts[pair] += word.count
+                pair_words[pair].add(i)
+                changed.add(pair)
+        for pair in changed:
+            _push_pair(heap, pair_counts, pair)
+        if best_pair not in vocab_set:
+            vocab.append(best_pair)
+            vocab_set.add(best_pair)
+        if len(vocab) % 1000 == 0:
+            logger.info(f'roots vocab size: {len(vocab)}')
+    return vocab
+
+
+def save_vocab(vocab: list, tokenizer_folder_path: Path):
+    tokenizer_folder_path.mkdir(parents=True, exist_ok=True)
+    with open(tokenizer_folder_path / 'vocab.txt', 'w', encoding='utf8') as f:
+        f.write('\n'.join(vocab) + '\n')
+
+
+# Trains every tokenizer type and vocab size from a single (cached) word count pass over the data files
+# Every tokenizer type is trained once at the largest vocab size, and the smaller vocabs are its prefixes
+def train_tokenizers(data_file_paths, corpus_type, vocab_sizes: list, tokenizer_types: list, sample_rate=1.0,
+                     count_scale=1):
+    word_counts = get_word_counts(data_file_paths, tokenizers_root_path / 'word_counts', sample_rate)
+    for tokenizer_type in tokenizer_types:
+        logger.info(f'training {tokenizer_type} vocab of size {max(vocab_sizes)}')
+        if tokenizer_type == 'wordpiece_roots':
+            vocab = train_roots_vocab(word_counts, max(vocab_sizes))
+        else:
+            vocab = train_wordpiece_vocab(word_counts, max(vocab_sizes), count_scale=count_scale)
+        for vocab_size in vocab_sizes:
+            tokenizer_folder_path = tokenizers_root_path / tokenizer_type / f'{tokenizer_type}-{corpus_type}-{vocab_size}'
+            logger.info(f'saving {tokenizer_type} tokenizer of vocab size {vocab_size} to {tokenizer_folder_path}')
+            save_vocab(vocab[:vocab_size], tokenizer_folder_path)
 
 
 # Setup logging
@@ -27,7 +213,11 @@ logging.basicConfig(
 # paths = [str(x) for x in Path("./data/raw").glob("**/*.txt")]
 corpus_type = 'oscar'
 paths = ['data/raw/oscar/he_dedup.txt']
-vocab_size = 52000
-tokenizer = train_tokenizer(paths)
-tokenizer_folder_path = Path(f'./experiments/tokenizers/wordpiece/wordpiece-{corpus_type}-{vocab_size}')
-tokenizer.save_model(str(tokenizer_folder_path))
+tokenizers_root_path = Path('./experiments/tokenizers')
+vocab_sizes = [10000, 32000, 52000]
+tokenizer_types = ['wordpiece', 'wordpiece_roots']
+# Fraction of the lines used for the word counts
+sample_rate = 1.0
+# Word counts fed to the wordpiece trainer divided by wordpiece_count_scale (1: exact corpus frequencies)
+wordpiece_count_scale = 10
+train_tokenizers(paths, corpus_type, vocab_sizes, tokenizer_types, sample_rate, wordpiece_count_scale)
@@ -1,12 +1,19 @@
+import json
+import math
 import logging
 from pathlib import Path
-from datasets import load_dataset
+import numpy as np
+import pandas as pd
+import torch
+from torch.optim import AdamW
+from datasets import load_dataset, load_from_disk
 from transformers import BertConfig, TrainingArguments, set_seed
 from transformers.trainer import Trainer
 from transformers.data.data_collator import DataCollatorForLanguageModeling
 from transformers.models.bert.tokenization_bert_fast import BertTokenizerFast
 from transformers.models.bert.modeling_bert import BertForMaskedLM
 from hebrew_root_tokenizer import AlefBERTRootTokenizer
+from pretrain_corpus import compile_corpus, CorpusBlockDataset
 
 
 def run_on_ram():
@@ -47,42 +54,118 @@ def get_model(model_path=None):
     return bert, bert_tokenizer
 
 
-def get_train_data(max_length, min_length=0):
-    # paths = [str(x) for x in Path("/dev/shm/amitse").glob("*.*")]
-    # paths = ['data/raw/oscar/he_dedup.txt', 'data/raw/wikipedia/wikipedia.raw',
-    #          'data/raw/twitter/hebrew_tweets_text_clean_full.txt']
-    paths = ['data/raw/oscar/he_dedup.txt']
+def get_tokenized_data():
+    paths = train_data_paths
     logger.info(f'loading training data from: {paths}')
     # ds = load_dataset('text', data_files=[str(p)], cache_dir='/dev/shm/amitse/.cache')
     ds = load_dataset('text', data_files=paths)
 
+    # doc_start marks the lines that follow a blank line (document boundaries in the raw text files)
     def tokenize_function(examples):
-        examples["text"] = [line for line in examples["text"] if len(line.split()) > 1]
-        return tokenizer(examples["text"], add_special_tokens=True, return_special_tokens_mask=False,
-                         return_length=True, return_token_type_ids=False, return_attention_mask=False)
+        lines, doc_starts = [], []
+        prev_blank = False
+        for line in examples["text"]:
+            if len(line.split()) > 1:
+                lines.append(line)
+                doc_starts.append(prev_blank)
+            prev_blank = len(line.strip()) == 0
+        examples["text"] = lines
+        tokenized = tokenizer(examples["text"], add_special_tokens=True, return_special_tokens_mask=False,
+                              return_length=True, return_token_type_ids=False, return_attention_mask=False)
+        tokenized["doc_start"] = doc_starts
+        return tokenized
     return ds.map(
         tokenize_function,
         batched=True,
         num_proc=8,
-    ).filter(lambda e: min_length < e['length'] < max_length)
+    )
+
+
+def get_train_data(max_length, min_length=0, tokenized_ds=None):
+    if tokenized_ds is None:
+        tokenized_ds = get_tokenized_data()
+    return tokenized_ds.filter(lambda e: min_length < e['length'] < max_length)
+
+
+# Concatenates consecutive tokenized lines into blocks of exactly block_size pieces: [CLS] followed by the line
+# pieces, each line ending with its [SEP]. Lines longer than a block continue in the next block, and the pieces
+# left over at the end of a map batch are dropped
+# With doc_boundaries, blocks do not cross documents and the last block of a document is kept as a shorter block
+# (if it is longer than min_length, it is padded by the data collator)
+def pack_lines(examples, block_size, cls_token_id, sep_token_id, doc_boundaries=False, min_length=0) -> dict:
+    blocks = []
+
+    def add_blocks(stream, keep_tail):
+        for i in range(0, len(stream), block_size - 1):
+            block = [cls_token_id] + stream[i:i + block_size - 1]
+            if len(block) == block_size or (keep_tail and len(block) > max(min_length, 1)):
+                blocks.append(block)
+
+    stream = []
+    for input_ids, doc_start in zip(examples['input_ids'], examples['doc_start']):
+        if doc_boundaries and doc_start and stream:
+            add_blocks(stream, True)
+            stream = []
+        line_ids = input_ids[1:] if input_ids[:1] == [cls_token_id] else input_ids
+        if line_ids[-1:] != [sep_token_id]:
+            line_ids = line_ids + [sep_token_id]
+        stream.extend(line_ids)
+    add_blocks(stream, doc_boundaries)
+    return {'input_ids': blocks, 'length': [len(block) for block in blocks]}
+
+
+def get_packed_train_data(max_length, tokenized_ds=None, doc_boundaries=False, min_length=0):
+    if tokenized_ds is None:
+        tokenized_ds = get_tokenized_data()
+    cls_token_id, sep_token_id = tokenizer.cls_token_id, tokenizer.sep_token_id
+    logger.info(f'packing training data into {max_length} piece blocks (document boundaries: {doc_boundaries})')
+    return tokenized_ds.map(
+        lambda examples: pack_lines(examples, max_length, cls_token_id, sep_token_id, doc_boundaries, min_length),
+        batched=True,
+        num_proc=8,
+        remove_columns=tokenized_ds['train'].column_names,
+    )
+
+
+# Share of pad positions when the samples are batched in random order and padded to the longest sample of
+# their batch (as DataCollatorForLanguageModeling does)
+def padding_ratio(lengths, batch_size, seed=42) -> float:
+    lengths = np.random.RandomState(seed).permutation(np.asarray(lengths))
+    if len(lengths) == 0:
+        return 0.0
+    num_batches = math.ceil(len(lengths) / batch_size)
+    padded_lengths = np.zeros(num_batches * batch_size, dtype=lengths.dtype)
+    padded_lengths[:len(lengths)] = lengths
+    batch_lengths = padded_lengths.reshape(num_batches, batch_size)
+    batch_sizes = np.minimum(batch_size, len(lengths) - np.arange(num_batches) * batch_size)
+    return 1.0 - lengths.sum() / (batch_lengths.max(axis=1) * batch_sizes).sum()
+
+
+# Padding ratio of the length filtered line samples (and the share of the pieces the filter discards) versus
+# the padding ratio of the packed blocks
+def print_padding_stats(tokenized_ds, packed_ds, batch_size, max_length, min_length=0):
+    line_lengths = np.asarray(tokenized_ds['train']['length'])
+    kept = (line_lengths > min_length) & (line_lengths < max_length)
+    discarded_ratio = 1.0 - line_lengths[kept].sum() / line_lengths.sum()
+    print(f'filtered lines: {kept.sum()} samples, padding ratio: {padding_ratio(line_lengths[kept], batch_size):.4f}, '
+          f'discarded pieces: {discarded_ratio:.4f}')
+    block_lengths = np.asarray(packed_ds['train']['length'])
+    print(f'packed blocks: {len(block_lengths)} samples, padding ratio: {padding_ratio(block_lengths, batch_size):.4f}, '
+          f'pieces: {block_lengths.sum()} ({block_lengths.sum() / line_lengths.sum():.4f} of the tokenized pieces)')
 
 
 def get_data_collator():
     return DataCollatorForLanguageModeling(tokenizer=tokenizer)
 
 
-def get_train_args(lr=1e-4):
-    train_root_path = Path('experiments/transformers/bert') / bert_model_size_type / tokenizer_type
-    p = train_root_path / f'bert-{bert_model_size_type}-{tokenizer_type}-{data_source_name}-{vocab_size}-05-64'
-    # p = train_root_path / f'bert-{bert_model_size_type}-{tokenizer_type}-{data_source_name}-{vocab_size}-05-128'
-    # p = train_root_path / f'bert-{bert_model_size_type}-{tokenizer_type}-{data_source_name}-{vocab_size}-05'
-    p.mkdir(parents=True, exist_ok=True)
+def get_train_args(output_path: Path, lr=1e-4, num_train_epochs=5, batch_size=48, gradient_accumulation_steps=5):
+    output_path.mkdir(parents=True, exist_ok=True)
     return TrainingArguments(
-        output_dir=str(p),
+        output_dir=str(output_path),
         overwrite_output_dir=True,
-        num_train_epochs=5,
-        per_device_train_batch_size=48,
-        gradient_accumulation_steps=5,
+        num_train_epochs=num_train_epochs,
+        per_device_train_batch_size=batch_size,
+        gradient_accumulation_steps=gradient_accumulation_steps,
         save_total_limit=0,
         save_steps=0,
         learning_rate=lr,
@@ -91,6 +174,118 @@ def get_train_args(lr=1e-4):
     )
 
 
+# Intermediate stages are saved to ...-{epochs}-{max_length} and the last stage to ...-{epochs}
+def get_stage_output_path(max_length, num_train_epochs, last_stage) -> Path:
+    train_root_path = Path('experiments/transformers/bert') / bert_model_size_type / tokenizer_type
+    name = f'bert-{bert_model_size_type}-{tokenizer_type}-{data_source_name}-{vocab_size}-{num_train_epochs:02d}'
+    if not last_stage:
+        name = f'{name}-{max_length}'
+    return train_root_path / name
+
+
+# Per device batch size and gradient accumulation steps of a stage, so that a train step covers tokens_per_step
+# pieces (at max_length) and a device batch at most max_batch_tokens pieces
+def get_stage_batch_config(max_length) -> (int, int):
+    samples_per_step = max(tokens_per_step // max_length, 1)
+    batch_size = max(min(max_batch_tokens // max_length, samples_per_step), 1)
+    gradient_accumulation_steps = math.ceil(samples_per_step / batch_size)
+    return samples_per_step // gradient_accumulation_steps, gradient_accumulation_steps
+
+
+# Packed (or length filtered) training data of a stage, saved to disk the first time it is built so that reruns
+# and later stages with the same lengths skip the tokenization
+# With use_corpus_shards, the blocks are read from the pre-tokenized corpus of the tokenizer (pretrain_corpus),
+# compiled on first use and shared by every stage and run
+def get_stage_train_data(max_length, min_length=0, batch_size=48):
+    global tokenized_dataset
+    if use_corpus_shards:
+        corpus_path = compile_corpus(train_data_paths, tokenizer, corpus_root_path,
+                                     f'{tokenizer_type}-{data_source_name}-{vocab_size}')
+        return {'train': CorpusBlockDataset(corpus_path, max_length, tokenizer.cls_token_id)}
+    data_type = 'packed' if pack_sequences else 'filtered'
+    stage_data_path = (Path('experiments/datasets/bert') / tokenizer_type /
+                       f'{data_source_name}-{vocab_size}-{data_type}-{min_length}-{max_length}')
+    if stage_data_path.exists():
+        logger.info(f'loading stage training data from {stage_data_path}')
+        return load_from_disk(str(stage_data_path))
+    if tokenized_dataset is None:
+        tokenized_dataset = get_tokenized_data()
+    if pack_sequences:
+        train_dataset = get_packed_train_data(max_length, tokenized_dataset, pack_doc_boundaries, min_length)
+        print_padding_stats(tokenized_dataset, train_dataset, batch_size, max_length, min_length)
+    else:
+        train_dataset = get_train_data(max_length, min_length, tokenized_dataset)
+    logger.info(f'saving stage training data to {stage_data_path}')
+    train_dataset.save_to_disk(str(stage_data_path))
+    return train_dataset
+
+
+def get_sample_lengths(dataset) -> pd.Series:
+    if isinstance(dataset, CorpusBlockDataset):
+        return pd.Series(dataset.lengths())
+    return dataset.data.column('length').to_pandas()
+
+
+# Trains the (max_length, min_length, num_train_epochs) stages in sequence, each stage continuing from the model
+# weights and optimizer state of the previous one (the learning rate schedule restarts every stage). Every stage
+# saves its model, tokenizer, optimizer state and train stats to its output path, and stages that already have
+# their stats saved are loaded instead of trained again
+def train_curriculum(model, stages: list, lr=1e-4) -> list:
+    optimizer = AdamW(model.parameters(), lr=lr)
+    stages_stats = []
+    for i, (max_length, min_length, num_train_epochs) in enumerate(stages):
+        output_path = get_stage_output_path(max_length, num_train_epochs, i == len(stages) - 1)
+        stats_path = output_path / 'stage_stats.json'
+        if stats_path.exists():
+            logger.info(f'stage {i + 1} (max length {max_length}) already trained, loading {output_path}')
+            # The model is moved to the training device before the optimizer is built, so the loaded optimizer
+            # state is on the same device as the parameters (the Trainer keeps the optimizer as is)
+            device = get_train_args(output_path, lr, num_train_epochs).device
+            model = BertForMaskedLM.from_pretrained(str(output_path)).to(device)
+            optimizer = AdamW(model.parameters(), lr=lr)
+            optimizer.load_state_dict(torch.load(output_path / 'optimizer.pt', map_location=device))
+            with open(stats_path) as f:
+                stages_stats.append(json.load(f))
+            continue
+        batch_size, gradient_accumulation_steps = get_stage_batch_config(max_length)
+        logger.info(f'stage {i + 1}: max length {max_length}, batch size {batch_size}, '
+                    f'gradient accumulation steps {gradient_accumulation_steps}')
+        train_dataset = get_stage_train_data(max_length, min_length, batch_size)
+        print(train_dataset['train'])
+        length_series = get_sample_lengths(train_dataset['train'])
+        print(f'num samples: {len(length_series)}')
+        print(f'avg sample length: {length_series.mean(axis=0)}')
+        print(f'sample length stddev: {length_series.std(axis=0)}')
+
+        training_args = get_train_args(output_path, lr, num_train_epochs, batch_size, gradient_accumulation_steps)
+        trainer = Trainer(
+            model=model,
+            args=training_args,
+            data_collator=data_collator,
+            train_dataset=train_dataset['train'],
+            optimizers=(optimizer, None),
+        )
+        set_seed(42)
+        train_output = trainer.train()
+        trainer.save_model()
+        tokenizer.save_pretrained(training_args.output_dir)
+        torch.save(optimizer.state_dict(), output_path / 'optimizer.pt')
+
+        train_runtime = train_output.metrics['train_runtime']
+        num_tokens = int(length_series.sum()) * num_train_epochs
+        stage_stats = {'max_length': max_length, 'min_length': min_length, 'num_train_epochs': num_train_epochs,
+                       'batch_size': batch_size, 'gradient_accumulation_steps': gradient_accumulation_steps,
+                       'tokens_per_step': batch_size * gradient_accumulation_steps * max_length,
+                       'num_samples': len(length_series), 'num_tokens': num_tokens,
+                       'global_steps': train_output.global_step, 'train_runtime': train_runtime,
+                       'samples_per_second': train_output.metrics['train_samples_per_second'],
+                       'tokens_per_second': num_tokens / train_runtime if train_runtime > 0 else None}
+        with open(stats_path, 'w') as f:
+            json.dump(stage_stats, f, indent=2)
+        stages_stats.append(stage_stats)
+    return stages_stats
+
+
 # Setup logging
 logger = logging.getLogger(__name__)
 logging.basicConfig(
@@ -106,6 +301,25 @@ tokenizer_type = 'wordpiece_roots'
 vocab_size = 10000
 num_hidden_layers = 6
 bert_model_size_type = 'small' if num_hidden_layers == 6 else 'basic'
+# paths = [str(x) for x in Path("/dev/shm/amitse").glob("*.*")]
+# train_data_paths = ['data/raw/oscar/he_dedup.txt', 'data/raw/wikipedia/wikipedia.raw',
+#                     'data/raw/twitter/hebrew_tweets_text_clean_full.txt']
+train_data_paths = ['data/raw/oscar/he_dedup.txt']
+# Cleaned and deduplicated with corpus_clean.py
+# train_data_paths = ['data/clean/oscar/he_dedup.txt']
+# Read the training blocks from memory mapped pre-tokenized corpus shards (see pretrain_corpus) instead of
+# tokenizing with the datasets library
+use_corpus_shards = True
+corpus_root_path = Path('data/corpus')
+# Pack the tokenized lines into full length blocks instead of dropping the lines longer than max_length
+pack_sequences = True
+pack_doc_boundaries = False
+# Sequence length curriculum: (max_length, min_length, num_train_epochs) stages, most of the compute at the
+# short lengths. Every stage keeps the train step size of the first stage (48 x 5 samples of 64 pieces)
+curriculum_stages = [(64, 0, 5), (128, 64, 5), (512, 128, 5)]
+# curriculum_stages = [(64, 0, 5)]
+tokens_per_step = 48 * 5 * 64
+max_batch_tokens = 48 * 64
 
 # model_root_path = Path('experiments/transformers/bert') / bert_model_size_type / tokenizer_type
 # model_path = model_root_path / f'bert-{bert_model_size_type}-{tokenizer_type}-{data_source_name}-{vocab_size}-05-64'
@@ -114,25 +328,9 @@ tokenizer = get_tokenizer()
 model = get_model()
 
 data_collator = get_data_collator()
-train_dataset = get_train_data(64)
-# train_dataset = get_train_data(128, 64)
-# train_dataset = get_train_data(512, 128)
-print(train_dataset['train'])
-
-training_args = get_train_args()
-length_series = train_dataset['train'].data[1].to_pandas()
-print(f'num samples: {len(length_series)}')
-print(f'avg sample length: {length_series.mean(axis=0)}')
-print(f'sample length stddev: {length_series.std(axis=0)}')
-
-trainer = Trainer(
-    model=model,
-    args=training_args,
-    data_collator=data_collator,
-    train_dataset=train_dataset['train'],
-)
-
-set_seed(42)
-trainer.train()
-trainer.save_model()
-tokenizer.save_pretrained(training_args.output_dir)
+tokenized_dataset = None
+curriculum_stats = train_curriculum(model, curriculum_stages)
+for stage_stats in curriculum_stats:
+    print(f'stage max length {stage_stats["max_length"]}: {stage_stats["num_tokens"]} tokens in '
+          f'{stage_stats["train_runtime"]:.1f}s, {stage_stats["samples_per_second"]:.1f} samples/sec, '
+          f'{stage_stats["tokens_per_second"]:.1f} tokens/sec')
@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import queue
+import random
+import logging
+import threading
+from pathlib import Path
+import torch
+
+
+def _to_cpu(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def get_rng_states() -> dict:
+    states = {'python': random.getstate(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states: dict):
+    random.setstate(states['python'])
+    torch.set_rng_state(states['torch'])
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+
+# Write to a temporary file in the target folder and rename it, so that a crash while writing never leaves a
+# partial file behind the target path
+def _atomic_save(obj, file_path: Path):
+    tmp_file_path = file_path.with_name(f'.{file_path.name}.tmp')
+    with open(tmp_file_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file_path, file_path)
+
+
+def _atomic_save_json(obj, file_path: Path):
+    tmp_file_path = file_path.with_name(f'.{file_path.name}.tmp')
+    with open(tmp_file_path, 'w') as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp_file_path, file_path)
+
+
+def load_checkpoint(file_path) -> dict:
+    logging.info(f'Loading checkpoint from {file_path}')
+    return torch.load(file_path, map_location='cpu', weights_only=False)
+
+
+# Training checkpoints (checkpoint-{step}.pt) in a folder, written by a background thread
+# save() takes a CPU copy of the state (so training can modify the weights right away) and queues it for writing
+# Retention: the last keep_last checkpoints, plus the best scoring one (keep_best) - checkpoints get their (dev)
+# score with set_score, possibly later than they were saved (asynchronous evaluation). The steps, paths and scores
+# are kept in checkpoints.json in the same folder
+class CheckpointManager:
+
+    def __init__(self, dir_path, keep_last=3, keep_best=True):
+        self.dir_path = Path(dir_path)
+        self.dir_path.mkdir(parents=True, exist_ok=True)
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.index_path = self.dir_path / 'checkpoints.json'
+        self.checkpoints = {}
+        if self.index_path.exists():
+            with open(self.index_path) as f:
+                self.checkpoints = {int(step): entry for step, entry in json.load(f).items()
+                                    if entry['path'] is not None}
+        self.lock = threading.Lock()
+        self.states = queue.Queue()
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def _write_loop(self):
+        while True:
+            item = self.states.get()
+            if item is None:
+                self.states.task_done()
+                break
+            step, state = item
+            file_path = self.dir_path / f'checkpoint-{step}.pt'
+            start_time = time.perf_counter()
+            try:
+                _atomic_save(state, file_path)
+                logging.info(f'Saved checkpoint {file_path} in {time.perf_counter() - start_time:.2f}s')
+                with self.lock:
+                    self.checkpoints[step]['path'] = file_path.name
+                    self._prune()
+            except Exception as e:
+                logging.error(f'Failed saving checkpoint {file_path}: {e}')
+            self.states.task_done()
+
+    def save(self, state: dict, step):
+        with self.lock:
+            self.checkpoints.setdefault(step, {'path': None, 'score': None})
+        self.states.put((step, _to_cpu(state)))
+
+    # Scores of checkpoints that were already removed are ignored
+    def set_score(self, step, score):
+        with self.lock:
+            if step not in self.checkpoints:
+                return
+            self.checkpoints[step]['score'] = score
+            self._prune()
+
+    def best_step(self):
+        scored = [step for step, entry in self.checkpoints.items()
+                  if entry['score'] is not None and entry['path'] is not None]
+        if not scored:
+            return None
+        return max(scored, key=lambda step: self.checkpoints[step]['score'])
+
+    # Latest checkpoint in a checkpoints folder, without starting a manager (and its writer thread)
+    @staticmethod
+    def read_latest_path(dir_path) -> Path:
+        index_path = Path(dir_path) / 'checkpoints.json'
+        if not index_path.exists():
+            return None
+        with open(index_path) as f:
+            saved = {int(step): entry['path'] for step, entry in json.load(f).items() if entry['path'] is not None}
+        if not saved:
+            return None
+        return Path(dir_path) / saved[max(saved)]
+
+    def latest_path(self) -> Path:
+        saved = [step for step, entry in self.checkpoints.items() if entry['path'] is not None]
+        if not saved:
+            return None
+        return self.dir_path / self.checkpoints[max(saved)]['path']
+
+    def _prune(self):
+        saved = sorted(step for step, entry in self.checkpoints.items() if entry['path'] is not None)
+        keep = set(saved[-self.keep_last:]) if self.keep_last > 0 else set()
+        best_step = self.best_step()
+        if self.keep_best and best_step is not None:
+            keep.add(best_step)
+        for step in saved:
+            if step in keep:
+                continue
+            file_path = self.dir_path / self.checkpoints[step]['path']
+            if file_path.exists():
+                file_path.unlink()
+            logging.info(f'Removed checkpoint {file_path}')
+            del self.checkpoints[step]
+        _atomic_save_json({str(step): entry for step, entry in sorted(self.checkpoints.items())}, self.index_path)
+
+    # Wait for the queued checkpoints to be written
+    def wait(self):
+        self.states.join()
+
+    def close(self):
+        self.states.put(None)
+        self.writer.join()
@@ -0,0 +1,257 @@
+import re
+import sys
+import json
+import time
+import hashlib
+import logging
+import unicodedata
+import collections
+import multiprocessing as mp
+from pathlib import Path
+import numpy as np
+from hebrew_root_tokenizer import suf_replace
+
+# Pretraining text preparation: streams the raw text files through num_workers processes that normalize and
+# filter the lines (length and charset) and compute their exact and MinHash dedup keys, and writes the lines that
+# are neither exact nor near duplicates of an earlier line (in input order) to a single output file
+# Memory is bounded: a fixed number of line chunks are in flight, and the dedup keys of the lines seen so far are
+# kept in Bloom filters sized for expected_lines lines (a line is dropped as a duplicate by a false positive with
+# probability false_positive_rate). Blank lines (document boundaries) are kept, collapsed to one
+# Near duplicates: MinHash signatures (num_perm hashes) over the word shingles of the line, split into
+# num_bands LSH bands - a line is dropped if one of its bands matches a band of an earlier line (lines with
+# Jaccard similarity above ~(1 / num_bands) ^ (num_perm / num_bands) are caught with high probability)
+# Usage: python corpus_clean.py out_path text_path [text_path ...]
+
+num_workers = 8
+lines_per_chunk = 10000
+max_pending_chunks = 2 * num_workers
+min_words = 2
+max_words = 5000
+min_hebrew_ratio = 0.5
+max_other_char_ratio = 0.1
+map_final_letters = False
+strip_niqqud = True
+shingle_size = 3
+num_perm = 64
+num_bands = 8
+expected_lines = 20000000
+false_positive_rate = 1e-4
+seed = 1
+
+_control_chars = re.compile(r'[\u0000-\u0008\u000b-\u001f\u007f-\u009f\u200b-\u200f\u202a-\u202e\ufeff]')
+# Hebrew points and cantillation marks, keeping the maqaf, paseq, sof pasuq and nun hafukha punctuation
+_niqqud = re.compile(r'[\u0591-\u05bd\u05bf\u05c1\u05c2\u05c4\u05c5\u05c7]')
+_non_word_chars = re.compile(r'[^\w\s]')
+_hebrew_letters = re.compile(r'[\u05d0-\u05ea]')
+_common_chars = re.compile(r'[\u05d0-\u05ea\u05be\u05f3\u05f4a-zA-Z0-9\s.,:;!?\'"()\[\]\-%/&@#*+=_]')
+_mersenne_prime = (1 << 61) - 1
+_max_hash = (1 << 32) - 1
+filter_names = ['short', 'long', 'charset', 'exact_duplicate', 'near_duplicate']
+
+
+def normalize_line(line: str) -> str:
+    line = unicodedata.normalize('NFC', line)
+    line = _control_chars.sub(' ', line)
+    if strip_niqqud:
+        line = _niqqud.sub('', line)
+    line = ' '.join(line.split())
+    if map_final_letters:
+        line = ''.join(suf_replace.get(c, c) for c in line)
+    return line
+
+
+# Dedup key: final letters mapped (as in whitespace_tokenize), lower cased, without punctuation
+def _dedup_words(line: str) -> list:
+    line = ''.join(suf_replace.get(c, c) for c in line.lower())
+    return _non_word_chars.sub(' ', line).split()
+
+
+def _filter_line(line: str, num_words) -> str:
+    if num_words < min_words:
+        return 'short'
+    if num_words > max_words:
+        return 'long'
+    letters = sum(1 for c in line if c.isalpha())
+    if letters == 0 or len(_hebrew_letters.findall(line)) / letters < min_hebrew_ratio:
+        return 'charset'
+    if len(line) - len(_common_chars.findall(line)) > max_other_char_ratio * len(line):
+        return 'charset'
+    return None
+
+
+def _hash64(s: str) -> int:
+    return int.from_bytes(hashlib.blake2b(s.encode('utf8'), digest_size=8).digest(), 'little')
+
+
+def _permutations() -> (np.array, np.array):
+    rnd = np.random.RandomState(seed)
+    a = rnd.randint(1, _mersenne_prime, size=num_perm, dtype=np.uint64)
+    b = rnd.randint(0, _mersenne_prime, size=num_perm, dtype=np.uint64)
+    return a, b
+
+
+# MinHash signature of the word shingles, reduced to one 64 bit key per LSH band
+def _band_keys(words: list, perms) -> np.array:
+    shingles = {' '.join(words[i:i + shingle_size]) for i in range(max(len(words) - shingle_size + 1, 1))}
+    shingle_hashes = np.array([_hash64(s) & _max_hash for s in shingles], dtype=np.uint64)
+    a, b = perms
+    with np.errstate(over='ignore'):
+        hashes = ((np.outer(shingle_hashes, a) + b) % np.uint64(_mersenne_prime)) & np.uint64(_max_hash)
+    signature = hashes.min(axis=0)
+    rows = num_perm // num_bands
+    return np.array([_hash64(f'{band}:{signature[band * rows:(band + 1) * rows].tobytes().hex()}')
+                     for band in range(num_bands)], dtype=np.uint64)
+
+
+# Normalizes and filters a chunk of lines. Returns the lines to keep (None for blank lines), their exact and
+# band keys, and the number of lines removed by each filter
+def _process_chunk(lines: list) -> (list, np.array, np.array, dict):
+    perms = _permutations()
+    out_lines, exact_keys, band_keys = [], [], []
+    filtered = collections.Counter()
+    for line in lines:
+        line = normalize_line(line)
+        if not line:
+            out_lines.append(None)
+            continue
+        reason = _filter_line(line, len(line.split()))
+        if reason is not None:
+            filtered[reason] += 1
+            continue
+        words = _dedup_words(line)
+        out_lines.append(line)
+        exact_keys.append(_hash64(' '.join(words)))
+        band_keys.append(_band_keys(words, perms))
+    exact_keys = np.array(exact_keys, dtype=np.uint64)
+    band_keys = np.stack(band_keys) if band_keys else np.zeros((0, num_bands), dtype=np.uint64)
+    return out_lines, exact_keys, band_keys, filtered
+
+
+class BloomFilter:
+
+    def __init__(self, capacity, error_rate):
+        self.num_bits = max(int(-capacity * np.log(error_rate) / np.log(2) ** 2), 64)
+        self.num_hashes = max(int(round(self.num_bits / capacity * np.log(2))), 1)
+        self.bits = np.zeros((self.num_bits + 7) // 8, dtype=np.uint8)
+
+    def _positions(self, keys: np.array) -> np.array:
+        h1 = keys & np.uint64(0xffffffff)
+        h2 = (keys >> np.uint64(32)) | np.uint64(1)
+        i = np.arange(self.num_hashes, dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            return (h1[:, None] + i[None, :] * h2[:, None]) % np.uint64(self.num_bits)
+
+    def contains(self, keys: np.array) -> np.array:
+        positions = self._positions(keys)
+        bits = (self.bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+        return bits.all(axis=1)
+
+    def add(self, keys: np.array):
+        positions = self._positions(keys)
+        np.bitwise_or.at(self.bits, positions >> np.uint64(3),
+                         np.left_shift(1, (positions & np.uint64(7)).astype(np.uint8)).astype(np.uint8))
+
+    @property
+    def size_mb(self):
+        return self.bits.nbytes / (1 << 20)
+
+
+def _seen(bloom: BloomFilter, keys: np.array) -> np.array:
+    if len(keys) == 0:
+        return np.zeros(0, dtype=bool)
+    _, first_idxs = np.unique(keys, return_index=True)
+    seen = np.ones(len(keys), dtype=bool)
+    seen[first_idxs] = False
+    return seen | bloom.contains(keys)
+
+
+def _read_line_chunks(text_paths: list):
+    lines = []
+    for text_path in text_paths:
+        with open(text_path, encoding='utf8', errors='replace') as f:
+            for line in f:
+                lines.append(line)
+                if len(lines) == lines_per_chunk:
+                    yield lines
+                    lines = []
+    if lines:
+        yield lines
+
+
+def clean_corpus(text_paths: list, out_path) -> dict:
+    out_path = Path(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    exact_bloom = BloomFilter(expected_lines, false_positive_rate)
+    band_bloom = BloomFilter(expected_lines * num_bands, false_positive_rate / num_bands)
+    logging.info(f'Dedup Bloom filters: {exact_bloom.size_mb + band_bloom.size_mb:.1f}MB')
+    stats = collections.Counter()
+    start_time = time.perf_counter()
+    prev_blank = True
+    ctx = mp.get_context('fork')
+    tmp_path = out_path.with_name(f'.{out_path.name}.tmp')
+    with ctx.Pool(num_workers) as pool, open(tmp_path, 'w', encoding='utf8') as out_f:
+        pending = collections.deque()
+        chunks = _read_line_chunks(text_paths)
+        num_chunks = 0
+        while True:
+            for lines in chunks:
+                stats['input_lines'] += len(lines)
+                pending.append(pool.apply_async(_process_chunk, (lines,)))
+                if len(pending) >= max_pending_chunks:
+                    break
+            if not pending:
+                break
+            out_lines, exact_keys, band_keys, filtered = pending.popleft().get()
+            stats.update(filtered)
+            exact_dups = _seen(exact_bloom, exact_keys)
+            near_dups = np.zeros(len(band_keys), dtype=bool)
+            if len(band_keys) > 0:
+                band_ids = np.arange(num_bands, dtype=np.uint64) * np.uint64(0x9e3779b97f4a7c15)
+                with np.errstate(over='ignore'):
+                    keyed_bands = band_keys ^ band_ids[None, :]
+                near_dups = _seen(band_bloom, keyed_bands.reshape(-1)).reshape(-1, num_bands).any(axis=1)
+                near_dups &= ~exact_dups
+                keep = ~exact_dups & ~near_dups
+                exact_bloom.add(exact_keys[keep])
+                band_bloom.add(keyed_bands[keep].reshape(-1))
+            stats['exact_duplicate'] += int(exact_dups.sum())
+            stats['near_duplicate'] += int(near_dups.sum())
+            i = 0
+            for line in out_lines:
+                if line is None:
+                    if not prev_blank:
+                        out_f.write('\n')
+                        prev_blank = True
+                    continue
+                if not exact_dups[i] and not near_dups[i]:
+                    out_f.write(line)
+                    out_f.write('\n')
+                    stats['output_lines'] += 1
+                    stats['output_chars'] += len(line)
+                    prev_blank = False
+                i += 1
+            num_chunks += 1
+            if num_chunks % 100 == 0:
+                logging.info(f'Processed {stats["input_lines"]} lines, kept {stats["output_lines"]}')
+    tmp_path.rename(out_path)
+    stats = dict(stats)
+    stats['seconds'] = time.perf_counter() - start_time
+    with open(out_path.with_name(f'{out_path.name}.stats.json'), 'w') as f:
+        json.dump(stats, f, indent=2)
+    print_stats(stats)
+    return stats
+
+
+def print_stats(stats: dict):
+    input_lines = stats.get('input_lines', 0)
+    print(f'input lines: {input_lines}')
+    for name in filter_names:
+        removed = stats.get(name, 0)
+        print(f'{name}: {removed} lines removed ({removed / input_lines if input_lines else 0.0:.4f})')
+    print(f'output lines: {stats.get("output_lines", 0)}, {stats.get("output_chars", 0)} chars')
+    print(f'{input_lines / stats["seconds"]:.1f} lines/sec')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    clean_corpus(sys.argv[2:], sys.argv[1])
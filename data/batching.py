@@ -0,0 +1,196 @@
+import queue
+import random
+import threading
+import time
+import torch
+from torch.utils.data import Sampler, TensorDataset
+from torch.utils.data.dataloader import default_collate
+
+
+# Sentence lengths used for bucketing: number of xtokens (subwords incl. [CLS]/[SEP]) and number of tokens
+# The xtoken tensor is [sent, xtoken, (token_idx, xtoken_id)] with token_idx -1 for padding, and the token char
+# tensor is [sent, token, char, (token_idx, char_id)] with char_id 0 for padding
+def get_sample_lengths(dataset: TensorDataset) -> (torch.Tensor, torch.Tensor):
+    xtokens, token_chars = dataset.tensors[0], dataset.tensors[1]
+    xtoken_lengths = torch.sum(torch.ne(xtokens[:, :, 0], -1), dim=1)
+    token_lengths = torch.sum(torch.gt(token_chars[:, :, 0, 1], 0), dim=1)
+    return xtoken_lengths, token_lengths
+
+
+# Groups sentences of similar length (subword count, then token count) into batches
+# Training: the samples are shuffled, split into buckets of bucket_size batches, sorted by length within each
+# bucket and batched, and the batch order is shuffled
+# Evaluation (shuffle=False): the samples are sorted by length and batched in order
+# Data parallel training (num_replicas > 1): every process builds the same batch order (the seed must be the same
+# on all the processes) and iterates its own rank's share of it. The batch list is padded by wrapping around so
+# that all the processes take the same number of steps
+# state_dict/load_state_dict save and restore the position in the batch order for resuming training
+class BucketBatchSampler(Sampler):
+
+    def __init__(self, dataset: TensorDataset, batch_size, shuffle=False, bucket_size=100, seed=None, num_replicas=1,
+                 rank=0):
+        xtoken_lengths, token_lengths = get_sample_lengths(dataset)
+        self.lengths = list(zip(xtoken_lengths.tolist(), token_lengths.tolist()))
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.rnd = random.Random(seed)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.iter_rnd_state = self.rnd.getstate()
+        self.skip_batches = 0
+
+    def __len__(self):
+        num_batches = (len(self.lengths) + self.batch_size - 1) // self.batch_size
+        return (num_batches + self.num_replicas - 1) // self.num_replicas
+
+    def _batches(self, idxs: list) -> list:
+        idxs = sorted(idxs, key=lambda i: self.lengths[i])
+        return [idxs[i:i + self.batch_size] for i in range(0, len(idxs), self.batch_size)]
+
+    def _shard(self, batches: list) -> list:
+        if self.num_replicas == 1:
+            return batches
+        batches = (batches * self.num_replicas)[:len(self) * self.num_replicas]
+        return batches[self.rank::self.num_replicas]
+
+    def _epoch_batches(self) -> list:
+        idxs = list(range(len(self.lengths)))
+        if not self.shuffle:
+            return self._shard(self._batches(idxs))
+        self.rnd.shuffle(idxs)
+        bucket_len = self.batch_size * self.bucket_size
+        batches = []
+        for i in range(0, len(idxs), bucket_len):
+            batches.extend(self._batches(idxs[i:i + bucket_len]))
+        self.rnd.shuffle(batches)
+        return self._shard(batches)
+
+    def __iter__(self):
+        self.iter_rnd_state = self.rnd.getstate()
+        batches = self._epoch_batches()[self.skip_batches:]
+        self.skip_batches = 0
+        return iter(batches)
+
+    # Position after num_batches batches of the current iteration: the next iteration replays the current batch
+    # order from batch num_batches on (or starts a new order if the current one is done)
+    def state_dict(self, num_batches) -> dict:
+        if num_batches >= len(self):
+            return {'rnd_state': self.rnd.getstate(), 'num_batches': 0}
+        return {'rnd_state': self.iter_rnd_state, 'num_batches': num_batches}
+
+    def load_state_dict(self, state: dict):
+        self.rnd.setstate(state['rnd_state'])
+        self.skip_batches = state['num_batches']
+
+
+# Stacks the (xtoken, token char, form char, label) samples and trims the batch to its own maximum number of
+# xtokens, tokens and token chars (and form chars and morphemes if trim_targets is set) instead of the dataset
+# wide padding. The target widths (form chars, morphemes) also bound the decoder, so they are only trimmed when
+# the targets are available to the model (training)
+class TrimCollator:
+
+    def __init__(self, trim_targets=True):
+        self.trim_targets = trim_targets
+
+    def __call__(self, samples):
+        xtokens, token_chars, form_chars, labels = default_collate(samples)
+        max_xtoken_len = int(torch.max(torch.sum(torch.ne(xtokens[:, :, 0], -1), dim=1)))
+        max_num_tokens = int(torch.max(torch.sum(torch.gt(token_chars[:, :, 0, 1], 0), dim=1)))
+        max_token_len = int(torch.max(torch.sum(torch.gt(token_chars[:, :, :, 1], 0), dim=2)))
+        xtokens = xtokens[:, :max_xtoken_len]
+        token_chars = token_chars[:, :max_num_tokens, :max_token_len]
+        form_chars = form_chars[:, :max_num_tokens]
+        labels = labels[:, :max_num_tokens]
+        if self.trim_targets:
+            max_form_len = int(torch.max(torch.sum(torch.gt(form_chars[:, :, :, -1], 0), dim=2)))
+            max_num_morphemes = int(torch.max(torch.sum(torch.any(torch.ne(labels[:, :, :, 2:], 0), dim=3), dim=2)))
+            form_chars = form_chars[:, :, :max_form_len]
+            labels = labels[:, :, :max(max_num_morphemes, 1)]
+        return xtokens, token_chars, form_chars, labels
+
+
+# Trims the batch (see TrimCollator) and precomputes everything the training loop derives from the raw sample
+# tensors, so that it runs in the DataLoader workers instead of between model steps:
+# xtokens:     [sent, xtoken, (token_idx, xtoken_id)]
+# token_chars: [sent, token, char] input token char ids
+# form_chars:  [sent, token, form char] target form char ids
+# labels:      [sent, token, morpheme, label] target label ids
+# token_mask:  [sent, token] real (non padding) tokens
+# num_tokens:  [sent] number of tokens in each sentence
+# sent_ids:    [sent] sentence ids
+class MorphBatchCollator(TrimCollator):
+
+    def __call__(self, samples) -> dict:
+        xtokens, token_chars, form_chars, labels = super(MorphBatchCollator, self).__call__(samples)
+        token_mask = torch.gt(token_chars[:, :, 0, 1], 0)
+        return {'xtokens': xtokens,
+                'token_chars': token_chars[:, :, :, -1].contiguous(),
+                'form_chars': form_chars[:, :, :, -1].contiguous(),
+                'labels': labels[:, :, :, 2:].contiguous(),
+                'token_mask': token_mask,
+                'num_tokens': torch.sum(token_mask, dim=1),
+                'sent_ids': form_chars[:, 0, 0, 0].clone()}
+
+
+def batch_to(batch: dict, device, non_blocking=False) -> dict:
+    return {k: t.to(device, non_blocking=non_blocking) for k, t in batch.items()}
+
+
+# Iterates a DataLoader in a background thread, moving the batches to the device and keeping up to queue_size of
+# them ready in a bounded queue, so that batch loading, collation and host to device copies overlap with the model
+# compute of the current step
+# wait_times holds, for each step of the last iteration, the time (seconds) spent blocked waiting for the batch -
+# steps that consistently wait mean training is input bound
+class BatchPrefetcher:
+
+    def __init__(self, data, device=None, queue_size=2):
+        self.data = data
+        self.device = device
+        self.queue_size = queue_size
+        self.wait_times = []
+
+    def __len__(self):
+        return len(self.data)
+
+    @staticmethod
+    def _put(batches: queue.Queue, stop: threading.Event, item) -> bool:
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, batches: queue.Queue, stop: threading.Event):
+        try:
+            for batch in self.data:
+                if self.device is not None:
+                    batch = batch_to(batch, self.device, non_blocking=True)
+                if not self._put(batches, stop, batch):
+                    return
+        except Exception as e:
+            self._put(batches, stop, e)
+            return
+        self._put(batches, stop, None)
+
+    def __iter__(self):
+        self.wait_times = []
+        batches = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(batches, stop), daemon=True)
+        producer.start()
+        try:
+            while True:
+                start_time = time.perf_counter()
+                batch = batches.get()
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                self.wait_times.append(time.perf_counter() - start_time)
+                yield batch
+        finally:
+            stop.set()
+            producer.join()
@@ -4,6 +4,7 @@ import numpy as np
 from tqdm import tqdm
 import logging
 import fasttext_emb as ft
+from bclm import treebank as tb
 from pathlib import Path
 
 
@@ -16,7 +17,8 @@ def _insert_morph_id_column(df: pd.DataFrame) -> pd.DataFrame:
 
 
 def _get_morph_df(raw_lattice_df: pd.DataFrame) -> pd.DataFrame:
-    morph_df = raw_lattice_df[['sent_id', 'token_id', 'token', 'form', 'lemma', 'tag', 'feats']]
+    morph_df = raw_lattice_df[['sent_id', 'token_id', 'token', 'form', 'lemma', 'tag', 'feats'] +
+                              [tb.feat_column(fname) for fname in tb.feat_names(raw_lattice_df)]]
     morph_df = _insert_morph_id_column(morph_df)
     return morph_df
 
@@ -117,19 +119,24 @@ def _collate_token_chars(token_char_df: pd.DataFrame, char2id: dict, pad) -> pd.
 
 def save_char_vocab(data_path: Path, ft_root_path: Path, raw_partition: dict, pad, sep, sos, eos):
     logging.info(f'saving char embedding')
-    tokens = set(token for part in raw_partition for token in raw_partition[part].token)
-    forms = set(token for part in raw_partition for token in raw_partition[part].form)
-    lemmas = set(token for part in raw_partition for token in raw_partition[part].lemma)
+    tokens = tb.unique_values(raw_partition, 'token')
+    forms = tb.unique_values(raw_partition, 'form')
+    lemmas = tb.unique_values(raw_partition, 'lemma')
     # chars = set(c.lower() for word in list(tokens) + list(forms) + list(lemmas) for c in word)
     chars = set(c for word in list(tokens) + list(forms) + list(lemmas) for c in word)
     chars = [pad, sep, sos, eos] + sorted(list(chars))
     char_vectors, char2id = ft.get_word_vectors('he', ft_root_path / 'models/cc.he.300.bin', chars)
-    ft.save_word_vectors(data_path / 'ft_char.vec.txt', char_vectors, char2id)
+    ft.save_vector_store(data_path / 'ft_char', char_vectors, chars)
 
 
+# The char vectors of preprocessed data saved in the text format (ft_char.vec.txt) are converted to the vector
+# store once
 def load_char_vocab(data_path: Path) -> (np.array, dict):
     logging.info(f'Loading char embedding')
-    char_vectors, char2id = ft.load_word_vectors(data_path / 'ft_char.vec.txt')
+    store_path = data_path / 'ft_char'
+    if not ft.vector_store_exists(store_path):
+        ft.compile_vec_file(data_path / 'ft_char.vec.txt', store_path)
+    char_vectors, char2id = ft.load_vector_store(store_path)
     id2char = {char2id[c]: c for c in char2id}
     char_vocab = {'char2id': char2id, 'id2char': id2char}
     return char_vectors, char_vocab
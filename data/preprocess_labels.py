@@ -6,8 +6,7 @@ from .preprocess_base import *
 def _collate_labels(morph_df: pd.DataFrame, labels2id: dict, pad, eos):
     sent_groups = morph_df.groupby([morph_df.sent_id])
     num_sentences = len(sent_groups)
-    token_groups = sorted(morph_df.groupby([morph_df.sent_id, morph_df.token_id]))
-    max_num_morphemes = max([len(token_df) for _, token_df in token_groups])
+    max_num_morphemes = int(morph_df.groupby([morph_df.sent_id, morph_df.token_id]).size().max())
     if eos is not None:
         max_num_morphemes += 1
     data_sent_indices, data_token_indices, data_tokens, data_morph_indices = [], [], [], []
@@ -15,6 +14,13 @@ def _collate_labels(morph_df: pd.DataFrame, labels2id: dict, pad, eos):
     data_labels = {l: [] for l in labels2id}
     data_label_ids = {l: [] for l in labels2id}
     feat_names = labels2id.keys()
+    morph_df = morph_df.copy()
+    label_columns = {}
+    for feat_name, values in tb.get_feat_values(morph_df, [l for l in feat_names if l != 'tag']).items():
+        label_columns[feat_name] = f'label_{feat_name}'
+        morph_df[label_columns[feat_name]] = values
+    label_columns['tag'] = 'tag'
+    token_groups = sorted(morph_df.groupby([morph_df.sent_id, morph_df.token_id]))
     cur_sent_id = None
     tq = tqdm(total=num_sentences, desc="Sentence")
     for (sent_id, token_id), token_df in token_groups:
@@ -27,18 +33,7 @@ def _collate_labels(morph_df: pd.DataFrame, labels2id: dict, pad, eos):
         tokens = list(token_df.token)
         morph_index = list(token_df.morph_id)
         forms = list(token_df.form)
-        labels = {feat_name: [] for feat_name in feat_names}
-        for morph_feats in token_df.feats:
-            feats = {feat_name: '_' for feat_name in feat_names}
-            if morph_feats != '_':
-                morph_feats = morph_feats.split('|')
-                for f in morph_feats:
-                    [feat_name, feat_value] = f.split('=')
-                    feats[feat_name] = feat_value
-            for feat_name in feats:
-                labels[feat_name].append(feats[feat_name])
-        labels['tag'] = list(token_df.tag)
-        labels = {l: labels[l] for l in labels2id}
+        labels = {l: list(token_df[label_columns[l]]) for l in labels2id}
         label_ids = {l: [labels2id[l][v] for v in labels[l]] for l in labels}
         if eos is not None:
             sent_index.append(sent_index[-1])
@@ -88,12 +83,9 @@ def load_label_vocab(data_path: Path, partition: iter, pad, sos=None, eos=None)
         morph_file = data_path / f'{part}_morph.csv'
         morph_data = pd.read_csv(str(morph_file), index_col=0)
         tags |= set(morph_data.tag)
-        for morph_feats in morph_data.feats:
-            morph_feats = morph_feats.split('|')
-            for f in morph_feats:
-                if f != '_':
-                    [feat_name, feat_value] = f.split('=')
-                    feats[feat_name].add(feat_value)
+        feat_df = morph_data if tb.feat_names(morph_data) else tb.parse_feats(morph_data.feats)
+        for feat_name in tb.feat_names(feat_df):
+            feats[feat_name] |= set(feat_df[tb.feat_column(feat_name)].astype(str).unique()) - {'_'}
     # tags.add('_')
     for f in feats:
         if f != 'biose_layer0':
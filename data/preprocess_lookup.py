@@ -0,0 +1,61 @@
+from collections import Counter, defaultdict
+
+from .preprocess_base import *
+
+
+# Collect, for every token string in the lattice, the counts of its segmentations (tuple of forms) and the
+# per morpheme label counts of each segmentation
+def _count_token_segments(lattice_df: pd.DataFrame, label_names: list) -> (dict, dict):
+    token_seg_counts = defaultdict(Counter)
+    seg_label_counts = defaultdict(lambda: defaultdict(lambda: defaultdict(Counter)))
+    lattice_df = lattice_df.copy()
+    for l, values in tb.get_feat_values(lattice_df, [l for l in label_names if l != 'tag']).items():
+        lattice_df[f'label_{l}'] = values
+    label_columns = ['tag' if l == 'tag' else f'label_{l}' for l in label_names]
+    token_groups = lattice_df.groupby([lattice_df.sent_id, lattice_df.token_id])
+    tq = tqdm(total=len(token_groups), desc="Token")
+    for _, token_df in token_groups:
+        token = token_df.token.iloc[0]
+        forms = tuple(token_df.form)
+        token_seg_counts[token][forms] += 1
+        for i, labels in enumerate(zip(*[token_df[c] for c in label_columns])):
+            for l, label in zip(label_names, labels):
+                seg_label_counts[(token, forms)][l][i][label] += 1
+        tq.update(1)
+    tq.close()
+    return token_seg_counts, seg_label_counts
+
+
+# Build the known token segmentation index: token char ids -> (form char ids, label distributions)
+# A token is indexed only if it was seen at least min_count times and its most frequent segmentation covers
+# at least min_ratio of its occurrences (min_ratio=1.0 keeps only unambiguous tokens)
+# The form char ids follow the form char data samples layout: forms separated by sep and terminated by eos
+# The label distributions are a list (per label name) of per morpheme {label_id: probability} dicts
+def build_segment_lookup(lattice_df: pd.DataFrame, char2id: dict, labels2id: dict, label_names: list, sep, eos,
+                         min_count=5, min_ratio=1.0) -> dict:
+    logging.info(f'Building segment lookup (min_count={min_count}, min_ratio={min_ratio})')
+    token_seg_counts, seg_label_counts = _count_token_segments(lattice_df, label_names)
+    lookup = {}
+    for token, seg_counts in token_seg_counts.items():
+        token_count = sum(seg_counts.values())
+        forms, forms_count = seg_counts.most_common(1)[0]
+        if token_count < min_count or forms_count / token_count < min_ratio:
+            continue
+        if any(not isinstance(form, str) for form in forms):
+            continue
+        if any(c not in char2id for c in token) or any(c not in char2id for form in forms for c in form):
+            continue
+        form_chars = [char2id[c] for form in forms for c in list(form) + [sep]]
+        form_chars[-1] = char2id[eos]
+        label_dists = []
+        for l in label_names:
+            morph_dists = []
+            for i in range(len(forms)):
+                label_counts = seg_label_counts[(token, forms)][l][i]
+                label_dist = {labels2id[l][v]: c / forms_count for v, c in label_counts.items() if v in labels2id[l]}
+                morph_dists.append(label_dist)
+            label_dists.append(morph_dists)
+        token_chars = tuple(char2id[c] for c in token)
+        lookup[token_chars] = (form_chars, label_dists)
+    logging.info(f'Segment lookup: {len(lookup)} indexed tokens out of {len(token_seg_counts)}')
+    return lookup
@@ -0,0 +1,166 @@
+import os
+import sys
+import time
+import random
+import socket
+import torch
+import torch.nn as nn
+import torch.optim as optim
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, TensorDataset
+from transformers import BertConfig, BertModel
+from data.batching import BucketBatchSampler, MorphBatchCollator
+from morph_model import BertTokenEmbeddingModel, SegmentDecoder, MorphPipelineModel
+import dist_utils
+
+# Data parallel training throughput scaling benchmark: trains a small morph-pipeline model on random sentences with
+# 1, 2, 4, ... processes (gloo, CPU) and reports the train sentences/sec for each number of processes
+# Every process trains on sents_per_process sentences (the data grows with the number of processes), so every
+# process runs the same number of timed steps after the warmup steps
+# Usage: python dist_train_benchmark.py [max_processes] [sents_per_process] [threads_per_process]
+
+pad, sos, eos, sep = 0, 1, 2, 3
+num_chars = 30
+num_xtokens = 200
+num_labels = 10
+max_num_tokens = 20
+max_token_len = 12
+max_form_len = 18
+max_num_morphemes = 4
+batch_size = 8
+warmup_steps = 2
+
+
+class _PadTokenizer:
+    pad_token_id = 0
+
+
+# Random sentences in the morph_train data samples layout:
+# xtokens [sent, xtoken, (token_idx, xtoken_id)], token chars [sent, token, char, (token_idx, char_id)],
+# form chars [sent, token, char, (sent_idx, token_idx, char_id)], labels [sent, token, morpheme, (sent_idx,
+# token_idx, label_id)]
+def _random_dataset(num_sentences, seed=0) -> TensorDataset:
+    rnd = random.Random(seed)
+    xtokens = torch.full((num_sentences, max_num_tokens * 2 + 2, 2), -1, dtype=torch.long)
+    xtokens[:, :, 1] = 0
+    token_chars = torch.zeros((num_sentences, max_num_tokens, max_token_len, 2), dtype=torch.long)
+    form_chars = torch.zeros((num_sentences, max_num_tokens, max_form_len, 3), dtype=torch.long)
+    labels = torch.zeros((num_sentences, max_num_tokens, max_num_morphemes, 3), dtype=torch.long)
+    for i in range(num_sentences):
+        num_tokens = rnd.randint(5, max_num_tokens)
+        xtoken_ids = [(0, 1)]
+        for j in range(num_tokens):
+            morphemes = [[rnd.randint(4, num_chars - 1) for _ in range(rnd.randint(1, 3))]
+                         for _ in range(rnd.randint(1, 3))]
+            chars = [c for m in morphemes for c in m][:max_token_len]
+            forms = [c for m in morphemes for c in m + [sep]][:-1] + [eos]
+            token_chars[i, j, :, 0] = j + 1
+            token_chars[i, j, :len(chars), 1] = torch.tensor(chars)
+            form_chars[i, j, :, 0] = i
+            form_chars[i, j, :, 1] = j + 1
+            form_chars[i, j, :len(forms), 2] = torch.tensor(forms)
+            labels[i, j, :, 0] = i
+            labels[i, j, :, 1] = j + 1
+            labels[i, j, :len(morphemes), 2] = torch.tensor([rnd.randint(1, num_labels - 1) for _ in morphemes])
+            xtoken_ids.extend((j + 1, rnd.randint(3, num_xtokens - 1)) for _ in range(rnd.randint(1, 2)))
+        xtoken_ids.append((num_tokens + 1, 2))
+        xtokens[i, :len(xtoken_ids)] = torch.tensor(xtoken_ids)
+    return TensorDataset(xtokens, token_chars, form_chars, labels)
+
+
+def _create_model() -> MorphPipelineModel:
+    bert_config = BertConfig(vocab_size=num_xtokens, hidden_size=128, num_hidden_layers=2, num_attention_heads=2,
+                             intermediate_size=256)
+    bert = BertModel(bert_config)
+    for param in bert.parameters():
+        param.requires_grad = False
+    xtoken_emb = BertTokenEmbeddingModel(bert, _PadTokenizer())
+    char_emb = nn.Embedding(num_chars, 50, padding_idx=pad)
+    hidden_size = bert_config.hidden_size // 2
+    segmentor = SegmentDecoder(char_emb, hidden_size, 2, 0.1, 0.5, num_chars)
+    labels_configs = [{'id2label': {i: str(i) for i in range(num_labels)}}]
+    return MorphPipelineModel(xtoken_emb, segmentor, hidden_size, 2, 0.1, 0.5, labels_configs, fused_labels=True)
+
+
+def _train_worker(rank, world_size, port, num_sentences, threads_per_process, results):
+    os.environ.update({'MASTER_ADDR': '127.0.0.1', 'MASTER_PORT': str(port), 'RANK': str(rank),
+                       'WORLD_SIZE': str(world_size)})
+    dist_utils.init_distributed('gloo', threads_per_process)
+    torch.manual_seed(0)
+    dataset = _random_dataset(num_sentences)
+    sampler = BucketBatchSampler(dataset, batch_size, shuffle=True, seed=0, num_replicas=world_size, rank=rank)
+    if len(sampler) <= warmup_steps:
+        raise ValueError(f'{len(sampler)} batches per process, expected more than {warmup_steps} warmup steps '
+                         f'(batch size {batch_size})')
+    data = DataLoader(dataset, batch_sampler=sampler, collate_fn=MorphBatchCollator())
+    model = _create_model()
+    dist_utils.broadcast_parameters(model)
+    parameters = [p for p in model.parameters() if p.requires_grad]
+    optimizer = optim.AdamW(parameters, lr=1e-3)
+    criterion = nn.CrossEntropyLoss(ignore_index=0)
+    special_symbols = {'<s>': torch.tensor([sos]), '</s>': torch.tensor([eos]), '<sep>': torch.tensor([sep]),
+                       '<pad>': torch.tensor([pad])}
+    model.train()
+    num_sents = 0
+    start_time = None
+    for i, batch in enumerate(data):
+        if i == warmup_steps:
+            dist_utils.barrier()
+            start_time = time.perf_counter()
+        num_tokens = batch['num_tokens'].tolist()
+        form_scores, _, label_scores = model.forward_batch(batch['xtokens'], batch['token_chars'], special_symbols,
+                                                           num_tokens, batch['form_chars'].shape[2],
+                                                           batch['labels'].shape[2], batch['form_chars'])
+        form_scores = nn.utils.rnn.pad_sequence(form_scores, batch_first=True)
+        label_scores = [nn.utils.rnn.pad_sequence(scores, batch_first=True)
+                        for scores in list(map(list, zip(*label_scores)))]
+        form_targets = batch['form_chars'][:, :form_scores.shape[1]]
+        label_targets = [batch['labels'][:, :form_scores.shape[1], :, j] for j in range(batch['labels'].shape[-1])]
+        loss = model.form_loss(form_scores, form_targets, criterion)
+        loss = loss + sum(model.labels_losses(label_scores, label_targets, criterion))
+        loss.backward()
+        dist_utils.all_reduce_gradients(parameters)
+        torch.nn.utils.clip_grad_norm_(parameters, 1.0)
+        optimizer.step()
+        optimizer.zero_grad()
+        if start_time is not None:
+            num_sents += len(num_tokens)
+    dist_utils.barrier()
+    elapsed_time = time.perf_counter() - start_time
+    total_sents = dist_utils.all_reduce_sum(num_sents)
+    if rank == 0:
+        results.put((world_size, total_sents / elapsed_time))
+    dist_utils.cleanup_distributed()
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def run_benchmark(max_processes, sents_per_process=512, threads_per_process=1) -> list:
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    scores = []
+    world_size = 1
+    while world_size <= max_processes:
+        mp.spawn(_train_worker, args=(world_size, _free_port(), sents_per_process * world_size, threads_per_process,
+                                      results),
+                 nprocs=world_size, join=True)
+        scores.append(results.get())
+        world_size *= 2
+    base_throughput = scores[0][1]
+    print('processes\tsents/sec\tspeedup\tefficiency')
+    for world_size, throughput in scores:
+        speedup = throughput / base_throughput
+        print(f'{world_size}\t{throughput:.2f}\t{speedup:.2f}\t{speedup / world_size:.2f}')
+    return scores
+
+
+if __name__ == '__main__':
+    max_processes = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+    sents_per_process = int(sys.argv[2]) if len(sys.argv) > 2 else 512
+    threads_per_process = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    run_benchmark(max_processes, sents_per_process, threads_per_process)
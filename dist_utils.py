@@ -0,0 +1,86 @@
+import os
+import logging
+from datetime import timedelta
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+
+
+# Single host data parallel training helpers (gloo backend, CPU processes)
+# The processes are started by torchrun (or torch.multiprocessing with the env:// variables set), e.g.
+# torchrun --standalone --nproc_per_node 8 morph_train.py
+# The timeout covers the other processes waiting in barrier() while rank 0 evaluates
+def init_distributed(backend='gloo', threads_per_process=None, timeout_minutes=120) -> (int, int):
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    rank = int(os.environ.get('RANK', 0))
+    if threads_per_process is not None:
+        torch.set_num_threads(threads_per_process)
+    if world_size > 1 and not dist.is_initialized():
+        dist.init_process_group(backend, rank=rank, world_size=world_size,
+                                timeout=timedelta(minutes=timeout_minutes))
+        logging.info(f'Initialized {backend} process group: rank {rank} of {world_size}, '
+                     f'{torch.get_num_threads()} threads per process')
+    return rank, world_size
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+# Start all the replicas from the rank 0 weights
+def broadcast_parameters(module: nn.Module):
+    if not is_distributed():
+        return
+    with torch.no_grad():
+        for t in list(module.parameters()) + list(module.buffers()):
+            dist.broadcast(t.data, src=0)
+
+
+# Average the gradients of the given parameters across the processes with a single flattened all reduce
+# Parameters that did not get a gradient in this step (e.g. a label CRF that was not used) contribute zeros so
+# that every process reduces the same buffer layout
+def all_reduce_gradients(parameters: list):
+    if not is_distributed():
+        return
+    parameters = [p for p in parameters if p.requires_grad]
+    for p in parameters:
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+    grads = [p.grad for p in parameters]
+    flat_grads = torch.cat([g.reshape(-1) for g in grads])
+    dist.all_reduce(flat_grads, op=dist.ReduceOp.SUM)
+    flat_grads /= get_world_size()
+    offset = 0
+    for g in grads:
+        g.copy_(flat_grads[offset:offset + g.numel()].view_as(g))
+        offset += g.numel()
+
+
+def all_reduce_sum(value: float) -> float:
+    if not is_distributed():
+        return value
+    t = torch.tensor([value], dtype=torch.double)
+    dist.all_reduce(t, op=dist.ReduceOp.SUM)
+    return t.item()
@@ -1,12 +1,17 @@
+import sys
 import gzip
+import json
 from pathlib import Path
-import fasttext
 import numpy as np
 import logging
 
+# Compiled vector store: {store_path}.npy - the vectors matrix (float32, or float16), one row per word, and
+# {store_path}.vocab.json - the words in row order. The matrix is memory mapped when loaded, so nothing is parsed
+# and only the rows that are used are read
+# Usage (one time conversion): python fasttext_emb.py vec_or_bin_path [store_path] [float16]
 
 ft_models = {}
-ft_pad_vector = np.zeros(300, dtype=np.float)
+ft_pad_vector = np.zeros(300, dtype=np.float64)
 
 
 def _save_to(path: Path, lines: list):
@@ -57,17 +62,38 @@ def _load_vec_file(path: Path) -> (dict, list):
 def load_word_vectors(vec_file_path: Path) -> (np.array, dict):
     logging.info(f'Loading FastText vectors from {vec_file_path}')
     word2index, vectors = _load_vec_file(vec_file_path)
-    word_vectors = np.array([vectors[word2index[word]] for word in word2index], dtype=np.float)
+    word_vectors = np.array([vectors[word2index[word]] for word in word2index], dtype=np.float64)
     return word_vectors, word2index
 
 
-def get_word_vectors(lang, model_path, words: list):
+def _get_model(lang, model_path):
     global ft_models
     if lang not in ft_models:
+        import fasttext
         logging.info(f'Loading FastText model from {model_path}')
         ft_models[lang] = fasttext.load_model(f'{model_path}')
+    return ft_models[lang]
+
+
+# The word vectors are looked up in the compiled store of the model (see get_store_path) if there is one, the
+# FastText model is loaded only for the words that are not in the store
+def get_word_vectors(lang, model_path, words: list):
     word2index = {word: i + 1 for i, word in enumerate(words)}
-    word_vectors = np.stack([ft_models[lang].get_word_vector(word) if word != '<pad>' else ft_pad_vector
+    store_path = get_store_path(model_path)
+    if vector_store_exists(store_path):
+        store_vectors, store_word2index = load_vector_store(store_path)
+        missing = [word for word in words if word != '<pad>' and word not in store_word2index]
+        missing_vectors = {}
+        if missing:
+            model = _get_model(lang, model_path)
+            missing_vectors = {word: model.get_word_vector(word) for word in missing}
+        word_vectors = np.stack([ft_pad_vector if word == '<pad>' else
+                                 missing_vectors[word] if word in missing_vectors else
+                                 store_vectors[store_word2index[word]].astype(np.float64)
+                                 for word in words], axis=0)
+        return word_vectors, word2index
+    model = _get_model(lang, model_path)
+    word_vectors = np.stack([model.get_word_vector(word) if word != '<pad>' else ft_pad_vector
                              for word in words], axis=0)
     return word_vectors, word2index
 
@@ -80,3 +106,95 @@ def save_word_vectors(vec_file_path: Path, word_vectors, word2index):
             line = ' '.join([word] + [str(v) for v in vec.tolist()])
             f.write(line)
             f.write('\n')
+
+
+def get_store_path(path: Path) -> Path:
+    path = Path(path)
+    if path.suffix == '.gz':
+        path = path.with_suffix('')
+    return path.with_suffix('')
+
+
+def vector_store_exists(store_path: Path) -> bool:
+    return Path(f'{store_path}.npy').exists() and Path(f'{store_path}.vocab.json').exists()
+
+
+def save_vector_store(store_path: Path, word_vectors, words: list, dtype=np.float32):
+    np.save(f'{store_path}.npy', np.asarray(word_vectors, dtype=dtype))
+    with open(f'{store_path}.vocab.json', 'w', encoding='utf8') as f:
+        json.dump(words, f, ensure_ascii=False)
+
+
+def load_vector_store(store_path: Path) -> (np.array, dict):
+    logging.info(f'Loading vector store {store_path}')
+    with open(f'{store_path}.vocab.json', encoding='utf8') as f:
+        words = json.load(f)
+    word_vectors = np.load(f'{store_path}.npy', mmap_mode='r')
+    word2index = {word: i for i, word in enumerate(words)}
+    return word_vectors, word2index
+
+
+def _open_text(path: Path):
+    if path.suffix == '.gz':
+        return gzip.open(str(path), 'rt', encoding='utf8', errors='replace')
+    return open(str(path), 'r', encoding='utf8', errors='replace')
+
+
+# Streams a text .vec file (with or without the fastText "num_words dim" header line) into a vector store:
+# the rows are counted first (unless there is a header) and written to a memory mapped matrix
+def compile_vec_file(vec_file_path: Path, store_path: Path, dtype=np.float32):
+    vec_file_path = Path(vec_file_path)
+    with _open_text(vec_file_path) as f:
+        header = f.readline().split()
+        if len(header) == 2:
+            num_words, dim, skip = int(header[0]), int(header[1]), 1
+        else:
+            num_words, dim, skip = 1 + sum(1 for line in f if line.strip()), len(header) - 1, 0
+    logging.info(f'Compiling {vec_file_path} ({num_words} x {dim}) to {store_path}')
+    tmp_path = Path(f'{store_path}.tmp.npy')
+    word_vectors = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=(num_words, dim))
+    words = []
+    with _open_text(vec_file_path) as f:
+        for i, line in enumerate(f):
+            if i < skip or not line.strip():
+                continue
+            parts = line.rstrip().split(' ')
+            word_vectors[len(words)] = np.asarray(parts[-dim:], dtype=np.float32)
+            words.append(' '.join(parts[:-dim]))
+    word_vectors.flush()
+    del word_vectors
+    tmp_path.rename(f'{store_path}.npy')
+    with open(f'{store_path}.vocab.json', 'w', encoding='utf8') as f:
+        json.dump(words, f, ensure_ascii=False)
+
+
+# Writes the vectors of the words of a FastText binary model (all the model words by default) to a vector store
+def compile_bin_model(model_path: Path, store_path: Path, dtype=np.float32, words: list = None, batch_size=10000):
+    import fasttext
+    logging.info(f'Loading FastText model from {model_path}')
+    model = fasttext.load_model(f'{model_path}')
+    if words is None:
+        words = model.get_words()
+    logging.info(f'Compiling {model_path} ({len(words)} x {model.get_dimension()}) to {store_path}')
+    tmp_path = Path(f'{store_path}.tmp.npy')
+    word_vectors = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype,
+                                             shape=(len(words), model.get_dimension()))
+    for start in range(0, len(words), batch_size):
+        batch = words[start:start + batch_size]
+        word_vectors[start:start + len(batch)] = np.stack([model.get_word_vector(word) for word in batch])
+    word_vectors.flush()
+    del word_vectors
+    tmp_path.rename(f'{store_path}.npy')
+    with open(f'{store_path}.vocab.json', 'w', encoding='utf8') as f:
+        json.dump(list(words), f, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    src_path = Path(sys.argv[1])
+    dst_path = Path(sys.argv[2]) if len(sys.argv) > 2 else get_store_path(src_path)
+    store_dtype = np.float16 if 'float16' in sys.argv[3:] else np.float32
+    if src_path.suffix == '.bin':
+        compile_bin_model(src_path, dst_path, store_dtype)
+    else:
+        compile_vec_file(src_path, dst_path, store_dtype)
@@ -1,8 +1,10 @@
+import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from transformers import BertModel, BertTokenizer
 from conditional_random_field import ConditionalRandomField, allowed_transitions
+from stage_timer import StageTimer
 
 
 def compute_loss(scores, targets, criterion: nn.CrossEntropyLoss):
@@ -11,6 +13,36 @@ def compute_loss(scores, targets, criterion: nn.CrossEntropyLoss):
     return criterion(loss_input, loss_target)
 
 
+# Aggregates the form and label losses into a single loss so the shared encoder/decoder graph is traversed by one
+# backward pass. The task losses are either combined with fixed weights or with learned homoscedastic uncertainty
+# weights (Kendall et al. 2018): sum(exp(-s_i) * loss_i + s_i) where s_i = log(sigma_i^2) is learned per task
+class MultiTaskLoss(nn.Module):
+
+    def __init__(self, num_tasks, weights: list = None, learned=False):
+        super(MultiTaskLoss, self).__init__()
+        self.num_tasks = num_tasks
+        self.learned = learned
+        if learned:
+            self.log_vars = nn.Parameter(torch.zeros(num_tasks))
+        else:
+            if weights is None:
+                weights = [1.0] * num_tasks
+            self.register_buffer('weights', torch.tensor(weights, dtype=torch.float))
+
+    @property
+    def task_weights(self) -> list:
+        if self.learned:
+            return torch.exp(-self.log_vars).tolist()
+        return self.weights.tolist()
+
+    def forward(self, losses: list) -> torch.Tensor:
+        assert len(losses) == self.num_tasks, f'{len(losses)} losses, expected {self.num_tasks}'
+        losses = torch.stack(losses)
+        if self.learned:
+            return torch.sum(torch.exp(-self.log_vars) * losses + self.log_vars)
+        return torch.sum(self.weights * losses)
+
+
 # Mask starting from the position of the first mask_value occurrence
 # Done on the last dimension [batch, token, morph_labels]
 # E.g. [[[28, 0, 0, 0, 0], [5, 7, 0, 0, 0], [6, 0, 0, 0, 0], [13, 13, 0, 0, 0], [8, 0, 0, 0, 0]]]
@@ -57,6 +89,40 @@ class BertTokenEmbeddingModel(nn.Module):
         return emb_tokens
 
 
+def create_crf(config: dict):
+    if 'crf_trans_type' not in config:
+        return None
+    constraint_type = config['crf_trans_type']
+    labels = config['id2label']
+    transitions = allowed_transitions(constraint_type=constraint_type, labels=labels)
+    return ConditionalRandomField(num_tags=len(labels), constraints=transitions)
+
+
+def crf_loss(crf: ConditionalRandomField, scores, targets) -> torch.Tensor:
+    crf_scores, crf_tags, _ = crf_prepare(scores, targets)
+    crf_masks = torch.ne(crf_tags, 0).bool()
+    crf_log_likelihood = crf(inputs=crf_scores, tags=crf_tags, mask=crf_masks)
+    crf_log_likelihood /= torch.sum(crf_masks)
+    return -crf_log_likelihood
+
+
+def crf_decode(crf: ConditionalRandomField, scores, decoded_labels) -> torch.Tensor:
+    crf_scores, crf_tags, token_masks = crf_prepare(scores, decoded_labels)
+    crf_masks = torch.ne(crf_tags, 0).bool()
+    crf_decoded_labels = crf.viterbi_tags(logits=crf_scores, mask=crf_masks)
+    for labels, crf_labels, token_mask in zip(decoded_labels, crf_decoded_labels, token_masks):
+        idxs_vals = [torch.unique_consecutive(mask, return_counts=True) for mask in token_mask]
+        idxs = torch.cat([idx for idx, _ in idxs_vals])
+        vals = torch.cat([val for _, val in idxs_vals])
+        decoded_token_tags = torch.split_with_sizes(torch.tensor(crf_labels[0]), tuple(vals[idxs]))
+        # TODO: this doesn't do the right thing if a token is decoded as all pads (0)
+        # In such a case the first mask is all False and the above split doesn't indicate that this token
+        # should be skipped
+        for idx, token_tags in enumerate(decoded_token_tags):
+            labels[idx, :len(token_tags)] = token_tags
+    return decoded_labels
+
+
 class LabelClassifier(nn.Module):
 
     def __init__(self, char_emb_size, config: dict):
@@ -64,12 +130,7 @@ class LabelClassifier(nn.Module):
         self.config = config
         self.num_labels = len(config['id2label'])
         self.ff = nn.Linear(in_features=char_emb_size, out_features=self.num_labels)
-        self.crf = None
-        if 'crf_trans_type' in config:
-            constraint_type = config['crf_trans_type']
-            labels = config['id2label']
-            transitions = allowed_transitions(constraint_type=constraint_type, labels=labels)
-            self.crf = ConditionalRandomField(num_tags=self.num_labels, constraints=transitions)
+        self.crf = create_crf(config)
 
     def forward(self, dec_chars):
         return self.ff(dec_chars)
@@ -78,39 +139,97 @@ class LabelClassifier(nn.Module):
         if self.crf is None:
             loss_value = compute_loss(scores, targets, criterion)
         else:
-            crf_scores, crf_tags, _ = crf_prepare(scores, targets)
-            crf_masks = torch.ne(crf_tags, 0).bool()
-            crf_log_likelihood = self.crf(inputs=crf_scores, tags=crf_tags, mask=crf_masks)
-            crf_log_likelihood /= torch.sum(crf_masks)
-            loss_value = -crf_log_likelihood
-        return loss_value
+            loss_value = crf_loss(self.crf, scores, targets)
+        return loss_value * self.config.get('loss_weight', 1.0)
 
     def decode(self, scores) -> torch.Tensor:
         decoded_labels = torch.argmax(scores, dim=-1)
         if self.crf is not None:
-            crf_scores, crf_tags, token_masks = crf_prepare(scores, decoded_labels)
-            crf_masks = torch.ne(crf_tags, 0).bool()
-            crf_decoded_labels = self.crf.viterbi_tags(logits=crf_scores, mask=crf_masks)
-            for labels, crf_labels, token_mask in zip(decoded_labels, crf_decoded_labels, token_masks):
-                idxs_vals = [torch.unique_consecutive(mask, return_counts=True) for mask in token_mask]
-                idxs = torch.cat([idx for idx, _ in idxs_vals])
-                vals = torch.cat([val for _, val in idxs_vals])
-                decoded_token_tags = torch.split_with_sizes(torch.tensor(crf_labels[0]), tuple(vals[idxs]))
-                # TODO: this doesn't do the right thing if a token is decoded as all pads (0)
-                # In such a case the first mask is all False and the above split doesn't indicate that this token
-                # should be skipped
-                for idx, token_tags in enumerate(decoded_token_tags):
-                    labels[idx, :len(token_tags)] = token_tags
+            decoded_labels = crf_decode(self.crf, scores, decoded_labels)
+        return decoded_labels
+
+
+# One LabelClassifier per label name, exposing the same list based interface as FusedLabelClassifier
+class LabelClassifiers(nn.ModuleList):
+
+    def forward(self, dec_chars) -> list:
+        return [classifier(dec_chars) for classifier in self]
+
+    def loss(self, labels_scores: list, labels_targets: list, criterion: nn.CrossEntropyLoss) -> list:
+        return [classifier.loss(scores, targets, criterion)
+                for scores, targets, classifier in zip(labels_scores, labels_targets, self)]
+
+    def decode(self, labels_scores: list) -> list:
+        return [classifier.decode(scores) for scores, classifier in zip(labels_scores, self)]
+
+
+# All the label classifiers fused into a single linear layer whose output is split by label (precomputed slices)
+# The cross entropy losses of all the labels are computed in one call over the label scores padded to the
+# largest label space, and weighted by the 'loss_weight' of each label config
+# Labels with a 'crf_trans_type' config keep their own CRF which is applied on top of the label scores
+class FusedLabelClassifier(nn.Module):
+
+    def __init__(self, char_emb_size, configs: list, pad_score=-1e4):
+        super(FusedLabelClassifier, self).__init__()
+        self.configs = configs
+        self.num_labels = [len(config['id2label']) for config in configs]
+        self.pad_score = pad_score
+        self.ff = nn.Linear(in_features=char_emb_size, out_features=sum(self.num_labels))
+        self.crfs = nn.ModuleDict({str(i): create_crf(config) for i, config in enumerate(configs)
+                                   if 'crf_trans_type' in config})
+        self.register_buffer('loss_weights', torch.tensor([config.get('loss_weight', 1.0) for config in configs]),
+                             persistent=False)
+
+    def __len__(self):
+        return len(self.configs)
+
+    def forward(self, dec_chars) -> list:
+        return list(torch.split(self.ff(dec_chars), self.num_labels, dim=-1))
+
+    def loss(self, labels_scores: list, labels_targets: list, criterion: nn.CrossEntropyLoss) -> list:
+        losses = [None] * len(labels_scores)
+        ce_idxs = [i for i in range(len(labels_scores)) if str(i) not in self.crfs]
+        if len(ce_idxs) > 0:
+            max_num_labels = max(self.num_labels[i] for i in ce_idxs)
+            scores = torch.stack([F.pad(labels_scores[i].reshape(-1, self.num_labels[i]),
+                                        (0, max_num_labels - self.num_labels[i]), value=self.pad_score)
+                                  for i in ce_idxs])
+            targets = torch.stack([labels_targets[i].reshape(-1) for i in ce_idxs])
+            ce_losses = F.cross_entropy(scores.view(-1, max_num_labels), targets.view(-1), reduction='none',
+                                        ignore_index=criterion.ignore_index).view(targets.shape)
+            num_targets = torch.sum(torch.ne(targets, criterion.ignore_index), dim=1)
+            ce_losses = torch.sum(ce_losses, dim=1) / num_targets.clamp(min=1)
+            ce_losses = ce_losses * self.loss_weights[ce_idxs]
+            for i, loss_value in zip(ce_idxs, ce_losses):
+                losses[i] = loss_value
+        for i, crf in self.crfs.items():
+            i = int(i)
+            losses[i] = crf_loss(crf, labels_scores[i], labels_targets[i]) * self.loss_weights[i]
+        return losses
+
+    def decode(self, labels_scores: list) -> list:
+        decoded_labels = [torch.argmax(scores, dim=-1) for scores in labels_scores]
+        for i, crf in self.crfs.items():
+            i = int(i)
+            decoded_labels[i] = crf_decode(crf, labels_scores[i], decoded_labels[i])
         return decoded_labels
 
 
+def create_label_classifiers(char_emb_size, labels_configs: list, fused=False):
+    if fused:
+        return FusedLabelClassifier(char_emb_size, labels_configs)
+    return LabelClassifiers([LabelClassifier(char_emb_size, config) for config in labels_configs])
+
+
 class SegmentDecoder(nn.Module):
 
     def __init__(self, char_emb: nn.Embedding, hidden_size, num_layers, dropout, char_dropout, char_out_size,
-                 labels_configs: list = None):
+                 labels_configs: list = None, use_gru_cell=False, stop_check_steps=4, fused_labels=False):
         super(SegmentDecoder, self).__init__()
         if labels_configs is None:
             labels_configs = []
+        self.use_gru_cell = use_gru_cell
+        self.stop_check_steps = stop_check_steps
         self.char_emb = char_emb
         self.char_encoder = nn.GRU(input_size=char_emb.embedding_dim,
                                    hidden_size=hidden_size,
@@ -126,7 +245,8 @@ class SegmentDecoder(nn.Module):
                                    dropout=dropout)
         self.char_dropout = nn.Dropout(char_dropout)
         self.char_out = nn.Linear(in_features=self.char_decoder.hidden_size, out_features=char_out_size)
-        self.classifiers = nn.ModuleList([LabelClassifier(char_out_size, config) for config in labels_configs])
+        self.classifiers = create_label_classifiers(char_out_size, labels_configs, fused_labels)
+        self.timer = StageTimer(enabled=False)
 
     @property
     def enc_num_layers(self):
@@ -136,46 +256,100 @@ class SegmentDecoder(nn.Module):
     def dec_num_layers(self):
         return self.char_decoder.num_layers
 
-    def forward(self, char_seq, enc_state, special_symbols, max_out_char_seq_len, target_char_seq, max_num_labels):
-        char_scores, char_states, label_scores = [], [], []
-        enc_output, dec_char_state = self._forward_encode(char_seq, enc_state)
+    # The decode loop writes each step into output buffers allocated once per token and never inspects the
+    # decoded chars on the host, except for an </s> check every stop_check_steps steps (greedy decoding only,
+    # with teacher forcing the number of steps is known upfront). Steps past the end of the segmentation are
+    # masked out afterwards, and the label classifiers run once over the decoded char scores at the morpheme
+    # boundaries (<sep> and the final step)
+    # max_decode_len is an optional per token decoding budget (steps beyond it are never decoded)
+    def forward(self, char_seq, enc_state, special_symbols, max_out_char_seq_len, target_char_seq, max_num_labels,
+                max_decode_len=None):
+        with self.timer.stage('char_encode', sync=False):
+            enc_output, dec_char_state = self._forward_encode(char_seq, enc_state)
         sos, eos, sep = special_symbols['<s>'], special_symbols['</s>'], special_symbols['<sep>']
-        dec_char = sos
-        for _ in self.classifiers:
-            label_scores.append([])
-        while (len(char_scores) < max_out_char_seq_len and
-               (max_num_labels is None or all([len(scores) < max_num_labels for scores in label_scores]))):
-            dec_output = self._forward_decoder_step(dec_char, dec_char_state, target_char_seq, len(char_scores), sep)
-            dec_char, dec_char_output, dec_char_state, dec_labels_output = dec_output
-            char_scores.append(dec_char_output)
-            char_states.append(dec_char_state.view(1, -1, self.dec_num_layers * dec_char_state.shape[2]))
-            if dec_labels_output:
-                for output, scores in zip(dec_labels_output, label_scores):
-                    scores.append(output)
-            if torch.all(torch.eq(dec_char, eos)):
-                break
-        dec_labels_output = self._labels_decode(char_scores[-1])
-        if dec_labels_output:
-            for output, scores in zip(dec_labels_output, label_scores):
-                scores.append(output)
-        char_fill_len = max_out_char_seq_len - len(char_scores)
-        char_scores = torch.cat(char_scores, dim=1)
-        char_scores_out = F.pad(char_scores, (0, 0, 0, char_fill_len))
-        char_states = torch.cat(char_states, dim=1)
-        char_states_out = F.pad(char_states, (0, 0, 0, char_fill_len))
+        with self.timer.stage('decode', sync=False):
+            num_chars = self.char_out.out_features
+            char_scores = enc_output.new_zeros((max_out_char_seq_len, num_chars))
+            char_states = enc_output.new_zeros((max_out_char_seq_len, self.dec_num_layers * dec_char_state.shape[2]))
+            dec_chars = torch.zeros(max_out_char_seq_len, dtype=torch.long, device=char_seq.device)
+            num_steps = self._num_forced_steps(target_char_seq, max_out_char_seq_len, eos, sep, max_num_labels)
+            if max_decode_len is not None:
+                num_steps = min(num_steps, max_decode_len)
+            dec_char = sos
+            num_decoded_steps = 0
+            for step in range(num_steps):
+                dec_output = self._forward_decoder_step(dec_char, dec_char_state, target_char_seq, step)
+                dec_char, dec_char_output, dec_char_state = dec_output
+                char_scores[step] = dec_char_output.view(-1)
+                char_states[step] = dec_char_state.view(-1)
+                dec_chars[step] = dec_char
+                num_decoded_steps += 1
+                if (target_char_seq is None and (step + 1) % self.stop_check_steps == 0 and
+                        self._is_decode_done(dec_chars, eos, sep, max_num_labels)):
+                    break
+            step_mask, label_mask = self._decoded_steps_masks(dec_chars, eos, sep, max_num_labels, num_steps)
+            char_scores_out = (char_scores * step_mask.unsqueeze(1)).unsqueeze(0)
+            char_states_out = (char_states * step_mask.unsqueeze(1)).unsqueeze(0)
+        self.timer.count('decoder_steps', num_decoded_steps)
         label_scores_out = []
-        for scores in label_scores:
-            label_fill_len = max_num_labels - len(scores)
-            scores = torch.cat(scores, dim=1)
-            label_scores_out.append(F.pad(scores, (0, 0, 0, label_fill_len)))
+        if len(self.classifiers) > 0:
+            label_steps, slot_mask = self._label_steps(label_mask, max_num_labels)
+            with self.timer.stage('labels', sync=False):
+                for scores in self._labels_decode(char_scores[label_steps]):
+                    label_scores_out.append((scores * slot_mask.unsqueeze(1)).unsqueeze(0))
         return char_scores_out, char_states_out, label_scores_out
 
+    # Decoded step of every label slot: the [max_num_labels] steps of the first label_mask steps (scattered by their
+    # slot, the steps past the last slot go to a dropped extra slot) and the mask of the filled slots
+    # Fixed size so the label steps are gathered without copying the mask to the host
+    def _label_steps(self, label_mask, max_num_labels) -> (torch.Tensor, torch.Tensor):
+        label_slots = torch.cumsum(label_mask, dim=0) - 1
+        label_slots = torch.where(label_mask, label_slots, torch.full_like(label_slots, max_num_labels))
+        label_slots = label_slots.clamp(max=max_num_labels)
+        steps = torch.arange(len(label_mask), device=label_mask.device)
+        label_steps = steps.new_zeros(max_num_labels + 1).scatter(0, label_slots, steps)[:max_num_labels]
+        slots = torch.arange(max_num_labels, device=label_mask.device)
+        slot_mask = torch.lt(slots, torch.sum(label_mask))
+        return label_steps, slot_mask
+
+    # Valid decoded steps: up to and including the first </s>, up to the <sep> that completes max_num_labels
+    # morphemes (only when there are label classifiers) and up to the decoding budget (max_decode_len)
+    # Label steps: valid steps followed by a <sep>, and the last valid step
+    # Computed on the last dimension so a [num_tokens, max_len] batch of decoded chars is masked in one call
+    def _decoded_steps_masks(self, dec_chars, eos, sep, max_num_labels, max_decode_len=None) -> (torch.Tensor,
+                                                                                                 torch.Tensor):
+        eos_mask = torch.eq(dec_chars, eos)
+        sep_mask = torch.eq(dec_chars, sep)
+        step_mask = torch.eq(torch.cumsum(eos_mask, dim=-1) - eos_mask.long(), 0)
+        if len(self.classifiers) > 0 and max_num_labels is not None:
+            num_prev_seps = torch.cumsum(sep_mask, dim=-1) - sep_mask.long()
+            step_mask = torch.bitwise_and(step_mask, torch.lt(num_prev_seps, max_num_labels))
+        if max_decode_len is not None:
+            steps = torch.arange(dec_chars.shape[-1], device=dec_chars.device)
+            step_mask = torch.bitwise_and(step_mask, torch.lt(steps, max_decode_len))
+        next_step_mask = torch.cat([step_mask[..., 1:], step_mask.new_zeros(step_mask.shape[:-1] + (1,))], dim=-1)
+        last_step_mask = torch.bitwise_and(step_mask, ~next_step_mask)
+        label_mask = torch.bitwise_and(step_mask, torch.bitwise_or(sep_mask, last_step_mask))
+        return step_mask, label_mask
+
+    def _is_decode_done(self, dec_chars, eos, sep, max_num_labels) -> bool:
+        done = torch.any(torch.eq(dec_chars, eos))
+        if len(self.classifiers) > 0 and max_num_labels is not None:
+            done = torch.bitwise_or(done, torch.sum(torch.eq(dec_chars, sep)) >= max_num_labels)
+        return bool(done)
+
+    # With teacher forcing the decoded chars are the targets, so the number of steps is computed once
+    def _num_forced_steps(self, target_char_seq, max_out_char_seq_len, eos, sep, max_num_labels) -> int:
+        if target_char_seq is None:
+            return max_out_char_seq_len
+        step_mask, _ = self._decoded_steps_masks(target_char_seq[:max_out_char_seq_len], eos, sep, max_num_labels)
+        return max(int(torch.sum(step_mask)), 1)
+
     def form_loss(self, form_scores, form_targets, criterion: nn.CrossEntropyLoss):
         return compute_loss(form_scores, form_targets, criterion)
 
     def labels_losses(self, labels_scores, labels_targets, criterion: nn.CrossEntropyLoss):
-        return [classifier.loss(scores, targets, criterion)
-                for scores, targets, classifier in zip(labels_scores, labels_targets, self.classifiers)]
+        return self.classifiers.loss(labels_scores, labels_targets, criterion)
 
     def _forward_encode(self, char_seq, enc_state):
         mask = torch.ne(char_seq, 0)
@@ -186,59 +360,231 @@ class SegmentDecoder(nn.Module):
         enc_output, enc_state = self.char_encoder(emb_chars, enc_state)
         return enc_output, enc_state
 
-    def _forward_decoder_step(self, cur_dec_char, dec_char_state, target_char_seq, num_scores, sep):
+    def _forward_decoder_step(self, cur_dec_char, dec_char_state, target_char_seq, num_scores):
         emb_dec_char = self.char_emb(cur_dec_char).unsqueeze(1)
-        dec_char_output, dec_char_state = self.char_decoder(emb_dec_char, dec_char_state)
+        if self.use_gru_cell:
+            dec_char_output, dec_char_state = self._gru_cell_step(emb_dec_char, dec_char_state)
+        else:
+            dec_char_output, dec_char_state = self.char_decoder(emb_dec_char, dec_char_state)
         dec_char_output = self.char_dropout(dec_char_output)
         dec_char_output = self.char_out(dec_char_output)
         if target_char_seq is not None:
             next_dec_char = target_char_seq[num_scores].unsqueeze(0)
         else:
             next_dec_char = self._form_decode(dec_char_output).squeeze(0)
-        if torch.eq(next_dec_char, sep):
-            dec_labels_output = self._labels_decode(dec_char_output)
-        else:
-            dec_labels_output = None
-        return next_dec_char, dec_char_output, dec_char_state, dec_labels_output
+        return next_dec_char, dec_char_output, dec_char_state
+
+    # Single decoder step computed layer by layer with fused GRU cells sharing the char_decoder weights
+    # (skips the nn.GRU sequence setup which dominates the cost of a one step, small hidden size GRU call)
+    def _gru_cell_step(self, emb_dec_char, dec_char_state):
+        gru = self.char_decoder
+        layer_input = emb_dec_char.view(-1, emb_dec_char.shape[-1])
+        states = []
+        for layer in range(gru.num_layers):
+            if layer > 0:
+                layer_input = F.dropout(layer_input, p=gru.dropout, training=self.training)
+            layer_input = torch.gru_cell(layer_input, dec_char_state[layer],
+                                         getattr(gru, f'weight_ih_l{layer}'), getattr(gru, f'weight_hh_l{layer}'),
+                                         getattr(gru, f'bias_ih_l{layer}'), getattr(gru, f'bias_hh_l{layer}'))
+            states.append(layer_input)
+        return layer_input.unsqueeze(0), torch.stack(states, dim=0)
 
     def _labels_decode(self, dec_char_output) -> list:
-        return [classifier(dec_char_output) for classifier in self.classifiers]
+        return self.classifiers(dec_char_output)
 
     def _form_decode(self, scores):
         return torch.argmax(scores, dim=-1)
 
     def decode(self, form_scores, label_scores) -> (torch.Tensor, torch.Tensor):
         dec_forms = self._form_decode(form_scores)
-        dec_labels = [classifier.decode(scores) for scores, classifier in zip(label_scores, self.classifiers)]
+        dec_labels = self.classifiers.decode(label_scores)
         return dec_forms, dec_labels
 
+    # Encode all the tokens of a sentence in a single (packed) char encoder call
+    # char_seq: [num_tokens, max_token_len], enc_state: [num_tokens, enc_num_layers * hidden_size]
+    def _forward_batch_encode(self, char_seq, enc_state):
+        lengths = torch.sum(torch.ne(char_seq, 0), dim=1)
+        emb_chars = self.char_emb(char_seq).transpose(0, 1)
+        emb_chars = nn.utils.rnn.pack_padded_sequence(emb_chars, lengths.cpu(), enforce_sorted=False)
+        enc_state = enc_state.view(enc_state.shape[0], self.enc_num_layers, -1).transpose(0, 1).contiguous()
+        _, enc_state = self.char_encoder(emb_chars, enc_state)
+        return enc_state
+
+    # Batched beam search over the char decoder, vectorized across tokens and beams
+    # Each decoder step runs once on [num_tokens * beam_size] states. Finished beams (</s> emitted) are only
+    # extended with <pad> at no cost, and the search stops once every beam of every token has finished.
+    # Final beam scores are length normalized: sum(log_prob) / len^length_penalty
+    # Tokens that reach their decoding budget (max_decode_lens, [num_tokens]) are finished as is
+    # Returns the n-best form chars [num_tokens, beam_size, max_out_char_seq_len] and their scores
+    # [num_tokens, beam_size], best first
+    def beam_decode(self, char_seq, enc_state, special_symbols, max_out_char_seq_len, beam_size=4,
+                    length_penalty=1.0, max_decode_lens=None) -> (torch.Tensor, torch.Tensor):
+        num_tokens = char_seq.shape[0]
+        num_chars = self.char_out.out_features
+        sos, eos = special_symbols['<s>'], special_symbols['</s>']
+        dec_char_state = self._forward_batch_encode(char_seq, enc_state)
+        dec_char_state = dec_char_state.repeat_interleave(beam_size, dim=1)
+        beam_scores = torch.full((num_tokens, beam_size), float('-inf'), device=char_seq.device)
+        beam_scores[:, 0] = 0.0
+        beam_chars = torch.zeros((num_tokens, beam_size, max_out_char_seq_len), dtype=torch.long,
+                                 device=char_seq.device)
+        beam_lengths = torch.zeros((num_tokens, beam_size), dtype=torch.long, device=char_seq.device)
+        beam_finished = torch.zeros((num_tokens, beam_size), dtype=torch.bool, device=char_seq.device)
+        finished_scores = torch.full((num_chars,), float('-inf'), device=char_seq.device)
+        finished_scores[0] = 0.0
+        dec_char = sos.expand(num_tokens * beam_size)
+        token_idxs = torch.arange(num_tokens, device=char_seq.device).unsqueeze(1)
+        num_steps = max_out_char_seq_len
+        if max_decode_lens is not None:
+            num_steps = min(num_steps, int(torch.max(max_decode_lens)))
+        for step in range(num_steps):
+            if max_decode_lens is not None:
+                beam_finished = torch.bitwise_or(beam_finished, torch.le(max_decode_lens, step).unsqueeze(1))
+            emb_dec_char = self.char_emb(dec_char).unsqueeze(0)
+            dec_char_output, dec_char_state = self.char_decoder(emb_dec_char, dec_char_state)
+            dec_char_output = self.char_out(self.char_dropout(dec_char_output))
+            char_scores = F.log_softmax(dec_char_output.squeeze(0), dim=-1).view(num_tokens, beam_size, num_chars)
+            char_scores = torch.where(beam_finished.unsqueeze(-1), finished_scores, char_scores)
+            cand_scores = (beam_scores.unsqueeze(-1) + char_scores).view(num_tokens, -1)
+            beam_scores, cand_idxs = torch.topk(cand_scores, beam_size, dim=-1)
+            beam_idxs = torch.div(cand_idxs, num_chars, rounding_mode='floor')
+            next_chars = cand_idxs % num_chars
+            beam_chars = beam_chars[token_idxs, beam_idxs]
+            beam_lengths = beam_lengths[token_idxs, beam_idxs]
+            beam_finished = beam_finished[token_idxs, beam_idxs]
+            beam_chars[:, :, step] = next_chars
+            beam_lengths += (~beam_finished).long()
+            beam_finished = torch.bitwise_or(beam_finished, torch.eq(next_chars, eos))
+            state_idxs = (token_idxs * beam_size + beam_idxs).view(-1)
+            dec_char_state = dec_char_state[:, state_idxs]
+            dec_char = next_chars.view(-1)
+            if torch.all(beam_finished):
+                break
+        beam_scores = beam_scores / beam_lengths.clamp(min=1).float().pow(length_penalty)
+        beam_scores, order = torch.sort(beam_scores, dim=-1, descending=True)
+        return beam_chars[token_idxs, order], beam_scores
+
+
+# Known token segmentation index (see data.preprocess_lookup.build_segment_lookup)
+# Maps token char ids to precomputed form char scores and label scores so that frequent unambiguous tokens
+# (function words, punctuation, ...) can bypass the char decoder at inference time
+class SegmentLookup:
+
+    def __init__(self, token_segments: dict, num_chars, num_labels: list, min_score=-1e4):
+        self.num_chars = num_chars
+        self.num_labels = num_labels
+        self.form_chars = {}
+        self.form_scores = {}
+        self.label_scores = {}
+        for token_chars, (form_chars, label_dists) in token_segments.items():
+            form_chars = torch.tensor(form_chars, dtype=torch.long)
+            form_scores = torch.full((len(form_chars), num_chars), min_score)
+            form_scores[torch.arange(len(form_chars)), form_chars] = 0.0
+            label_scores = []
+            for morph_dists, n in zip(label_dists, num_labels):
+                scores = torch.full((len(morph_dists), n), min_score)
+                for i, dist in enumerate(morph_dists):
+                    for label_id, p in dist.items():
+                        scores[i, label_id] = max(math.log(p), min_score)
+                label_scores.append(scores)
+            self.form_chars[token_chars] = form_chars
+            self.form_scores[token_chars] = form_scores
+            self.label_scores[token_chars] = label_scores
+        self.num_queries, self.num_hits = 0, 0
+
+    def __len__(self):
+        return len(self.form_scores)
+
+    def __contains__(self, token_chars):
+        return token_chars in self.form_scores
+
+    def to(self, device):
+        self.form_chars = {k: v.to(device) for k, v in self.form_chars.items()}
+        self.form_scores = {k: v.to(device) for k, v in self.form_scores.items()}
+        self.label_scores = {k: [s.to(device) for s in v] for k, v in self.label_scores.items()}
+        return self
+
+    def lookup(self, token_chars: tuple) -> bool:
+        self.num_queries += 1
+        if token_chars in self.form_scores:
+            self.num_hits += 1
+            return True
+        return False
+
+    @property
+    def hit_rate(self):
+        return self.num_hits / self.num_queries if self.num_queries else 0.0
+
+    def reset_stats(self):
+        self.num_queries, self.num_hits = 0, 0
+
+    # Form char ids padded to max_form_len, used as forced decoder targets
+    def get_form_chars(self, token_chars, max_form_len):
+        form_chars = self.form_chars[token_chars][:max_form_len]
+        return F.pad(form_chars, (0, max_form_len - len(form_chars)))
+
+    # Scores shaped and padded like the SegmentDecoder output of a single token
+    def get_scores(self, token_chars, max_form_len, max_num_labels) -> (torch.Tensor, list):
+        form_scores = self.form_scores[token_chars][:max_form_len]
+        form_scores = F.pad(form_scores, (0, 0, 0, max_form_len - len(form_scores))).unsqueeze(dim=0)
+        label_scores = []
+        for scores in self.label_scores[token_chars]:
+            scores = scores[:max_num_labels]
+            label_scores.append(F.pad(scores, (0, 0, 0, max_num_labels - len(scores))).unsqueeze(dim=0))
+        return form_scores, label_scores
+
 
 class MorphSequenceModel(nn.Module):
 
-    def __init__(self, xtoken_emb: BertTokenEmbeddingModel, segment_decoder: SegmentDecoder):
+    def __init__(self, xtoken_emb: BertTokenEmbeddingModel, segment_decoder: SegmentDecoder,
+                 segment_lookup: SegmentLookup = None, decode_len_factor=None, decode_len_extra=0):
         super(MorphSequenceModel, self).__init__()
         self.xtoken_emb = xtoken_emb
         self.segment_decoder = segment_decoder
+        self.segment_lookup = segment_lookup
+        self.decode_len_factor = decode_len_factor
+        self.decode_len_extra = decode_len_extra
+        self.timer = StageTimer(enabled=False)
 
     @property
     def embedding_dim(self):
         return self.xtoken_emb.embedding_dim
 
+    # Number of label classifiers (label losses), 0 for segmentation only models
+    @property
+    def num_classifiers(self):
+        return len(self.segment_decoder.classifiers)
+
+    # Stage timing of the model (and its segment decoder) forward passes
+    def set_timer(self, timer: StageTimer):
+        self.timer = timer
+        self.segment_decoder.timer = timer
+
     def forward(self, xtoken_seq, char_seq, special_symbols, num_tokens, max_form_len, max_num_labels,
                 target_chars=None):
-        token_ctx = self.xtoken_emb(xtoken_seq.unsqueeze(dim=0))[0]
+        with self.timer.stage('bert'):
+            token_ctx = self.xtoken_emb(xtoken_seq.unsqueeze(dim=0))[0]
         out_char_scores, out_char_states = [], []
         out_label_scores = []
-        for _ in self.segment_decoder.classifiers:
+        for _ in range(len(self.segment_decoder.classifiers)):
             out_label_scores.append([])
+        lookup_tokens = self._lookup_tokens(char_seq, num_tokens, target_chars)
+        decode_budgets = self._decode_budgets(char_seq, num_tokens)
+        if decode_budgets is not None:
+            decode_budgets = decode_budgets.tolist()
         for cur_token_idx in range(num_tokens):
             cur_token_state = token_ctx[cur_token_idx + 1]
             cur_input_chars = char_seq[cur_token_idx]
             cur_target_chars = None
             if target_chars is not None:
                 cur_target_chars = target_chars[cur_token_idx]
-            seg_output = self.segment_decoder(cur_input_chars, cur_token_state, special_symbols, max_form_len,
-                                              cur_target_chars, max_num_labels)
+            if lookup_tokens[cur_token_idx] is not None:
+                seg_output = self._lookup_forward(lookup_tokens[cur_token_idx], cur_input_chars, cur_token_state,
+                                                  special_symbols, max_form_len, max_num_labels)
+            else:
+                seg_output = self.segment_decoder(cur_input_chars, cur_token_state, special_symbols, max_form_len,
+                                                  cur_target_chars, max_num_labels,
+                                                  None if decode_budgets is None else decode_budgets[cur_token_idx])
             cur_token_segment_scores, cur_token_segment_states, cur_token_label_scores = seg_output
             out_char_scores.append(cur_token_segment_scores)
             out_char_states.append(cur_token_segment_states)
@@ -249,9 +595,85 @@ class MorphSequenceModel(nn.Module):
         out_label_scores = [torch.cat(label_scores, dim=0) for label_scores in out_label_scores]
         return out_char_scores, out_char_states, out_label_scores
 
+    # Known tokens (as char id tuples) for which the segment decoder is skipped, None for the rest
+    # The lookup is only used at inference time (no targets, eval mode)
+    def _lookup_tokens(self, char_seq, num_tokens, target_chars) -> list:
+        if self.segment_lookup is None or target_chars is not None or self.training:
+            return [None] * num_tokens
+        lookup_tokens = []
+        for token_chars in char_seq[:num_tokens].tolist():
+            token_chars = tuple(c for c in token_chars if c > 0)
+            lookup_tokens.append(token_chars if self.segment_lookup.lookup(token_chars) else None)
+        return lookup_tokens
+
+    # Per token decoding budget: len(token) * decode_len_factor + decode_len_extra chars (forms, <sep>s and </s>)
+    # None if budgets are disabled
+    def _decode_budgets(self, char_seq, num_tokens) -> torch.Tensor:
+        if self.decode_len_factor is None:
+            return None
+        token_lens = torch.sum(torch.ne(char_seq[:num_tokens], 0), dim=-1)
+        return torch.ceil(token_lens * self.decode_len_factor).long() + self.decode_len_extra
+
+    # Compact ragged layout of padded [num_tokens, max_form_len, ...] decoder outputs: only the decoded steps of
+    # each token are kept (see SegmentDecoder._decoded_steps_masks)
+    # form_chars are the chars fed back into the decoder (the targets with teacher forcing, decoded chars otherwise)
+    # With target_chars, the target steps are kept as well (the steps past an early decoded </s> still count in the
+    # form loss, as in the padded layout)
+    # Returns the [num_decoded_steps, ...] outputs and the [num_tokens] decoded lengths
+    def to_ragged(self, form_outputs, form_chars, char_seq, special_symbols, max_num_labels,
+                  target_chars=None) -> (torch.Tensor, torch.Tensor):
+        eos, sep = special_symbols['</s>'], special_symbols['<sep>']
+        num_tokens = form_chars.shape[0]
+        decode_budgets = self._decode_budgets(char_seq, num_tokens)
+        if decode_budgets is not None:
+            decode_budgets = decode_budgets.unsqueeze(-1)
+        step_mask, _ = self.segment_decoder._decoded_steps_masks(form_chars, eos, sep, max_num_labels, decode_budgets)
+        if target_chars is not None:
+            target_mask, _ = self.segment_decoder._decoded_steps_masks(target_chars[:num_tokens], eos, sep,
+                                                                       max_num_labels)
+            step_mask = torch.bitwise_or(step_mask, target_mask)
+        return form_outputs[:num_tokens][step_mask], torch.sum(step_mask, dim=-1)
+
+    # Padded [num_tokens, max_form_len] targets aligned with the ragged outputs of to_ragged
+    def to_ragged_targets(self, form_targets, form_lengths) -> torch.Tensor:
+        steps = torch.arange(form_targets.shape[-1], device=form_targets.device)
+        target_mask = torch.lt(steps, form_lengths.unsqueeze(-1))
+        return form_targets[:len(form_lengths)][target_mask]
+
+    def _lookup_forward(self, token_chars, char_seq, enc_state, special_symbols, max_form_len, max_num_labels):
+        form_scores, label_scores = self.segment_lookup.get_scores(token_chars, max_form_len, max_num_labels)
+        states_size = self.segment_decoder.dec_num_layers * self.segment_decoder.char_decoder.hidden_size
+        form_states = form_scores.new_zeros((1, max_form_len, states_size))
+        return form_scores, form_states, label_scores
+
+    # Batch version of forward over [batch_size, ...] inputs, returns the per sentence outputs
+    # target_chars are the forced form chars of every sentence (None for the sentences decoded freely)
+    def forward_batch(self, xtoken_seqs, char_seqs, special_symbols, num_tokens: list, max_form_len, max_num_labels,
+                      target_chars=None) -> (list, list, list):
+        batch_morph_scores, batch_morph_states, batch_label_scores = [], [], []
+        for i in range(len(num_tokens)):
+            sent_target_chars = target_chars[i] if target_chars is not None else None
+            morph_scores, morph_states, label_scores = self(xtoken_seqs[i], char_seqs[i], special_symbols,
+                                                            num_tokens[i], max_form_len, max_num_labels,
+                                                            sent_target_chars)
+            batch_morph_scores.append(morph_scores)
+            batch_morph_states.append(morph_states)
+            batch_label_scores.append(label_scores)
+        return batch_morph_scores, batch_morph_states, batch_label_scores
+
     def decode(self, morph_seg_scores, label_scores: list):
         return self.segment_decoder.decode(morph_seg_scores, label_scores)
 
+    # N-best segmentations of all the sentence tokens (see SegmentDecoder.beam_decode)
+    def beam_decode(self, xtoken_seq, char_seq, special_symbols, num_tokens, max_form_len, beam_size=4,
+                    length_penalty=1.0) -> (torch.Tensor, torch.Tensor):
+        with self.timer.stage('bert'):
+            token_ctx = self.xtoken_emb(xtoken_seq.unsqueeze(dim=0))[0]
+        with self.timer.stage('decode'):
+            return self.segment_decoder.beam_decode(char_seq[:num_tokens], token_ctx[1:num_tokens + 1],
+                                                    special_symbols, max_form_len, beam_size, length_penalty,
+                                                    self._decode_budgets(char_seq, num_tokens))
+
     def form_loss(self, form_scores, form_targets, criterion: nn.CrossEntropyLoss):
         return self.segment_decoder.form_loss(form_scores, form_targets, criterion)
 
@@ -262,8 +684,10 @@ class MorphSequenceModel(nn.Module):
 class MorphPipelineModel(MorphSequenceModel):
 
     def __init__(self, xtoken_emb: BertTokenEmbeddingModel, segment_decoder: SegmentDecoder, hidden_size, num_layers,
-                 dropout, seg_dropout, labels_configs: list = None):
-        super(MorphPipelineModel, self).__init__(xtoken_emb, segment_decoder)
+                 dropout, seg_dropout, labels_configs: list = None, segment_lookup: SegmentLookup = None,
+                 decode_len_factor=None, decode_len_extra=0, fused_labels=False):
+        super(MorphPipelineModel, self).__init__(xtoken_emb, segment_decoder, segment_lookup, decode_len_factor,
+                                                 decode_len_extra)
         if labels_configs is None:
             labels_configs = []
         self.encoder = nn.LSTM(input_size=xtoken_emb.embedding_dim,
@@ -273,17 +697,45 @@ class MorphPipelineModel(MorphSequenceModel):
                                batch_first=False,
                                dropout=dropout)
         self.seg_dropout = nn.Dropout(seg_dropout)
-        self.classifiers = nn.ModuleList([LabelClassifier(hidden_size*2, config) for config in labels_configs])
+        self.classifiers = create_label_classifiers(hidden_size*2, labels_configs, fused_labels)
+
+    @property
+    def num_classifiers(self):
+        return len(self.classifiers)
 
     def forward(self, xtoken_seq, char_seq, special_symbols, num_tokens, max_form_len, max_num_labels,
                 target_chars=None):
         morph_scores, morph_states, _ = super().forward(xtoken_seq, char_seq, special_symbols, num_tokens,
                                                         max_form_len, max_num_labels, target_chars)
-        if target_chars is not None:
-            morph_chars = target_chars
-        else:
-            morph_chars, _ = self.decode(morph_scores, [])
-            morph_chars = morph_chars.squeeze(0)
+        morph_chars = target_chars if target_chars is not None else self.segment_decoder._form_decode(morph_scores)
+        with self.timer.stage('labels'):
+            label_scores = self._forward_labels([morph_chars], [morph_states], [num_tokens], special_symbols,
+                                                max_num_labels)
+        return morph_scores, morph_states, [scores[0, :num_tokens] for scores in label_scores]
+
+    def forward_batch(self, xtoken_seqs, char_seqs, special_symbols, num_tokens: list, max_form_len, max_num_labels,
+                      target_chars=None) -> (list, list, list):
+        batch_morph_scores, batch_morph_states, batch_morph_chars = [], [], []
+        for i in range(len(num_tokens)):
+            sent_target_chars = target_chars[i] if target_chars is not None else None
+            morph_scores, morph_states, _ = super().forward(xtoken_seqs[i], char_seqs[i], special_symbols,
+                                                            num_tokens[i], max_form_len, max_num_labels,
+                                                            sent_target_chars)
+            batch_morph_scores.append(morph_scores)
+            batch_morph_states.append(morph_states)
+            if sent_target_chars is not None:
+                batch_morph_chars.append(sent_target_chars)
+            else:
+                batch_morph_chars.append(self.segment_decoder._form_decode(morph_scores))
+        with self.timer.stage('labels'):
+            label_scores = self._forward_labels(batch_morph_chars, batch_morph_states, num_tokens, special_symbols,
+                                                max_num_labels)
+        batch_label_scores = [[scores[i, :num_tokens[i]] for scores in label_scores] for i in range(len(num_tokens))]
+        return batch_morph_scores, batch_morph_states, batch_label_scores
+
+    # Morpheme boundary mask: the first </s> of each token (or its last step if there is none) and the <sep>s
+    # before it
+    def _seg_state_mask(self, morph_chars, num_tokens, special_symbols) -> torch.BoolTensor:
         eos, sep = special_symbols['</s>'], special_symbols['<sep>']
         eos_mask = torch.eq(morph_chars[:num_tokens], eos)
         eos_mask[:, -1] = True
@@ -291,29 +743,59 @@ class MorphPipelineModel(MorphSequenceModel):
 
         sep_mask = torch.eq(morph_chars[:num_tokens], sep)
         sep_mask = torch.bitwise_and(torch.eq(torch.cumsum(eos_mask, dim=1), 0), sep_mask)
-
-        seg_state_mask = torch.bitwise_or(eos_mask, sep_mask)
-        seg_states = morph_states[seg_state_mask]
-        enc_seg_scores, _ = self.encoder(seg_states.unsqueeze(dim=1))
+        return torch.bitwise_or(eos_mask, sep_mask)
+
+    # Encode the morpheme boundary states of all the sentences with a single (packed) LSTM call and scatter the
+    # label scores back to [batch, token, max_num_labels, num_labels] using indices computed once per batch
+    def _forward_labels(self, batch_morph_chars: list, batch_morph_states: list, num_tokens: list, special_symbols,
+                        max_num_labels) -> list:
+        seg_state_masks = [self._seg_state_mask(morph_chars, n, special_symbols)
+                           for morph_chars, n in zip(batch_morph_chars, num_tokens)]
+        seg_state_masks = nn.utils.rnn.pad_sequence(seg_state_masks, batch_first=True)
+        morph_states = nn.utils.rnn.pad_sequence([states[:n] for states, n in zip(batch_morph_states, num_tokens)],
+                                                 batch_first=True)
+        batch_size = seg_state_masks.shape[0]
+        sent_seg_idxs = torch.cumsum(seg_state_masks.view(batch_size, -1), dim=1).view(seg_state_masks.shape) - 1
+        token_seg_idxs = torch.cumsum(seg_state_masks, dim=2) - 1
+        sent_idxs, token_idxs, char_idxs = torch.nonzero(seg_state_masks, as_tuple=True)
+        sent_seg_idxs = sent_seg_idxs[sent_idxs, token_idxs, char_idxs]
+        token_seg_idxs = token_seg_idxs[sent_idxs, token_idxs, char_idxs]
+        seg_sizes = torch.sum(seg_state_masks.view(batch_size, -1), dim=1)
+
+        seg_states = morph_states.new_zeros((batch_size, int(torch.max(seg_sizes)), morph_states.shape[-1]))
+        seg_states[sent_idxs, sent_seg_idxs] = morph_states[sent_idxs, token_idxs, char_idxs]
+        seg_states = nn.utils.rnn.pack_padded_sequence(seg_states, seg_sizes.cpu(), batch_first=True,
+                                                       enforce_sorted=False)
+        enc_seg_scores, _ = self.encoder(seg_states)
+        enc_seg_scores, _ = nn.utils.rnn.pad_packed_sequence(enc_seg_scores, batch_first=True)
         enc_seg_scores = self.seg_dropout(enc_seg_scores)
+
+        label_mask = torch.lt(token_seg_idxs, max_num_labels)
+        sent_idxs, token_idxs = sent_idxs[label_mask], token_idxs[label_mask]
+        sent_seg_idxs, token_seg_idxs = sent_seg_idxs[label_mask], token_seg_idxs[label_mask]
         label_scores = []
-        seg_sizes = torch.sum(seg_state_mask, dim=1)
-        for classifier in self.classifiers:
-            scores = classifier(enc_seg_scores)
-            scores = torch.split_with_sizes(scores.squeeze(dim=1), tuple(seg_sizes))
-            scores = nn.utils.rnn.pad_sequence(scores, batch_first=True)
-            fill_len = max_num_labels - scores.shape[1]
-            label_scores.append(F.pad(scores, (0, 0, 0, fill_len)))
-        return morph_scores, morph_states, label_scores
+        for scores in self.classifiers(enc_seg_scores):
+            scores_out = scores.new_zeros((batch_size, seg_state_masks.shape[1], max_num_labels, scores.shape[-1]))
+            scores_out[sent_idxs, token_idxs, token_seg_idxs] = scores[sent_idxs, sent_seg_idxs]
+            label_scores.append(scores_out)
+        return label_scores
+
+    # The pipeline labels are computed from the decoder states at the morpheme boundaries, so known tokens are
+    # decoded with their looked up segmentation as forced targets instead of skipping the decoder altogether
+    def _lookup_forward(self, token_chars, char_seq, enc_state, special_symbols, max_form_len, max_num_labels):
+        form_scores, _ = self.segment_lookup.get_scores(token_chars, max_form_len, max_num_labels)
+        form_chars = self.segment_lookup.get_form_chars(token_chars, max_form_len)
+        _, form_states, label_scores = self.segment_decoder(char_seq, enc_state, special_symbols, max_form_len,
+                                                            form_chars, max_num_labels)
+        return form_scores, form_states, label_scores
 
     def decode(self, morph_seg_scores, label_scores: list) -> (torch.Tensor, torch.Tensor):
         dec_forms, _ = self.segment_decoder.decode(morph_seg_scores, label_scores)
-        dec_labels = [classifier.decode(scores) for scores, classifier in zip(label_scores, self.classifiers)]
+        dec_labels = self.classifiers.decode(label_scores)
         return dec_forms, dec_labels
 
     def form_loss(self, form_scores, form_targets, criterion: nn.CrossEntropyLoss):
         return self.segment_decoder.form_loss(form_scores, form_targets, criterion)
 
     def labels_losses(self, labels_scores, labels_targets, criterion: nn.CrossEntropyLoss):
-        return [classifier.loss(scores, targets, criterion)
-                for scores, targets, classifier in zip(labels_scores, labels_targets, self.classifiers)]
+        return self.classifiers.loss(labels_scores, labels_targets, criterion)
@@ -47,11 +47,12 @@ if __name__ == '__main__':
 
     if not raw_root_path.exists():
         # raw_partition = tb.ud(raw_root_path, 'HTB', tb_root_path)
-        raw_partition = tb.spmrl_ner_conllu(raw_root_path, 'hebtb', tb_root_path)
+        raw_partition = tb.spmrl_ner_conllu(raw_root_path, 'hebtb', tb_root_path, categorical=True,
+                                             split_feats=True)
         # raw_partition = tb.spmrl(raw_root_path, 'hebtb', tb_root_path)
     else:
         # raw_partition = tb.ud(raw_root_path, 'HTB')
-        raw_partition = tb.spmrl_ner_conllu(raw_root_path, 'hebtb')
+        raw_partition = tb.spmrl_ner_conllu(raw_root_path, 'hebtb', categorical=True, split_feats=True)
         # raw_partition = tb.spmrl(raw_root_path, 'hebtb')
 
     bert_root_path = Path(f'./experiments/tokenizers/{tokenizer_type}/{tokenizer_version}')
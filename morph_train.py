@@ -1,3 +1,4 @@
+import sys
 import random
 import logging
 from pathlib import Path
@@ -7,11 +8,17 @@ import torch.nn as nn
 from torch.utils.data import DataLoader, TensorDataset
 from tqdm import trange
 from transformers import BertModel, BertTokenizerFast
-from data import preprocess_form, preprocess_labels
-from morph_model import BertTokenEmbeddingModel, SegmentDecoder, MorphSequenceModel, MorphPipelineModel
+from data import preprocess_form, preprocess_labels, preprocess_lookup
+from data.batching import BucketBatchSampler, MorphBatchCollator, BatchPrefetcher
+from morph_model import BertTokenEmbeddingModel, SegmentDecoder, MorphSequenceModel, MorphPipelineModel, SegmentLookup
+from morph_model import MultiTaskLoss
 from bclm import treebank as tb, ne_evaluate_mentions
 from hebrew_root_tokenizer import AlefBERTRootTokenizer
 import utils
+import dist_utils
+from async_eval import AsyncEvaluator
+from checkpoint import CheckpointManager, load_checkpoint, get_rng_states, set_rng_states
+from stage_timer import StageTimer, ProfilerWindow
 
 # Logging setup
 logger = logging.getLogger(__name__)
@@ -21,6 +28,14 @@ logging.basicConfig(
     level=logging.INFO
 )
 
+# Data parallel CPU training: launched with torchrun (torchrun --standalone --nproc_per_node N morph_train.py)
+# every process trains on its own shard of the train batches, gradients are averaged with gloo all reduce and dev/test
+# evaluation runs on rank 0 only (single process runs are unaffected)
+threads_per_process = None
+rank, world_size = dist_utils.init_distributed('gloo', threads_per_process)
+if rank > 0:
+    logging.getLogger().setLevel(logging.WARNING)
+
 # Config
 tb_schema = "UD"
 # tb_schema = "SPMRL"
@@ -116,16 +131,34 @@ if all([data_samples_file_paths[part].exists() for part in data_samples_file_pat
         datasets[part] = torch.load(file_path)
 else:
     datasets = load_preprocessed_data_samples(preprocessed_data_root_path, partition, label_names)
-    for part in datasets:
-        file_path = data_samples_file_paths[part]
-        logging.info(f'Saving {tb_schema} {out_morph_type} tensor dataset to {file_path}')
-        torch.save(datasets[part], file_path)
+    if dist_utils.is_main_process():
+        for part in datasets:
+            file_path = data_samples_file_paths[part]
+            logging.info(f'Saving {tb_schema} {out_morph_type} tensor dataset to {file_path}')
+            torch.save(datasets[part], file_path)
 # datasets['train'] = TensorDataset(*[t[:100] for t in datasets['train'].tensors])
 # datasets['dev'] = TensorDataset(*[t[:100] for t in datasets['dev'].tensors])
 # datasets['test'] = TensorDataset(*[t[:100] for t in datasets['test'].tensors])
-train_dataloader = DataLoader(datasets['train'], batch_size=1, shuffle=False)
-dev_dataloader = DataLoader(datasets['dev'], batch_size=100)
-test_dataloader = DataLoader(datasets['test'], batch_size=100)
+# Length bucketed batches trimmed to their own max lengths (targets are only trimmed for training), collated by
+# num_workers DataLoader worker processes and prefetched to the device (see below) prefetch_size batches ahead
+train_batch_size = 1
+eval_batch_size = 100
+num_workers = 4
+prefetch_size = 4
+pin_memory = torch.cuda.is_available() and world_size == 1
+train_seed = 42
+train_sampler = BucketBatchSampler(datasets['train'], train_batch_size, shuffle=True, seed=train_seed,
+                                   num_replicas=world_size, rank=rank)
+dev_sampler = BucketBatchSampler(datasets['dev'], eval_batch_size)
+test_sampler = BucketBatchSampler(datasets['test'], eval_batch_size)
+train_dataloader = DataLoader(datasets['train'], batch_sampler=train_sampler, collate_fn=MorphBatchCollator(),
+                              num_workers=num_workers, pin_memory=pin_memory, persistent_workers=num_workers > 0)
+dev_dataloader = DataLoader(datasets['dev'], batch_sampler=dev_sampler,
+                            collate_fn=MorphBatchCollator(trim_targets=False), num_workers=num_workers,
+                            pin_memory=pin_memory, persistent_workers=num_workers > 0)
+test_dataloader = DataLoader(datasets['test'], batch_sampler=test_sampler,
+                             collate_fn=MorphBatchCollator(trim_targets=False), num_workers=num_workers,
+                             pin_memory=pin_memory, persistent_workers=num_workers > 0)
 
 # Language Model
 bert_folder_path = Path(f'./experiments/transformers/{bert_model_name}/{bert_model_size_type}/{bert_tokenizer_type}/{bert_version}')
@@ -177,30 +210,91 @@ for name in label_names:
     config = {'id2label': label_vocab['id2labels'][name]}
     # if name == 'biose_layer0':
     #     config['crf_trans_type'] = 'BIOSE'
+    # config['loss_weight'] = 1.0
     label_classifier_configs.append(config)
+# Single linear layer for all the label classifiers (changes the md_model state_dict layout)
+fused_labels = False
+
+# Per token decoding budget: len(token) * decode_len_factor + decode_len_extra chars (None disables budgets)
+# and form loss over the decoded and target steps only (ragged layout) instead of the max_form_len padded scores
+decode_len_factor = None
+decode_len_extra = 4
+ragged_form_loss = False
 
 if md_strategry == "morph-pipeline":
     segmentor = SegmentDecoder(char_emb, hidden_size, num_layers, dropout, out_dropout, num_chars)
     md_model = MorphPipelineModel(xtoken_emb, segmentor, hidden_size, num_layers, dropout, out_dropout,
-                                  label_classifier_configs)
+                                  label_classifier_configs, decode_len_factor=decode_len_factor,
+                                  decode_len_extra=decode_len_extra, fused_labels=fused_labels)
 elif md_strategry == "morph-sequence":
     segmentor = SegmentDecoder(char_emb, hidden_size, num_layers, dropout, out_dropout, num_chars,
-                               label_classifier_configs)
-    md_model = MorphSequenceModel(xtoken_emb, segmentor)
+                               label_classifier_configs, fused_labels=fused_labels)
+    md_model = MorphSequenceModel(xtoken_emb, segmentor, decode_len_factor=decode_len_factor,
+                                  decode_len_extra=decode_len_extra)
 else:
     segmentor = SegmentDecoder(char_emb, hidden_size, num_layers, dropout, out_dropout, num_chars)
-    md_model = MorphSequenceModel(xtoken_emb, segmentor)
+    md_model = MorphSequenceModel(xtoken_emb, segmentor, decode_len_factor=decode_len_factor,
+                                  decode_len_extra=decode_len_extra)
+
+# Known token segmentation lookup (inference fast path, off by default): dev/test tokens indexed in the train set
+# get their train segmentation and label distribution. Only the morph-sequence model skips the segment decoder for
+# them (the morph-pipeline model decodes them forced on the looked up forms, so there is no decode saving)
+use_segment_lookup = False
+segment_lookup_min_count = 5
+segment_lookup_min_ratio = 1.0
+if use_segment_lookup:
+    token_segments = preprocess_lookup.build_segment_lookup(partition['train'], char_vocab['char2id'],
+                                                            label_vocab['labels2id'], label_names, sep=sep, eos=eos,
+                                                            min_count=segment_lookup_min_count,
+                                                            min_ratio=segment_lookup_min_ratio)
+    num_labels = [len(label_vocab['labels2id'][name]) for name in label_names]
+    md_model.segment_lookup = SegmentLookup(token_segments, num_chars, num_labels)
+# Dev/test form decoding: greedy (beam_size = 1) or n-best beam search (the labels are classified from the best
+# beam forms)
+beam_size = 1
+beam_length_penalty = 1.0
 device = 1
+if world_size > 1:
+    device = None
 char_special_symbols = {sos: char_sos.to(device), eos: char_eos.to(device),
                         sep: char_sep.to(device), pad: char_pad.to(device)}
 if device is not None:
     md_model.to(device)
+    if md_model.segment_lookup is not None:
+        md_model.segment_lookup.to(device)
 print(md_model)
+# Stage timing and throughput (printed every print_every batches) and an optional torch.profiler trace of the
+# train steps profile_steps[0] to profile_steps[1] - 1
+# Timing synchronizes CUDA around the per batch and per sentence stages, so it is off by default
+time_stages = False
+profile_steps = None
+# profile_steps = (10, 20)
+md_model.set_timer(StageTimer(time_stages, sync_cuda=device is not None, record_functions=profile_steps is not None))
+# Dev/test evaluation is timed separately, so an evaluation during an epoch keeps the train stage times
+eval_timer = StageTimer(time_stages, sync_cuda=device is not None)
+profiler_window = None
+if profile_steps is not None and dist_utils.is_main_process():
+    profiler_window = ProfilerWindow(profile_steps[0], profile_steps[1], out_path / 'profile_trace.json')
+train_data = BatchPrefetcher(train_dataloader, device, prefetch_size)
+dev_data = BatchPrefetcher(dev_dataloader, device, prefetch_size)
+test_data = BatchPrefetcher(test_dataloader, device, prefetch_size)
+
+
+# Best beam search segmentation ([num_tokens, max_form_len] form chars) of every sentence in the batch
+def beam_decode_batch(model: MorphSequenceModel, xtoken_seqs, char_seqs, num_tokens: list, max_form_len) -> list:
+    batch_beam_chars = []
+    with torch.no_grad():
+        for xtoken_seq, char_seq, n in zip(xtoken_seqs, char_seqs, num_tokens):
+            beam_chars, _ = model.beam_decode(xtoken_seq, char_seq, char_special_symbols, n, max_form_len, beam_size,
+                                              beam_length_penalty)
+            batch_beam_chars.append(beam_chars[:, 0])
+    return batch_beam_chars
 
 
 # Training and evaluation routine
-def process(model: MorphSequenceModel, data: DataLoader, criterion: nn.CrossEntropyLoss, epoch, phase, print_every,
-            teacher_forcing_ratio=0.0, optimizer: optim.AdamW = None, max_grad_norm=None):
+def process(model: MorphSequenceModel, data: BatchPrefetcher, criterion: nn.CrossEntropyLoss, epoch, phase, print_every,
+            teacher_forcing_ratio=0.0, optimizer: optim.AdamW = None, max_grad_norm=None,
+            multi_task_loss: MultiTaskLoss = None, step_callback=None):
     print_form_loss, total_form_loss = 0, 0
     print_label_losses, total_label_losses = [0 for _ in range(len(label_names))], [0 for _ in range(len(label_names))]
     print_target_forms, total_target_forms = [], []
@@ -208,61 +302,100 @@ def process(model: MorphSequenceModel, data: DataLoader, criterion: nn.CrossEntr
     print_decoded_forms, total_decoded_forms = [], []
     print_decoded_labels, total_decoded_labels = [], []
     print_decoded_lattice_rows, total_decoded_lattice_rows = [], []
+    timer = model.timer
+    timer.reset()
 
     for i, batch in enumerate(data):
-        batch = tuple(t.to(device) for t in batch)
-        batch_form_scores, batch_label_scores, batch_form_targets, batch_label_targets = [], [], [], []
-        batch_token_chars, batch_sent_ids, batch_num_tokens = [], [], []
-        for sent_xtoken, sent_token_chars, sent_form_chars, sent_labels in zip(*batch):
-            input_token_chars = sent_token_chars[:, :, -1]
-            num_tokens = len(sent_token_chars[sent_token_chars[:, 0, 1] > 0])
-            target_token_form_chars = sent_form_chars[:, :, -1]
-            max_form_len = target_token_form_chars.shape[1]
-            target_token_labels = sent_labels[:, :, 2:]
-            max_num_labels = target_token_labels.shape[1]
-            use_teacher_forcing = True if random.random() < teacher_forcing_ratio else False
-            form_scores, _, label_scores = model(sent_xtoken, input_token_chars, char_special_symbols, num_tokens,
-                                                 max_form_len, max_num_labels,
-                                                 target_token_form_chars if use_teacher_forcing else None)
-            batch_form_scores.append(form_scores)
-            batch_label_scores.append(label_scores)
-            batch_form_targets.append(target_token_form_chars[:num_tokens])
-            batch_label_targets.append(target_token_labels[:num_tokens])
-            batch_token_chars.append(input_token_chars[:num_tokens])
-            batch_sent_ids.append(sent_form_chars[:, :, 0].unique().item())
-            batch_num_tokens.append(num_tokens)
+        batch_form_targets, batch_label_targets = [], []
+        batch_ragged_form_scores, batch_ragged_form_targets = [], []
+        batch_token_chars = []
+        batch_xtokens = batch['xtokens']
+        input_token_chars = batch['token_chars']
+        target_token_form_chars = batch['form_chars']
+        max_form_len = target_token_form_chars.shape[2]
+        target_token_labels = batch['labels']
+        max_num_labels = target_token_labels.shape[2]
+        batch_num_tokens = batch['num_tokens'].tolist()
+        batch_sent_ids = batch['sent_ids'].tolist()
+        timer.add('data', data.wait_times[-1])
+        timer.count('sents', len(batch_num_tokens))
+        timer.count('tokens', sum(batch_num_tokens))
+        # Teacher forcing is drawn per sentence (sentences without forced form chars are decoded freely)
+        forced_form_chars = [target_token_form_chars[j] if random.random() < teacher_forcing_ratio else None
+                             for j in range(len(batch_num_tokens))]
+        # Dev/test beam search: the sentences are decoded forced on their best beam segmentation (instead of greedy
+        # decoding) so that the labels are classified from the beam forms
+        batch_beam_chars = None
+        if optimizer is None and beam_size > 1:
+            batch_beam_chars = beam_decode_batch(model, batch_xtokens, input_token_chars, batch_num_tokens,
+                                                 max_form_len)
+            forced_form_chars = batch_beam_chars
+        batch_output = model.forward_batch(batch_xtokens, input_token_chars, char_special_symbols, batch_num_tokens,
+                                           max_form_len, max_num_labels, forced_form_chars)
+        batch_form_scores, _, batch_label_scores = batch_output
+        for j, num_tokens in enumerate(batch_num_tokens):
+            if ragged_form_loss:
+                form_scores = batch_form_scores[j]
+                if forced_form_chars[j] is not None:
+                    form_chars = forced_form_chars[j][:num_tokens]
+                else:
+                    form_chars = torch.argmax(form_scores, dim=-1)
+                ragged_form_scores, form_lengths = model.to_ragged(form_scores, form_chars, input_token_chars[j],
+                                                                   char_special_symbols, max_num_labels,
+                                                                   target_token_form_chars[j])
+                batch_ragged_form_scores.append(ragged_form_scores)
+                batch_ragged_form_targets.append(model.to_ragged_targets(target_token_form_chars[j], form_lengths))
+            batch_form_targets.append(target_token_form_chars[j, :num_tokens])
+            batch_label_targets.append(target_token_labels[j, :num_tokens])
+            batch_token_chars.append(input_token_chars[j, :num_tokens])
 
         # Decode
         batch_form_scores = nn.utils.rnn.pad_sequence(batch_form_scores, batch_first=True)
         batch_label_scores = [nn.utils.rnn.pad_sequence(label_scores, batch_first=True)
                               for label_scores in list(map(list, zip(*batch_label_scores)))]
         with torch.no_grad():
-            batch_decoded_chars, batch_decoded_labels = model.decode(batch_form_scores, batch_label_scores)
+            with timer.stage('labels'):
+                batch_decoded_chars, batch_decoded_labels = model.decode(batch_form_scores, batch_label_scores)
+            if batch_beam_chars is not None:
+                for j, beam_chars in enumerate(batch_beam_chars):
+                    batch_decoded_chars[j, :batch_num_tokens[j]] = beam_chars
 
         # Form Loss
-        batch_form_targets = nn.utils.rnn.pad_sequence(batch_form_targets, batch_first=True)
-        form_loss = model.form_loss(batch_form_scores, batch_form_targets, criterion)
-        print_form_loss += form_loss.item()
-
-        # Label Losses
-        batch_label_targets = [[t[:, :, j] for j in range(t.shape[-1])] for t in batch_label_targets]
-        batch_label_targets = [nn.utils.rnn.pad_sequence(label_targets, batch_first=True)
-                               for label_targets in list(map(list, zip(*batch_label_targets)))]
-        label_losses = model.labels_losses(batch_label_scores, batch_label_targets, criterion)
-        for j in range(len(label_losses)):
-            print_label_losses[j] += label_losses[j].item()
+        with timer.stage('loss'):
+            batch_form_targets = nn.utils.rnn.pad_sequence(batch_form_targets, batch_first=True)
+            if ragged_form_loss:
+                form_loss = model.form_loss(torch.cat(batch_ragged_form_scores), torch.cat(batch_ragged_form_targets),
+                                            criterion)
+            else:
+                form_loss = model.form_loss(batch_form_scores, batch_form_targets, criterion)
+            print_form_loss += form_loss.item()
+
+            # Label Losses
+            batch_label_targets = [[t[:, :, j] for j in range(t.shape[-1])] for t in batch_label_targets]
+            batch_label_targets = [nn.utils.rnn.pad_sequence(label_targets, batch_first=True)
+                                   for label_targets in list(map(list, zip(*batch_label_targets)))]
+            label_losses = model.labels_losses(batch_label_scores, batch_label_targets, criterion)
+            for j in range(len(label_losses)):
+                print_label_losses[j] += label_losses[j].item()
 
         # Optimization Step
         if optimizer is not None:
-            form_loss.backward(retain_graph=len(label_losses) > 0)
-            for j in range(len(label_losses)):
-                label_losses[j].backward(retain_graph=(j < len(label_losses)-1))
-            if max_grad_norm is not None:
-                torch.nn.utils.clip_grad_norm_(model.parameters(), max_grad_norm)
-            optimizer.step()
-            optimizer.zero_grad()
+            with timer.stage('loss'):
+                loss = multi_task_loss([form_loss] + label_losses)
+            with timer.stage('backward'):
+                loss.backward()
+            with timer.stage('grad_sync'):
+                dist_utils.all_reduce_gradients(list(model.parameters()) + list(multi_task_loss.parameters()))
+            with timer.stage('optimizer'):
+                if max_grad_norm is not None:
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), max_grad_norm)
+                optimizer.step()
+                optimizer.zero_grad()
+            if step_callback is not None:
+                step_callback(epoch, i + 1)
 
         # To Lattice
+        timer.start('detokenize')
         for j in range(len(batch_sent_ids)):
             sent_id = batch_sent_ids[j]
             input_chars = batch_token_chars[j]
@@ -296,8 +429,10 @@ def process(model: MorphSequenceModel, data: DataLoader, criterion: nn.CrossEntr
             print_target_labels.append(target_morph_labels)
             print_decoded_forms.append(decoded_morph_segments)
             print_decoded_labels.append(decoded_morph_labels)
+        timer.stop('detokenize')
 
         # Log Print Eval
+        timer.start('evaluation')
         if (i + 1) % print_every == 0:
             sent_id, input_tokens, decoded_segments, decoded_labels = print_decoded_lattice_rows[-1]
             target_segments = print_target_forms[-1]
@@ -306,6 +441,10 @@ def process(model: MorphSequenceModel, data: DataLoader, criterion: nn.CrossEntr
             decoded_labels = print_decoded_labels[-1]
 
             print(f'epoch {epoch} {phase}, batch {i + 1} form char loss: {print_form_loss / print_every}')
+            data_wait_time = sum(data.wait_times[-print_every:]) / print_every
+            print(f'epoch {epoch} {phase}, batch {i + 1} data wait time per step: {data_wait_time * 1000:.2f}ms')
+            if optimizer is not None and model.num_classifiers > 0:
+                print(f'epoch {epoch} {phase}, batch {i + 1} multi task loss weights: {multi_task_loss.task_weights}')
             for j in range(len(label_names)):
                 print(f'epoch {epoch} {phase}, batch {i + 1} {label_names[j]} loss: {print_label_losses[j] / print_every}')
             print(f'epoch {epoch} {phase}, batch {i + 1} sent #{sent_id} input tokens  : {input_tokens}')
@@ -345,6 +484,11 @@ def process(model: MorphSequenceModel, data: DataLoader, criterion: nn.CrossEntr
             print_decoded_forms = []
             print_decoded_labels = []
             print_decoded_lattice_rows = []
+        timer.stop('evaluation')
+
+        timer.next_batch()
+        if timer.enabled and (i + 1) % print_every == 0:
+            print(f'epoch {epoch} {phase}, batch {i + 1} {timer.format_summary(print_every)}')
 
     # Log Total Eval
     if print_form_loss > 0:
@@ -358,6 +502,13 @@ def process(model: MorphSequenceModel, data: DataLoader, criterion: nn.CrossEntr
         total_decoded_lattice_rows.extend(print_decoded_lattice_rows)
 
     print(f'epoch {epoch} {phase}, total form char loss: {total_form_loss / len(data)}')
+    if timer.enabled:
+        print(f'epoch {epoch} {phase}, total {timer.format_summary()}')
+    if model.segment_lookup is not None and model.segment_lookup.num_queries > 0:
+        lookup = model.segment_lookup
+        print(f'epoch {epoch} {phase}, segment lookup hits: {lookup.num_hits}/{lookup.num_queries} '
+              f'(hit rate: {lookup.hit_rate})')
+        lookup.reset_stats()
     for j in range(len(label_names)):
         print(f'epoch {epoch} {phase}, total {label_names[j]} loss: {total_label_losses[j] / len(data)}')
 
@@ -387,35 +538,158 @@ for param in bert.parameters():
     param.requires_grad = False
 parameters = list(filter(lambda p: p.requires_grad, md_model.parameters()))
 # parameters = morph_tagger_model.parameters()
+# Form and label losses are summed (fixed or learned uncertainty weights) and backpropagated once
+# mt_loss_weights = [1.0] + [1.0 for _ in range(md_model.num_classifiers)]
+mt_loss_weights = None
+mt_loss_learned = False
+mt_loss = MultiTaskLoss(1 + md_model.num_classifiers, mt_loss_weights, mt_loss_learned)
+if device is not None:
+    mt_loss.to(device)
+parameters += list(mt_loss.parameters())
+dist_utils.broadcast_parameters(md_model)
+dist_utils.broadcast_parameters(mt_loss)
 adam = optim.AdamW(parameters, lr=lr)
 loss_fct = nn.CrossEntropyLoss(ignore_index=0)
 teacher_forcing_ratio = 1.0
 
+# Dev/test evaluation: decoding, scoring and NER reports, step is the epoch or the global train step
+# Returns the dev mset F1 score (all the eval fields)
+def evaluate(model: MorphSequenceModel, epoch, step):
+    train_timer = model.timer
+    model.set_timer(eval_timer)
+    dev_samples = process(model, dev_data, loss_fct, epoch, 'dev', 1)
+    dev_samples.to_csv(out_path / 'dev_samples.csv')
+    _, dev_mset_scores = utils.print_eval_scores(decoded_df=dev_samples, truth_df=partition['dev'], phase='dev',
+                                                 step=step, fields=eval_fields)
+    test_samples = process(model, test_data, loss_fct, epoch, 'test', 1)
+    model.set_timer(train_timer)
+    test_samples.to_csv(out_path / 'test_samples.csv')
+    utils.print_eval_scores(decoded_df=test_samples, truth_df=partition['test'], phase='test', step=step,
+                            fields=eval_fields)
+
+    if 'biose_layer0' in label_names:
+        utils.save_ner(dev_samples, out_path / 'morph_label_dev.bmes', 'biose_layer0')
+        dev_gold_file_path = Path(f'data/raw/{tb_data_src}/{tb_name}/gold/morph_gold_dev.bmes')
+        dev_pred_file_path = out_path / 'morph_label_dev.bmes'
+        print(ne_evaluate_mentions.evaluate_files(dev_gold_file_path, dev_pred_file_path))
+        print(ne_evaluate_mentions.evaluate_files(dev_gold_file_path, dev_pred_file_path, ignore_cat=True))
+
+        utils.save_ner(test_samples, out_path / 'morph_label_test.bmes', 'biose_layer0')
+        test_gold_file_path = Path(f'data/raw/{tb_data_src}/{tb_name}/gold/morph_gold_test.bmes')
+        test_pred_file_path = out_path / 'morph_label_test.bmes'
+        print(ne_evaluate_mentions.evaluate_files(test_gold_file_path, test_pred_file_path))
+        print(ne_evaluate_mentions.evaluate_files(test_gold_file_path, test_pred_file_path, ignore_cat=True))
+    return dev_mset_scores[tuple(eval_fields)][2]
+
+
+# Evaluate every eval_every_steps train steps (None: after every epoch), in a separate process that evaluates a
+# snapshot of the weights while training goes on (async_eval, CPU training only) or in the training process
+eval_every_steps = None
+async_eval = device is None
+evaluator = None
+if async_eval and dist_utils.is_main_process():
+    evaluator = AsyncEvaluator(evaluate, md_model)
+
+
+# Checkpoints (MD model, optimizer, multi task loss, RNG states and train sampler position) are written by a
+# background thread every checkpoint_every_steps train steps (None: at every evaluation), keeping the last
+# checkpoint_keep_last ones and the one with the best dev mset F1
+# Resume training with: python morph_train.py --resume [checkpoint file path] (default: the latest checkpoint)
+checkpoint_every_steps = None
+checkpoint_keep_last = 3
+checkpoint_keep_best = True
+checkpoint_path = out_path / 'checkpoints'
+checkpoint_manager = None
+if dist_utils.is_main_process():
+    checkpoint_manager = CheckpointManager(checkpoint_path, checkpoint_keep_last, checkpoint_keep_best)
+# Evaluations waiting for their dev score: (epoch, eval step) -> checkpoint step
+eval_checkpoint_steps = {}
+
+
+def save_checkpoint(epoch, step, global_step):
+    if checkpoint_manager is None:
+        return
+    state = {'md_model': md_model.state_dict(), 'optimizer': adam.state_dict(), 'mt_loss': mt_loss.state_dict(),
+             'rng': get_rng_states(), 'sampler': train_sampler.state_dict(step), 'epoch': epoch, 'step': step,
+             'global_step': global_step}
+    checkpoint_manager.save(state, global_step)
+
+
+def set_eval_scores(eval_results: list):
+    for eval_args, dev_score in eval_results:
+        global_step = eval_checkpoint_steps.pop(tuple(eval_args), None)
+        if checkpoint_manager is not None and global_step is not None:
+            checkpoint_manager.set_score(global_step, dev_score)
+
+
+start_epoch, resume_step = 1, 0
+if '--resume' in sys.argv:
+    resume_arg_idx = sys.argv.index('--resume')
+    if resume_arg_idx + 1 < len(sys.argv):
+        resume_file_path = Path(sys.argv[resume_arg_idx + 1])
+    else:
+        resume_file_path = CheckpointManager.read_latest_path(checkpoint_path)
+    if resume_file_path is None:
+        logging.warning(f'No checkpoint found in {checkpoint_path}, training from scratch')
+    else:
+        checkpoint = load_checkpoint(resume_file_path)
+        md_model.load_state_dict(checkpoint['md_model'])
+        adam.load_state_dict(checkpoint['optimizer'])
+        mt_loss.load_state_dict(checkpoint['mt_loss'])
+        set_rng_states(checkpoint['rng'])
+        train_sampler.load_state_dict(checkpoint['sampler'])
+        resume_step = checkpoint['sampler']['num_batches']
+        start_epoch = checkpoint['epoch'] if resume_step > 0 else checkpoint['epoch'] + 1
+        logging.info(f'Resuming training at epoch {start_epoch} step {resume_step} '
+                     f'(global step {checkpoint["global_step"]})')
+
+
+def run_evaluation(epoch, step, global_step, eval_step):
+    if checkpoint_every_steps is None:
+        save_checkpoint(epoch, step, global_step)
+    if not dist_utils.is_main_process():
+        return
+    if evaluator is not None:
+        eval_checkpoint_steps[(epoch, eval_step)] = global_step
+        evaluator.submit(md_model, epoch, eval_step)
+        return
+    md_model.eval()
+    with torch.no_grad():
+        dev_score = evaluate(md_model, epoch, eval_step)
+    md_model.train()
+    eval_checkpoint_steps[(epoch, eval_step)] = global_step
+    set_eval_scores([((epoch, eval_step), dev_score)])
+
+
+def on_train_step(epoch, step):
+    if epoch == start_epoch:
+        step += resume_step
+    global_step = (epoch - 1) * len(train_data) + step
+    if profiler_window is not None:
+        profiler_window.step(global_step)
+    if evaluator is not None:
+        set_eval_scores(evaluator.poll())
+    if checkpoint_every_steps is not None and global_step % checkpoint_every_steps == 0:
+        save_checkpoint(epoch, step, global_step)
+    if eval_every_steps is not None and global_step % eval_every_steps == 0:
+        run_evaluation(epoch, step, global_step, global_step)
+
+
 # Training epochs
-for i in trange(epochs, desc="Epoch"):
+if profiler_window is not None:
+    profiler_window.step((start_epoch - 1) * len(train_data) + resume_step)
+for i in trange(start_epoch - 1, epochs, desc="Epoch"):
     epoch = i + 1
     md_model.train()
-    process(md_model, train_dataloader, loss_fct, epoch, 'train', 10, teacher_forcing_ratio, adam, max_grad_norm)
-    md_model.eval()
-    with torch.no_grad():
-        dev_samples = process(md_model, dev_dataloader, loss_fct, epoch, 'dev', 1)
-        dev_samples.to_csv(out_path / 'dev_samples.csv')
-        utils.print_eval_scores(decoded_df=dev_samples, truth_df=partition['dev'], phase='dev', step=epoch,
-                                      fields=eval_fields)
-        test_samples = process(md_model, test_dataloader, loss_fct, epoch, 'test', 1)
-        test_samples.to_csv(out_path / 'test_samples.csv')
-        utils.print_eval_scores(decoded_df=test_samples, truth_df=partition['test'], phase='test', step=epoch,
-                                      fields=eval_fields)
-
-        if 'biose_layer0' in label_names:
-            utils.save_ner(dev_samples, out_path / 'morph_label_dev.bmes', 'biose_layer0')
-            dev_gold_file_path = Path(f'data/raw/{tb_data_src}/{tb_name}/gold/morph_gold_dev.bmes')
-            dev_pred_file_path = out_path / 'morph_label_dev.bmes'
-            print(ne_evaluate_mentions.evaluate_files(dev_gold_file_path, dev_pred_file_path))
-            print(ne_evaluate_mentions.evaluate_files(dev_gold_file_path, dev_pred_file_path, ignore_cat=True))
-
-            utils.save_ner(test_samples, out_path / 'morph_label_test.bmes', 'biose_layer0')
-            test_gold_file_path = Path(f'data/raw/{tb_data_src}/{tb_name}/gold/morph_gold_test.bmes')
-            test_pred_file_path = out_path / 'morph_label_test.bmes'
-            print(ne_evaluate_mentions.evaluate_files(test_gold_file_path, test_pred_file_path))
-            print(ne_evaluate_mentions.evaluate_files(test_gold_file_path, test_pred_file_path, ignore_cat=True))
+    process(md_model, train_data, loss_fct, epoch, 'train', 10, teacher_forcing_ratio, adam, max_grad_norm,
+            mt_loss, on_train_step)
+    if eval_every_steps is None:
+        run_evaluation(epoch, len(train_data), epoch * len(train_data), epoch)
+    dist_utils.barrier()
+if profiler_window is not None:
+    profiler_window.stop()
+if evaluator is not None:
+    set_eval_scores(evaluator.close())
+if checkpoint_manager is not None:
+    checkpoint_manager.close()
+dist_utils.cleanup_distributed()
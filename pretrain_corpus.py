@@ -0,0 +1,223 @@
+import sys
+import json
+import shutil
+import hashlib
+import logging
+import multiprocessing as mp
+from pathlib import Path
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+# Pre-tokenized pretraining corpus: the word piece ids of every line of the text files, tokenized once per
+# tokenizer version and shared by all the pretraining runs that use that tokenizer
+# Layout of a compiled corpus folder ({corpus_root}/{tokenizer_name}-{tokenizer fingerprint}):
+# shard-{i:05d}.bin      - the ids of the lines of the shard, each line followed by [SEP], concatenated (uint16,
+#                          or uint32 for vocabularies larger than 65536)
+# shard-{i:05d}.idx.npy  - int64 offsets of the lines in the shard (num_lines + 1 entries, the last one is the
+#                          number of ids in the shard)
+# meta.json              - tokenizer name and fingerprint, dtype, shard sizes and the source text files
+# Lines with less than two words are skipped (as in bert_train.get_tokenized_data). A line is never split across
+# shards
+# Usage: python pretrain_corpus.py tokenizer_path corpus_root text_path [text_path ...]
+
+shard_size = 1 << 28
+lines_per_chunk = 10000
+num_workers = 8
+
+_worker_tokenizer = None
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    vocab = sorted(tokenizer.get_vocab().items(), key=lambda kv: kv[1])
+    h = hashlib.sha1(type(tokenizer).__name__.encode('utf8'))
+    h.update(json.dumps(vocab, ensure_ascii=False).encode('utf8'))
+    return h.hexdigest()[:16]
+
+
+def load_tokenizer(tokenizer_path):
+    tokenizer_path = Path(tokenizer_path)
+    if 'roots' in tokenizer_path.name:
+        from hebrew_root_tokenizer import AlefBERTRootTokenizer
+        return AlefBERTRootTokenizer(str(tokenizer_path / 'vocab.txt'))
+    from transformers import BertTokenizerFast
+    return BertTokenizerFast.from_pretrained(str(tokenizer_path))
+
+
+def _read_line_chunks(text_paths: list):
+    lines = []
+    for text_path in text_paths:
+        with open(text_path, encoding='utf8') as f:
+            for line in f:
+                if len(line.split()) > 1:
+                    lines.append(line.strip())
+                    if len(lines) == lines_per_chunk:
+                        yield lines
+                        lines = []
+    if lines:
+        yield lines
+
+
+def _init_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def _tokenize_chunk(lines: list) -> (np.array, np.array):
+    input_ids = _worker_tokenizer(lines, add_special_tokens=False, return_attention_mask=False,
+                                  return_token_type_ids=False)['input_ids']
+    input_ids = [ids + [_worker_tokenizer.sep_token_id] for ids in input_ids]
+    line_lengths = np.array([len(ids) for ids in input_ids], dtype=np.int64)
+    ids = np.fromiter((i for ids in input_ids for i in ids), dtype=np.int64, count=int(line_lengths.sum()))
+    return ids, line_lengths
+
+
+class _ShardWriter:
+
+    def __init__(self, dir_path: Path, dtype):
+        self.dir_path = dir_path
+        self.dtype = dtype
+        self.shards = []
+        self.f = None
+
+    def _open_shard(self):
+        self.f = open(self.dir_path / f'shard-{len(self.shards):05d}.bin', 'wb')
+        self.offsets = [np.zeros(1, dtype=np.int64)]
+        self.num_ids = 0
+        self.num_lines = 0
+
+    def _close_shard(self):
+        self.f.close()
+        np.save(self.dir_path / f'shard-{len(self.shards):05d}.idx.npy', np.concatenate(self.offsets))
+        self.shards.append({'num_ids': self.num_ids, 'num_lines': self.num_lines})
+        self.f = None
+
+    def write(self, ids: np.array, line_lengths: np.array):
+        line_ends = np.cumsum(line_lengths)
+        start_line = 0
+        while start_line < len(line_lengths):
+            if self.f is None:
+                self._open_shard()
+            # Lines that fit in the current shard (at least one line, so that long lines are not dropped)
+            base = line_ends[start_line] - line_lengths[start_line]
+            end_line = start_line + max(int(np.searchsorted(line_ends[start_line:] - base,
+                                                            shard_size - self.num_ids, side='right')), 1)
+            if self.num_ids > 0 and line_ends[end_line - 1] - base > shard_size - self.num_ids:
+                self._close_shard()
+                continue
+            shard_ids = ids[base:line_ends[end_line - 1]]
+            self.f.write(shard_ids.astype(self.dtype).tobytes())
+            self.offsets.append(line_ends[start_line:end_line] - base + self.num_ids)
+            self.num_ids += len(shard_ids)
+            self.num_lines += end_line - start_line
+            start_line = end_line
+            if self.num_ids >= shard_size:
+                self._close_shard()
+
+    def close(self) -> list:
+        if self.f is not None:
+            self._close_shard()
+        return self.shards
+
+
+# Tokenizes the text files (in num_workers processes) into the corpus folder of the tokenizer version, unless it
+# was already compiled. Returns the corpus folder path
+def compile_corpus(text_paths: list, tokenizer, corpus_root_path, tokenizer_name) -> Path:
+    fingerprint = tokenizer_fingerprint(tokenizer)
+    corpus_path = Path(corpus_root_path) / f'{tokenizer_name}-{fingerprint}'
+    if (corpus_path / 'meta.json').exists():
+        logging.info(f'Using compiled corpus {corpus_path}')
+        return corpus_path
+    tmp_path = corpus_path.with_name(f'.{corpus_path.name}.tmp')
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+    dtype = np.uint16 if len(tokenizer.get_vocab()) <= np.iinfo(np.uint16).max + 1 else np.uint32
+    logging.info(f'Compiling {text_paths} with {tokenizer_name} ({fingerprint}) to {corpus_path}')
+    writer = _ShardWriter(tmp_path, dtype)
+    ctx = mp.get_context('fork')
+    with ctx.Pool(num_workers, initializer=_init_worker, initargs=(tokenizer,)) as pool:
+        for i, (ids, line_lengths) in enumerate(pool.imap(_tokenize_chunk, _read_line_chunks(text_paths))):
+            writer.write(ids, line_lengths)
+            if (i + 1) % 100 == 0:
+                logging.info(f'Tokenized {(i + 1) * lines_per_chunk} lines')
+    shards = writer.close()
+    meta = {'tokenizer_name': tokenizer_name, 'tokenizer_fingerprint': fingerprint,
+            'dtype': np.dtype(dtype).name, 'text_paths': [str(p) for p in text_paths], 'shards': shards,
+            'num_ids': sum(shard['num_ids'] for shard in shards),
+            'num_lines': sum(shard['num_lines'] for shard in shards)}
+    with open(tmp_path / 'meta.json', 'w') as f:
+        json.dump(meta, f, indent=2)
+    tmp_path.rename(corpus_path)
+    logging.info(f'Compiled {meta["num_lines"]} lines, {meta["num_ids"]} ids in {len(shards)} shards')
+    return corpus_path
+
+
+# Read only memory maps of the shards of a compiled corpus
+class CorpusShards:
+
+    def __init__(self, corpus_path):
+        self.corpus_path = Path(corpus_path)
+        with open(self.corpus_path / 'meta.json') as f:
+            self.meta = json.load(f)
+        dtype = np.dtype(self.meta['dtype'])
+        self.shards = [np.memmap(self.corpus_path / f'shard-{i:05d}.bin', dtype=dtype, mode='r',
+                                 shape=(shard['num_ids'],))
+                       for i, shard in enumerate(self.meta['shards']) if shard['num_ids'] > 0]
+        self.offsets = [np.load(self.corpus_path / f'shard-{i:05d}.idx.npy', mmap_mode='r')
+                        for i, shard in enumerate(self.meta['shards']) if shard['num_ids'] > 0]
+
+    def __len__(self):
+        return len(self.shards)
+
+    @property
+    def num_ids(self):
+        return self.meta['num_ids']
+
+    # The ids of a span of a shard (a view of the memory map, nothing is read before it is used)
+    def span(self, shard_idx, start, length) -> np.array:
+        return self.shards[shard_idx][start:start + length]
+
+    def line(self, shard_idx, line_idx) -> np.array:
+        offsets = self.offsets[shard_idx]
+        return self.shards[shard_idx][offsets[line_idx]:offsets[line_idx + 1]]
+
+
+# Fixed length MLM blocks over a compiled corpus: [CLS] followed by block_size - 1 consecutive ids (lines
+# ending with their [SEP]), blocks do not cross shards. set_epoch shifts the block boundaries
+# (by a per epoch pseudo random offset) so that every epoch sees different spans. The number of blocks does not
+# depend on the epoch (the samplers take the length once)
+class CorpusBlockDataset(Dataset):
+
+    def __init__(self, corpus_path, block_size, cls_token_id):
+        super(CorpusBlockDataset, self).__init__()
+        self.corpus = CorpusShards(corpus_path)
+        self.block_size = block_size
+        self.cls_token_id = cls_token_id
+        self.span_size = block_size - 1
+        num_blocks = [max(len(shard) - self.span_size + 1, 0) // self.span_size for shard in self.corpus.shards]
+        self.cum_blocks = np.cumsum(num_blocks)
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch):
+        self.offset = (epoch * 7919) % self.span_size
+
+    def __len__(self):
+        return int(self.cum_blocks[-1]) if len(self.cum_blocks) > 0 else 0
+
+    def lengths(self) -> np.array:
+        return np.full(len(self), self.block_size, dtype=np.int64)
+
+    def __getitem__(self, idx):
+        shard_idx = int(np.searchsorted(self.cum_blocks, idx, side='right'))
+        block_idx = idx - (int(self.cum_blocks[shard_idx - 1]) if shard_idx > 0 else 0)
+        start = self.offset + block_idx * self.span_size
+        input_ids = np.empty(self.block_size, dtype=np.int64)
+        input_ids[0] = self.cls_token_id
+        input_ids[1:] = self.corpus.span(shard_idx, start, self.span_size)
+        return {'input_ids': torch.from_numpy(input_ids)}
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    tokenizer_path = Path(sys.argv[1])
+    compile_corpus(sys.argv[3:], load_tokenizer(tokenizer_path), sys.argv[2], tokenizer_path.name)
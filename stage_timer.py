@@ -0,0 +1,128 @@
+import time
+import logging
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+import torch
+
+
+# Per batch wall time of the training/evaluation stages, plus per batch counters (sentences, tokens, decoder steps)
+# stage(name) times a block (or start(name) and stop(name) the code in between) and adds it to the current batch,
+# count(name, n) adds to a counter and next_batch() closes the current batch (its total wall time is the time
+# since the previous next_batch call)
+# A disabled timer does nothing (so the model can always call it). With sync_cuda, CUDA is synchronized around
+# every stage so the asynchronous kernels are charged to the stage that launched them, except the stages timed
+# with sync=False (per token stages, whose kernels are charged to the next synchronized stage), and with
+# record_functions every stage is also a torch.profiler record_function range
+class StageTimer:
+
+    def __init__(self, enabled=True, sync_cuda=False, record_functions=False):
+        self.enabled = enabled
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.record_functions = record_functions
+        self.started_stages = {}
+        self.reset()
+
+    def reset(self):
+        self.batches = []
+        self.batch_times = []
+        self.cur_batch = defaultdict(float)
+        self.batch_start_time = time.perf_counter()
+
+    def _sync(self, sync=True):
+        if self.sync_cuda and sync:
+            torch.cuda.synchronize()
+
+    @contextmanager
+    def _stage(self, name, sync):
+        self._sync(sync)
+        start_time = time.perf_counter()
+        with torch.profiler.record_function(name) if self.record_functions else nullcontext():
+            yield
+        self._sync(sync)
+        self.cur_batch[name] += time.perf_counter() - start_time
+
+    def stage(self, name, sync=True):
+        if not self.enabled:
+            return nullcontext()
+        return self._stage(name, sync)
+
+    def start(self, name):
+        if self.enabled:
+            self.started_stages[name] = self._stage(name, True)
+            self.started_stages[name].__enter__()
+
+    def stop(self, name):
+        if self.enabled:
+            self.started_stages.pop(name).__exit__(None, None, None)
+
+    def add(self, name, seconds):
+        if self.enabled:
+            self.cur_batch[name] += seconds
+
+    def count(self, name, n):
+        if self.enabled:
+            self.cur_batch[f'#{name}'] += n
+
+    def next_batch(self):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.batches.append(self.cur_batch)
+        self.batch_times.append(now - self.batch_start_time)
+        self.cur_batch = defaultdict(float)
+        self.batch_start_time = now
+
+    # Mean stage times (seconds per batch) and counter sums over the last num_batches batches, and their total
+    # wall time
+    def summary(self, num_batches=None) -> (dict, dict, float):
+        batches = self.batches[-num_batches:] if num_batches else self.batches
+        total_time = sum(self.batch_times[-num_batches:] if num_batches else self.batch_times)
+        stage_times, counts = defaultdict(float), defaultdict(float)
+        for batch in batches:
+            for name, value in batch.items():
+                if name[0] == '#':
+                    counts[name[1:]] += value
+                else:
+                    stage_times[name] += value / len(batches)
+        return dict(stage_times), dict(counts), total_time
+
+    def format_summary(self, num_batches=None) -> str:
+        stage_times, counts, total_time = self.summary(num_batches)
+        stages_str = ', '.join(f'{name} {t * 1000:.1f}' for name, t in stage_times.items())
+        throughput = []
+        if total_time > 0:
+            for name in ['sents', 'tokens']:
+                if name in counts:
+                    throughput.append(f'{counts[name] / total_time:.1f} {name}/sec')
+        if counts.get('tokens') and 'decoder_steps' in counts:
+            throughput.append(f'{counts["decoder_steps"] / counts["tokens"]:.2f} decoder steps/token')
+        return f'stage times (ms/batch): {stages_str} | {", ".join(throughput)}'
+
+
+# torch.profiler trace of the train steps start_step to end_step - 1, exported as a chrome trace to trace_path
+# step(step) is called before training (with the number of steps already done) and after every train step
+class ProfilerWindow:
+
+    def __init__(self, start_step, end_step, trace_path):
+        self.start_step = start_step
+        self.end_step = end_step
+        self.trace_path = trace_path
+        self.profiler = None
+
+    def step(self, step):
+        if self.profiler is None and step == self.start_step - 1:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+            self.profiler.start()
+        elif self.profiler is not None and step >= self.end_step - 1:
+            self.stop()
+
+    def stop(self):
+        if self.profiler is None:
+            return
+        self.profiler.stop()
+        self.profiler.export_chrome_trace(str(self.trace_path))
+        logging.info(f'Saved profiler trace of steps [{self.start_step}, {self.end_step}) to {self.trace_path}')
+        self.profiler = None
@@ -1,5 +1,6 @@
 import json
 import torch
+import numpy as np
 import pandas as pd
 from itertools import zip_longest
 from collections import Counter
@@ -54,9 +55,7 @@ def _to_feats_strs(labels: dict) -> list:
     feature_values = [labels[feat_name] for feat_name in feature_names]
     feature_values = [f for f in zip_longest(*feature_values)]
     for fvalues in feature_values:
-        fstrs = [f'{feature_names[j]}={fvalues[j]}' for j in range(len(feature_names)) if fvalues[j] != '_']
-        feats_str = '|'.join(fstrs) if len(fstrs) > 0 else '_'
-        feats_strs.append(feats_str)
+        feats_strs.append(tb.feats_str(dict(zip(feature_names, fvalues))))
     return feats_strs
 
 
@@ -115,6 +114,7 @@ def print_eval_scores(decoded_df, truth_df, fields, phase, step):
         print(f'{phase} step {step} aligned {fs} eval scores: [P: {p}, R: {r}, F: {f}]')
         p, r, f = mset_scores[fs]
         print(f'{phase} step {step} mset {fs} eval scores   : [P: {p}, R: {r}, F: {f}]')
+    return aligned_scores, mset_scores
 
 
 # 0	1	גנן	גנן	NN	NN	gen=M|num=S	1
@@ -135,17 +135,18 @@ def save_lattice(df, out_file_path):
             f.write('\n')
 
 
-# Save bmes file used by the ner evaluation script
+# Save bmes file used by the ner evaluation script (morphemes without the ner feature are labeled O)
 def save_ner(df, out_file_path, ner_feat_name):
-    gb = df.groupby('sent_id')
+    ner_labels = tb.get_feat_values(df, [ner_feat_name])[ner_feat_name]
+    ner_labels = np.where(ner_labels == '_', 'O', ner_labels)
+    order = np.argsort(df.sent_id.to_numpy(), kind='stable')
+    sent_ids, forms = df.sent_id.to_numpy()[order], df.form.to_numpy()[order]
     with open(out_file_path, 'w') as f:
-        for sid, group in gb:
-            for row in group[['form', 'feats']].itertuples():
-                if row.feats == '_':
-                    feats = {ner_feat_name: 'O'}
-                else:
-                    feats = {feat.split('=')[0]: feat.split('=')[1] for feat in row.feats.split('|')}
-                f.write(f"{row.form} {feats[ner_feat_name]}\n")
+        for i, (sent_id, form, ner_label) in enumerate(zip(sent_ids, forms, ner_labels[order])):
+            if i > 0 and sent_id != sent_ids[i - 1]:
+                f.write('\n')
+            f.write(f"{form} {ner_label}\n")
+        if len(sent_ids) > 0:
             f.write('\n')
 
 